@@ -0,0 +1,210 @@
+# actuator_ipc.py
+# This file implements the command channel between the main application and
+# the actuator controllers (fan, diode).
+#
+# Commands are still written to the /tmp state files, but every write is now
+# followed by a wakeup on a named pipe next to the state file. Controllers
+# sleep in select() on that pipe instead of re-reading the file every second,
+# so a command takes effect as soon as it is written. Each command carries the
+# time it was issued; the controller writes back an acknowledgement with the
+# measured command-to-actuation latency.
+
+import asyncio
+import errno
+import fcntl
+import json
+import os
+import select
+import threading
+import time
+
+# Controllers still re-read the state file this often, in case a wakeup is lost
+# (e.g. the controller was restarted between a write and its notification).
+FALLBACK_POLL_S = 30.0
+
+# A latency log that nobody drains is started over once it grows past this size.
+LATENCY_LOG_MAX_BYTES = int(os.environ.get("ACTUATOR_LATENCY_LOG_MAX_BYTES", 1024 * 1024))
+# Only the process holding this lock drains the latency logs (see claim_latency_logs).
+LATENCY_DRAIN_LOCK = os.environ.get("ACTUATOR_LATENCY_LOCK", "/tmp/actuator_latency.lock")
+_drain_lock = {"file": None, "pid": None, "last_attempt": None}
+_drain_lock_guard = threading.Lock()
+
+
+def notify_path(state_file):
+    return state_file + ".notify"
+
+
+def ack_path(state_file):
+    return state_file + ".ack"
+
+
+def latency_log_path(state_file):
+    return state_file + ".latency"
+
+
+def _atomic_write(path, text):
+    # Unique per thread, so concurrent writers never rename each other's file.
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_command(state_file, value):
+    """
+    Writes a command to the state file and wakes up the controller.
+
+    The file holds the value on the first line and the issue time (ns since
+    the epoch) on the second. The wakeup is best-effort: if no controller is
+    listening, it picks the value up when it starts.
+    """
+    _atomic_write(state_file, f"{value}\n{time.time_ns()}\n")
+    try:
+        fd = os.open(notify_path(state_file), os.O_WRONLY | os.O_NONBLOCK)
+    except OSError as e:
+        # ENOENT: no controller has created the pipe yet. ENXIO: nobody is reading it.
+        if e.errno not in (errno.ENOENT, errno.ENXIO):
+            raise
+        return
+    try:
+        os.write(fd, b"\x01")
+    except BlockingIOError:
+        pass  # The pipe is already full of pending wakeups.
+    finally:
+        os.close(fd)
+
+
+def read_command(state_file):
+    """Returns (value, issued_ns) from the state file; issued_ns is None for old-style files."""
+    with open(state_file, 'r') as f:
+        lines = f.read().split()
+    if not lines:
+        raise ValueError("empty state file")
+    issued_ns = int(lines[1]) if len(lines) > 1 else None
+    return lines[0], issued_ns
+
+
+def write_ack(state_file, value, issued_ns):
+    """Records that a command was applied, with its command-to-actuation latency."""
+    actuated_ns = time.time_ns()
+    latency_ms = None if issued_ns is None else round((actuated_ns - issued_ns) / 1e6, 3)
+    _atomic_write(ack_path(state_file), json.dumps({
+        "value": value, "issued_ns": issued_ns, "actuated_ns": actuated_ns, "latency_ms": latency_ms
+    }))
+    if latency_ms is not None:
+        # The ack file only holds the latest command; every latency is also
+        # appended here until the app's metrics collector drains it. If the
+        # app is not running (or never scraped), the oldest latencies are dropped.
+        path = latency_log_path(state_file)
+        try:
+            oversized = os.path.getsize(path) >= LATENCY_LOG_MAX_BYTES
+        except OSError:
+            oversized = False
+        with open(path, 'w' if oversized else 'a') as f:
+            f.write(f"{latency_ms}\n")
+    return latency_ms
+
+
+def drain_latencies(state_file):
+    """Returns the latencies (ms) logged since the last call and clears the log."""
+    path = latency_log_path(state_file)
+    # Rename first, so acks written while the log is read go to a new log.
+    draining = f"{path}.{os.getpid()}.{threading.get_ident()}.draining"
+    try:
+        os.replace(path, draining)
+    except FileNotFoundError:
+        return []
+    try:
+        with open(draining) as f:
+            return [float(line) for line in f if line.strip()]
+    finally:
+        os.remove(draining)
+
+
+def claim_latency_logs(lock_path=LATENCY_DRAIN_LOCK):
+    """
+    Returns True if this process drains the latency logs. Draining moves the
+    logged latencies into the caller, so with several app processes only the
+    first to take the lock file drains them; it keeps the lock until it exits.
+    Cheap to call often; other processes retry at most every 30s.
+    """
+    with _drain_lock_guard:
+        if _drain_lock["file"] is not None and _drain_lock["pid"] == os.getpid():
+            return True
+        if _drain_lock["pid"] == os.getpid() and time.monotonic() - _drain_lock["last_attempt"] < 30:
+            return False
+        # A forked child gets a fresh attempt; its parent's lock is not its own.
+        _drain_lock.update(file=None, pid=os.getpid(), last_attempt=time.monotonic())
+        lock_file = open(lock_path, 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        _drain_lock["file"] = lock_file
+        return True
+
+
+def read_ack(state_file):
+    """Returns the controller's last acknowledgement, or None if there is none yet."""
+    try:
+        with open(ack_path(state_file), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class CommandWatcher:
+    """
+    Blocks a controller until the main application writes a new command.
+
+    The named pipe is opened read-write so it always has a writer; otherwise
+    select() would report end-of-file continuously whenever the main
+    application is not holding it open.
+    """
+
+    def __init__(self, state_file):
+        self.path = notify_path(state_file)
+        try:
+            os.mkfifo(self.path)
+        except FileExistsError:
+            pass
+        self._fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+
+    def wait(self, timeout=FALLBACK_POLL_S):
+        """Waits for a wakeup; returns True if one arrived, False on timeout."""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return False
+        self._drain()
+        return True
+
+    async def wait_async(self, timeout=FALLBACK_POLL_S):
+        """Like wait(), but lets the asyncio event loop watch the pipe."""
+        loop = asyncio.get_running_loop()
+        woken = loop.create_future()
+        loop.add_reader(self._fd, lambda: woken.done() or woken.set_result(True))
+        try:
+            await asyncio.wait_for(woken, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(self._fd)
+        self._drain()
+        return True
+
+    def _drain(self):
+        try:
+            while os.read(self._fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
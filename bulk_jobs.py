@@ -0,0 +1,110 @@
+# bulk_jobs.py
+# This file fans a large list of inference inputs out as one Celery group of
+# chunked tasks and tracks them under a single job id, so a whole folder of
+# inputs costs one HTTP call and a handful of broker messages.
+
+import json
+import os
+import uuid
+
+import redis
+from celery import group
+
+from tasks import (celery, run_npu_inference_chunk_task, CELERY_RESULT_BACKEND, BULK_DONE_KEY, BULK_FAILED_KEY,
+                   BULK_JOB_TTL_S)
+
+# --- Bulk Job Configuration ---
+# Number of inputs sent to a worker in one task (and one NPU batch).
+BULK_CHUNK_SIZE = int(os.environ.get('NPU_BULK_CHUNK_SIZE', 32))
+# Upper bound on the number of inputs accepted in one job.
+BULK_MAX_ITEMS = int(os.environ.get('NPU_BULK_MAX_ITEMS', 100000))
+
+JOB_KEY_PREFIX = "npu-bulk-job-"
+
+_redis = None
+
+def _client():
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(CELERY_RESULT_BACKEND)
+    return _redis
+
+def chunk_task_id(job_id, chunk_index):
+    # Chunk task ids are derived from the job id, so a page of results is read
+    # without loading the ids of every chunk in the job.
+    return f"{job_id}-{chunk_index}"
+
+def submit_job(model_name, inputs, chunk_size=BULK_CHUNK_SIZE):
+    """Queues inputs as a group of chunk tasks and returns the job id."""
+    job_id = str(uuid.uuid4())
+    meta = {"model_name": model_name, "total": len(inputs), "chunk_size": chunk_size}
+    # Stored first, so a chunk that finishes straight away belongs to a known job.
+    _client().set(JOB_KEY_PREFIX + job_id, json.dumps(meta), ex=BULK_JOB_TTL_S)
+
+    chunks = [inputs[i:i + chunk_size] for i in range(0, len(inputs), chunk_size)]
+    group(run_npu_inference_chunk_task.s(model_name, chunk, job_id=job_id, chunk_index=index)
+          .set(task_id=chunk_task_id(job_id, index))
+          for index, chunk in enumerate(chunks)).apply_async()
+    return job_id
+
+def get_job(job_id, offset=0, limit=100):
+    """
+    Returns the job's progress and one page of results, or None if the job is unknown.
+    Items whose chunk has not finished yet are reported as pending.
+
+    Progress comes from the job's bitmaps of finished chunks, and only the
+    chunks covering the page are looked up, so a poll costs a few Redis
+    round-trips however large the job is.
+    """
+    client = _client()
+    raw = client.get(JOB_KEY_PREFIX + job_id)
+    if raw is None:
+        return None
+    meta = json.loads(raw)
+    total, chunk_size = meta["total"], meta["chunk_size"]
+    last_chunk = (total - 1) // chunk_size
+
+    offset = max(0, min(offset, total))
+    end = min(total, offset + max(0, limit))
+    page_chunks = range(offset // chunk_size, (end - 1) // chunk_size + 1 if end > offset else 0)
+
+    pipe = client.pipeline()
+    pipe.bitcount(BULK_DONE_KEY.format(job_id))
+    pipe.bitcount(BULK_FAILED_KEY.format(job_id))
+    pipe.getbit(BULK_DONE_KEY.format(job_id), last_chunk)
+    for chunk_index in page_chunks:
+        pipe.getbit(BULK_DONE_KEY.format(job_id), chunk_index)
+    done_chunks, failed_chunks, last_done, *page_done = pipe.execute()
+
+    completed_items = done_chunks * chunk_size
+    if last_done:
+        # The last chunk may be shorter than chunk_size.
+        completed_items -= (last_chunk + 1) * chunk_size - total
+
+    page = []
+    for chunk_index, done in zip(page_chunks, page_done):
+        chunk_start = chunk_index * chunk_size
+        chunk_len = min(chunk_size, total - chunk_start)
+        chunk = celery.AsyncResult(chunk_task_id(job_id, chunk_index)) if done else None
+        if chunk is None or not chunk.ready():
+            outputs = [{"status": "pending"}] * chunk_len
+        elif chunk.successful():
+            outputs = [dict(output, status="failed" if "error" in output else "completed") for output in chunk.result]
+        else:
+            outputs = [{"status": "failed", "error": str(chunk.info)}] * chunk_len
+        for i, output in enumerate(outputs):
+            if offset <= chunk_start + i < end:
+                page.append(dict(output, index=chunk_start + i))
+
+    status = "completed" if completed_items == total else "pending"
+    if status == "completed" and failed_chunks:
+        status = "completed_with_errors"
+    return {
+        "job_id": job_id,
+        "model_name": meta["model_name"],
+        "status": status,
+        "progress": {"completed": completed_items, "total": total},
+        "offset": offset,
+        "limit": limit,
+        "results": page
+    }
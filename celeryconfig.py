@@ -0,0 +1,10 @@
+# celeryconfig.py
+# Connection settings for Celery, kept apart from tasks.py so modules that
+# only need the Redis URLs do not have to import Celery.
+
+import os
+
+# The broker URL points to Redis, which acts as the message queue.
+# The backend URL also points to Redis, where results will be stored.
+broker_url = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0')
+result_backend = os.environ.get('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0')
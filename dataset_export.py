@@ -0,0 +1,242 @@
+# dataset_export.py
+# This file converts generator output (JSONL) into a pre-tokenized binary
+# dataset that data loaders can memory-map, and provides the reader for it.
+#
+# Layout of an exported dataset directory:
+#   tokens.bin      all token ids back to back (uint8/uint16/uint32, see meta.json)
+#   offsets.npy     int64[N + 1]; example n spans tokens[offsets[n]:offsets[n + 1]]
+#   prompt_len.npy  int32[N]; the first prompt_len[n] tokens of example n are the prompt
+#   scenarios.npy   uint8[N]; index into meta.json "scenarios"
+#   meta.json       dtype, counts, scenario names and tokenizer description
+#   vocab.json      only for the built-in word-level tokenizer
+#
+# Usage:
+#     python dataset_export.py storage_management_training_data.jsonl --output dataset/
+#     python dataset_export.py data/train-*.jsonl --output dataset/ --tokenizer gemma/tokenizer.json
+
+import argparse
+import json
+import os
+import random
+import re
+from array import array
+
+import numpy as np
+
+import training_data_generator as generator
+
+# Splits text into words, runs of punctuation and runs of whitespace. Joining
+# the pieces gives back the original text exactly.
+_WORD_PATTERN = re.compile(r"\w+|[^\w\s]+|\s+")
+
+
+class WordTokenizer:
+    """A lossless word-level tokenizer whose vocabulary is built from the corpus."""
+
+    def __init__(self, vocab=None):
+        self.vocab = list(vocab or [])
+        self._ids = {piece: i for i, piece in enumerate(self.vocab)}
+
+    def add_text(self, text):
+        for piece in _WORD_PATTERN.findall(text):
+            if piece not in self._ids:
+                self._ids[piece] = len(self.vocab)
+                self.vocab.append(piece)
+
+    def encode(self, text):
+        return [self._ids[piece] for piece in _WORD_PATTERN.findall(text)]
+
+    def decode(self, ids):
+        return "".join(self.vocab[i] for i in ids)
+
+    @property
+    def vocab_size(self):
+        return len(self.vocab)
+
+    def describe(self):
+        return {"type": "word", "vocab_file": "vocab.json"}
+
+
+class HFTokenizer:
+    """Wraps a Hugging Face tokenizer.json (e.g. the model's own), via the optional 'tokenizers' package."""
+
+    def __init__(self, path):
+        from tokenizers import Tokenizer  # Optional dependency, only needed for this tokenizer.
+        self.path = path
+        self._tokenizer = Tokenizer.from_file(path)
+
+    def add_text(self, text):
+        pass  # The vocabulary is fixed.
+
+    def encode(self, text):
+        return self._tokenizer.encode(text, add_special_tokens=False).ids
+
+    def decode(self, ids):
+        return self._tokenizer.decode(list(ids))
+
+    @property
+    def vocab_size(self):
+        return self._tokenizer.get_vocab_size()
+
+    def describe(self):
+        return {"type": "huggingface", "path": os.path.abspath(self.path)}
+
+
+def _smallest_dtype(vocab_size):
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if vocab_size <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    raise ValueError(f"Vocabulary of {vocab_size} tokens is too large")
+
+
+def _completion_scenarios():
+    """Maps each plan (completion text) to its scenario, for input rows without a label."""
+    return {generator.generate_labeled_example(random.Random(0), name)[1]["completion"]: name
+            for name in generator.SCENARIOS}
+
+
+def _read_rows(paths):
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def export_dataset(input_paths, output_dir, tokenizer=None):
+    """
+    Tokenizes every (prompt, completion) row in the input JSONL files and
+    writes the binary dataset to output_dir. Rows are streamed, so memory
+    use does not depend on the size of the input. Returns the meta dict.
+    """
+    tokenizer = tokenizer or WordTokenizer()
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Pass 1: build the vocabulary (a no-op for fixed tokenizers).
+    if isinstance(tokenizer, WordTokenizer):
+        for row in _read_rows(input_paths):
+            tokenizer.add_text(row["prompt"])
+            tokenizer.add_text(row["completion"])
+    dtype = _smallest_dtype(tokenizer.vocab_size)
+
+    # Pass 2: write token ids and record where each example starts.
+    known_plans = _completion_scenarios()
+    scenario_ids = {name: i for i, name in enumerate(generator.SCENARIOS)}
+    offsets = array("q", [0])
+    prompt_lens = array("i")
+    scenarios = array("B")
+    with open(os.path.join(output_dir, "tokens.bin"), "wb") as f:
+        for row in _read_rows(input_paths):
+            prompt_ids = tokenizer.encode(row["prompt"])
+            completion_ids = tokenizer.encode(row["completion"])
+            np.asarray(prompt_ids + completion_ids, dtype=dtype).tofile(f)
+            offsets.append(offsets[-1] + len(prompt_ids) + len(completion_ids))
+            prompt_lens.append(len(prompt_ids))
+            scenario = row.get("scenario") or known_plans.get(row["completion"], "nominal")
+            scenarios.append(scenario_ids[scenario])
+
+    np.save(os.path.join(output_dir, "offsets.npy"), np.frombuffer(offsets, dtype=np.int64))
+    np.save(os.path.join(output_dir, "prompt_len.npy"), np.frombuffer(prompt_lens, dtype=np.int32))
+    np.save(os.path.join(output_dir, "scenarios.npy"), np.frombuffer(scenarios, dtype=np.uint8))
+    if isinstance(tokenizer, WordTokenizer):
+        with open(os.path.join(output_dir, "vocab.json"), "w") as f:
+            json.dump(tokenizer.vocab, f)
+
+    meta = {
+        "format_version": 1,
+        "examples": len(prompt_lens),
+        "tokens": offsets[-1],
+        "dtype": dtype.name,
+        "vocab_size": tokenizer.vocab_size,
+        "scenarios": generator.SCENARIOS,
+        "tokenizer": tokenizer.describe()
+    }
+    with open(os.path.join(output_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+class TokenizedDataset:
+    """
+    Random-access reader for an exported dataset.
+
+    Token ids are memory-mapped, so opening a dataset reads only the small
+    index files, and dataset[n] returns views into the mapped file without
+    copying. Safe to share across forked data-loader workers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.tokens = np.memmap(os.path.join(path, "tokens.bin"), dtype=self.meta["dtype"], mode="r",
+                                shape=(self.meta["tokens"],)) if self.meta["tokens"] else np.zeros(0, self.meta["dtype"])
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.prompt_len = np.load(os.path.join(path, "prompt_len.npy"), mmap_mode="r")
+        self.scenario_ids = np.load(os.path.join(path, "scenarios.npy"), mmap_mode="r")
+        self.scenarios = self.meta["scenarios"]
+        self._tokenizer = None
+
+    def __len__(self):
+        return self.meta["examples"]
+
+    def token_ids(self, n):
+        """All token ids of example n (prompt followed by completion), as a zero-copy view."""
+        if not -len(self) <= n < len(self):
+            raise IndexError(n)
+        n %= len(self)
+        return self.tokens[self.offsets[n]:self.offsets[n + 1]]
+
+    def __getitem__(self, n):
+        ids = self.token_ids(n)
+        n %= len(self)
+        prompt_len = int(self.prompt_len[n])
+        return {
+            "input_ids": ids,
+            "prompt_ids": ids[:prompt_len],
+            "completion_ids": ids[prompt_len:],
+            "scenario": self.scenarios[self.scenario_ids[n]]
+        }
+
+    def indices_for(self, scenario):
+        """Indices of all examples with the given scenario label."""
+        return np.flatnonzero(self.scenario_ids == self.scenarios.index(scenario))
+
+    def decode(self, n):
+        """Returns example n as the original {'prompt', 'completion', 'scenario'} dict."""
+        example = self[n]
+        tokenizer = self._get_tokenizer()
+        return {
+            "prompt": tokenizer.decode(example["prompt_ids"].tolist()),
+            "completion": tokenizer.decode(example["completion_ids"].tolist()),
+            "scenario": example["scenario"]
+        }
+
+    def _get_tokenizer(self):
+        if self._tokenizer is None:
+            info = self.meta["tokenizer"]
+            if info["type"] == "word":
+                with open(os.path.join(self.path, info["vocab_file"])) as f:
+                    self._tokenizer = WordTokenizer(json.load(f))
+            else:
+                self._tokenizer = HFTokenizer(info["path"])
+        return self._tokenizer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export generator JSONL to a pre-tokenized, memory-mappable dataset.")
+    parser.add_argument("inputs", nargs="+", help="JSONL files produced by training_data_generator.py")
+    parser.add_argument("--output", required=True, help="Directory to write the dataset to.")
+    parser.add_argument("--tokenizer", help="Path to a Hugging Face tokenizer.json (default: corpus word-level vocabulary).")
+    args = parser.parse_args()
+
+    tokenizer = HFTokenizer(args.tokenizer) if args.tokenizer else None
+    meta = export_dataset(args.inputs, args.output, tokenizer)
+    input_bytes = sum(os.path.getsize(p) for p in args.inputs)
+    output_bytes = sum(os.path.getsize(os.path.join(args.output, name)) for name in os.listdir(args.output))
+    print(f"Exported {meta['examples']} examples ({meta['tokens']} {meta['dtype']} tokens) to '{args.output}'.")
+    print(f"Size: {input_bytes} bytes of JSONL -> {output_bytes} bytes ({input_bytes / max(1, output_bytes):.1f}x smaller).")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,64 @@
-
 # diode_controller.py
 # This script simulates a controller for a fault-injection diode.
 
-import time
 import os
 
+from actuator_ipc import CommandWatcher, read_command, write_ack
+
 # --- State File ---
 # The main application will write the desired state to this file.
 STATE_FILE = "/tmp/diode_state.state"
 
-def get_diode_state():
-    """Reads the desired diode state ('on' or 'off') from the state file."""
+def get_diode_command():
+    """Reads the desired diode state and the time it was issued from the state file."""
     if not os.path.exists(STATE_FILE):
-        return "off"
+        return "off", None
     try:
-        with open(STATE_FILE, 'r') as f:
-            state = f.read().strip().lower()
-            return state if state in ["on", "off"] else "off"
+        state, issued_ns = read_command(STATE_FILE)
+        state = state.lower()
+        return (state if state in ["on", "off"] else "off"), issued_ns
     except (ValueError, IOError):
-        return "off"
+        return "off", None
 
-if __name__ == "__main__":
-    print("--- Starting Fault Diode Controller Simulator ---")
-    current_state = ""
-    while True:
-        desired_state = get_diode_state()
-        if current_state != desired_state:
-            current_state = desired_state
-            if current_state == "on":
+def get_diode_state():
+    """Reads the desired diode state ('on' or 'off') from the state file."""
+    return get_diode_command()[0]
+
+class DiodeController:
+    """Applies the desired diode state whenever a new command is written."""
+
+    def __init__(self):
+        self.current_state = ""
+        self.last_issued_ns = None
+
+    def apply(self):
+        desired_state, issued_ns = get_diode_command()
+        if self.current_state == desired_state and issued_ns == self.last_issued_ns:
+            return
+        self.last_issued_ns = issued_ns
+        if self.current_state != desired_state:
+            self.current_state = desired_state
+            if self.current_state == "on":
                 print("DIODE CONTROLLER: Diode is ON. (Simulating fault condition)")
             else:
                 print("DIODE CONTROLLER: Diode is OFF. (Normal operation)")
-        time.sleep(1)
+        latency_ms = write_ack(STATE_FILE, self.current_state, issued_ns)
+        if latency_ms is not None:
+            print(f"DIODE CONTROLLER: Command-to-actuation latency {latency_ms:.3f} ms.")
+
+async def run_async(session=None):
+    """Runs the controller as an asyncio task (see simulator_supervisor.py)."""
+    controller = DiodeController()
+    with CommandWatcher(STATE_FILE) as watcher:
+        while True:
+            controller.apply()
+            await watcher.wait_async()
+
+if __name__ == "__main__":
+    print("--- Starting Fault Diode Controller Simulator ---")
+    controller = DiodeController()
+    # Sleep until the main application signals a new command, instead of polling.
+    with CommandWatcher(STATE_FILE) as watcher:
+        while True:
+            controller.apply()
+            watcher.wait()
@@ -0,0 +1,224 @@
+# directory_index.py
+# This file serves paginated directory listings for the file browser API.
+#
+# Storage directories can hold hundreds of thousands of entries, so listings
+# are built from os.scandir() (which reports whether an entry is a directory
+# without a stat() call) and cached per directory. A cached listing is
+# reused until the directory's mtime changes, or until the file API itself
+# changes the directory. Only the entries on the returned page are stat()ed,
+# except when sorting by size or modification time, which needs every
+# entry's stat once per cached listing.
+#
+# Pages are addressed by an opaque cursor holding the sort key of the last
+# entry returned, so pages stay consistent while entries are added or removed.
+
+import base64
+import bisect
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from metrics import registry
+
+# --- Index Configuration ---
+# Number of directories whose listings are kept in memory.
+DIRECTORY_CACHE_MAX_DIRS = int(os.environ.get('DIRECTORY_CACHE_MAX_DIRS', 64))
+DEFAULT_PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+
+# Sort orders; "none" streams entries in directory order without caching,
+# which returns the first page of a huge directory without reading all of it.
+SORT_KEYS = ("name", "size", "modified", "none")
+ENTRY_TYPES = ("file", "dir")
+
+DIRECTORY_LISTINGS = registry.counter(
+    "directory_index_listings_total", "Directory listings served, by whether the cached listing was used.", ["cache"])
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError):
+        raise InvalidCursor("Invalid cursor") from None
+
+
+class _Listing:
+    """The cached entries of one directory: (name, is_dir) pairs, plus stat results once needed."""
+
+    def __init__(self, version, entries):
+        self.version = version
+        self.entries = entries
+        self.stats = None
+        # (sorted keys, matching indexes into entries) per sort order, built on first use.
+        self.sorted = {}
+
+
+def _version(st):
+    # Creating, removing or renaming an entry updates the directory's mtime and ctime.
+    return (st.st_mtime_ns, st.st_ctime_ns, st.st_ino)
+
+
+def _stat_fields(path):
+    """Returns (size, mtime) of path, or None if it has disappeared."""
+    try:
+        st = os.stat(path, follow_symlinks=False)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+
+class DirectoryIndex:
+    """
+    Lists directories below root a page at a time.
+
+    list_page() returns entries as dicts with name, path (relative to root,
+    starting with '/'), is_dir, size and modified, plus the cursor of the
+    next page (None on the last page).
+    """
+
+    def __init__(self, root, max_dirs=DIRECTORY_CACHE_MAX_DIRS, excluded=()):
+        self.root = root
+        self.max_dirs = max_dirs
+        # Paths never listed (e.g. internal staging directories), as names per parent directory.
+        self._hidden = {}
+        for path in excluded:
+            path = os.path.abspath(path)
+            self._hidden.setdefault(os.path.dirname(path), set()).add(os.path.basename(path))
+        self._listings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def invalidate(self, directory):
+        """Drops the cached listings of directory and of everything below it."""
+        directory = os.path.abspath(directory)
+        with self._lock:
+            for path in [p for p in self._listings if p == directory or p.startswith(directory + os.sep)]:
+                del self._listings[path]
+
+    def _listing(self, directory):
+        version = _version(os.stat(directory))
+        with self._lock:
+            listing = self._listings.get(directory)
+            if listing is not None and listing.version == version:
+                self._listings.move_to_end(directory)
+                DIRECTORY_LISTINGS.inc(cache="hit")
+                return listing
+        DIRECTORY_LISTINGS.inc(cache="miss")
+        hidden = self._hidden.get(directory, ())
+        with os.scandir(directory) as it:
+            entries = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in it if entry.name not in hidden]
+        listing = _Listing(version, entries)
+        with self._lock:
+            self._listings[directory] = listing
+            self._listings.move_to_end(directory)
+            while len(self._listings) > self.max_dirs:
+                self._listings.popitem(last=False)
+        return listing
+
+    def _sorted(self, directory, listing, sort):
+        """Returns (keys, indexes) of the listing's entries in ascending sort order; directories come first."""
+        cached = listing.sorted.get(sort)
+        if cached is not None:
+            return cached
+        if sort != "name" and listing.stats is None:
+            listing.stats = [_stat_fields(os.path.join(directory, name)) or (0, 0.0) for name, _ in listing.entries]
+
+        if sort == "name":
+            keys = [(0 if is_dir else 1, name.lower(), name) for name, is_dir in listing.entries]
+        else:
+            field = 0 if sort == "size" else 1
+            keys = [(0 if is_dir else 1, stats[field], name.lower(), name)
+                    for (name, is_dir), stats in zip(listing.entries, listing.stats)]
+        indexes = sorted(range(len(keys)), key=keys.__getitem__)
+        cached = listing.sorted[sort] = ([keys[i] for i in indexes], indexes)
+        return cached
+
+    def _item(self, directory, name, is_dir):
+        path = os.path.join(directory, name)
+        fields = _stat_fields(path)
+        if fields is None:
+            return None
+        return {
+            "name": name,
+            "path": "/" + os.path.relpath(path, self.root),
+            "is_dir": is_dir,
+            "size": fields[0],
+            "modified": fields[1]
+        }
+
+    def list_page(self, directory, cursor=None, limit=DEFAULT_PAGE_SIZE, sort="name", descending=False,
+                  entry_type=None, contains=None):
+        """
+        Returns (items, next_cursor) for one page of directory. entry_type
+        ("file" or "dir") and contains (a case-insensitive substring of the
+        name) filter entries before they are paginated.
+        """
+        directory = os.path.abspath(directory)
+        contains = contains.lower() if contains else None
+
+        def wanted(name, is_dir):
+            if entry_type is not None and is_dir != (entry_type == "dir"):
+                return False
+            return contains is None or contains in name.lower()
+
+        if sort == "none":
+            return self._stream_page(directory, cursor, limit, wanted)
+
+        listing = self._listing(directory)
+        keys, indexes = self._sorted(directory, listing, sort)
+        if cursor is None:
+            position = len(keys) - 1 if descending else 0
+        else:
+            after = decode_cursor(cursor)
+            try:
+                after = tuple(after)
+                position = bisect.bisect_left(keys, after) - 1 if descending else bisect.bisect_right(keys, after)
+            except TypeError:
+                raise InvalidCursor("Cursor does not match the sort order") from None
+
+        items = []
+        step = -1 if descending else 1
+        while 0 <= position < len(keys) and len(items) < limit:
+            name, is_dir = listing.entries[indexes[position]]
+            if wanted(name, is_dir):
+                item = self._item(directory, name, is_dir)
+                if item is not None:
+                    items.append(item)
+                    last_key = keys[position]
+            position += step
+        more = 0 <= position < len(keys)
+        return items, encode_cursor(last_key) if items and more else None
+
+    def _stream_page(self, directory, cursor, limit, wanted):
+        # The cursor is the number of matching entries already returned; it
+        # assumes the directory has not changed between pages.
+        skip = decode_cursor(cursor) if cursor is not None else 0
+        if not isinstance(skip, int):
+            raise InvalidCursor("Cursor does not match the sort order")
+        hidden = self._hidden.get(directory, ())
+        seen = 0
+        items = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name in hidden:
+                    continue
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if not wanted(entry.name, is_dir):
+                    continue
+                seen += 1
+                if seen <= skip:
+                    continue
+                if len(items) == limit:
+                    return items, encode_cursor(seen - 1)
+                item = self._item(directory, entry.name, is_dir)
+                if item is not None:
+                    items.append(item)
+        return items, None
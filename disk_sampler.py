@@ -0,0 +1,97 @@
+# disk_sampler.py
+# This file keeps a cached snapshot of disk partitions and their usage.
+# A background thread refreshes it on a fixed interval, so API requests
+# never block on statvfs() calls and dashboard refreshes do not touch disks.
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+# --- Sampler Configuration ---
+SAMPLE_INTERVAL_S = float(os.environ.get('DISK_SAMPLER_INTERVAL_S', 30))
+
+# Virtual and container filesystems that are not real storage.
+PSEUDO_FILESYSTEMS = {
+    "autofs", "binfmt_misc", "bpf", "cgroup", "cgroup2", "configfs", "debugfs",
+    "devpts", "devtmpfs", "efivarfs", "fusectl", "fuse.lxcfs", "fuse.portal",
+    "hugetlbfs", "mqueue", "nsfs", "overlay", "proc", "pstore", "ramfs",
+    "rpc_pipefs", "securityfs", "squashfs", "sysfs", "tmpfs", "tracefs"
+}
+
+
+def collect_disks():
+    """Reads partitions and usage for real filesystems, one entry per device."""
+    import psutil  # Imported on first sample, off the app's startup path.
+
+    disks = []
+    seen_devices = set()
+    for p in psutil.disk_partitions(all=False):
+        # Skip pseudo filesystems and repeated bind mounts of the same device.
+        if p.fstype in PSEUDO_FILESYSTEMS or p.device in seen_devices:
+            continue
+        try:
+            usage = psutil.disk_usage(p.mountpoint)
+        except (PermissionError, FileNotFoundError, OSError):
+            continue
+        seen_devices.add(p.device)
+        disks.append({
+            "device": p.device, "mountpoint": p.mountpoint, "fstype": p.fstype,
+            "total": f"{usage.total / (1024**3):.2f} GB",
+            "used": f"{usage.used / (1024**3):.2f} GB",
+            "free": f"{usage.free / (1024**3):.2f} GB",
+            "percent": usage.percent
+        })
+    return disks
+
+
+class DiskStatsSampler:
+    """
+    Refreshes the disk snapshot every interval_s seconds in a daemon thread.
+    The thread is started on the first call to get().
+    """
+
+    def __init__(self, interval_s=SAMPLE_INTERVAL_S):
+        self.interval_s = interval_s
+        self._snapshot = None
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+
+    def refresh(self):
+        """Collects a new snapshot now and returns it."""
+        with self._refresh_lock:
+            disks = collect_disks()
+            etag = hashlib.sha1(json.dumps(disks, sort_keys=True).encode()).hexdigest()
+            self._snapshot = {"disks": disks, "etag": etag, "sampled_at": time.time()}
+            return self._snapshot
+
+    def get(self, max_age=None):
+        """
+        Returns the cached snapshot, a dict with 'disks', 'etag' and 'sampled_at'.
+        If max_age (seconds) is given and the snapshot is older, it is refreshed first.
+        """
+        self._ensure_started()
+        snapshot = self._snapshot
+        if snapshot is None or (max_age is not None and time.time() - snapshot["sampled_at"] > max_age):
+            snapshot = self.refresh()
+        return snapshot
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._refresh_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="disk-sampler", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"DISK SAMPLER: Failed to refresh disk stats: {e}")
+            time.sleep(self.interval_s)
+
+
+# A single sampler shared by all requests handled in this process.
+disk_sampler = DiskStatsSampler()
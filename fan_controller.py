@@ -1,10 +1,10 @@
-
 # fan_controller.py
 # This script simulates a PWM fan controller.
 
-import time
 import os
 
+from actuator_ipc import CommandWatcher, read_command, write_ack
+
 # --- State File ---
 # The main application will write the desired fan speed to this file.
 # This simulates an I/O or hardware register interaction.
@@ -13,27 +13,56 @@ STATE_FILE = "/tmp/fan_speed.state"
 # --- Fan Simulation Parameters ---
 DEFAULT_SPEED = 0 # Fan is off by default
 
-def get_desired_speed():
-    """Reads the desired fan speed from the state file."""
+def get_desired_command():
+    """Reads the desired fan speed and the time it was issued from the state file."""
     if not os.path.exists(STATE_FILE):
-        return DEFAULT_SPEED
+        return DEFAULT_SPEED, None
     try:
-        with open(STATE_FILE, 'r') as f:
-            speed = int(f.read().strip())
-            # Ensure speed is within a valid PWM range (0-100%)
-            return max(0, min(100, speed))
+        speed, issued_ns = read_command(STATE_FILE)
+        # Ensure speed is within a valid PWM range (0-100%)
+        return max(0, min(100, int(speed))), issued_ns
     except (ValueError, IOError):
-        return DEFAULT_SPEED
+        return DEFAULT_SPEED, None
 
-if __name__ == "__main__":
-    print("--- Starting PWM Fan Controller Simulator ---")
-    current_speed = -1 # Initialize to a value that forces the first print
-    while True:
-        desired_speed = get_desired_speed()
-        if current_speed != desired_speed:
-            current_speed = desired_speed
-            if current_speed == 0:
+def get_desired_speed():
+    """Reads the desired fan speed from the state file."""
+    return get_desired_command()[0]
+
+class FanController:
+    """Applies the desired fan speed whenever a new command is written."""
+
+    def __init__(self):
+        self.current_speed = -1 # Initialize to a value that forces the first print
+        self.last_issued_ns = None
+
+    def apply(self):
+        desired_speed, issued_ns = get_desired_command()
+        if self.current_speed == desired_speed and issued_ns == self.last_issued_ns:
+            return
+        self.last_issued_ns = issued_ns
+        if self.current_speed != desired_speed:
+            self.current_speed = desired_speed
+            if self.current_speed == 0:
                 print("FAN CONTROLLER: Fan is OFF.")
             else:
-                print(f"FAN CONTROLLER: Fan speed set to {current_speed}%.")
-        time.sleep(1)
+                print(f"FAN CONTROLLER: Fan speed set to {self.current_speed}%.")
+        latency_ms = write_ack(STATE_FILE, self.current_speed, issued_ns)
+        if latency_ms is not None:
+            print(f"FAN CONTROLLER: Command-to-actuation latency {latency_ms:.3f} ms.")
+
+async def run_async(session=None):
+    """Runs the controller as an asyncio task (see simulator_supervisor.py)."""
+    controller = FanController()
+    with CommandWatcher(STATE_FILE) as watcher:
+        while True:
+            controller.apply()
+            await watcher.wait_async()
+
+if __name__ == "__main__":
+    print("--- Starting PWM Fan Controller Simulator ---")
+    controller = FanController()
+    # Sleep until the main application signals a new command, instead of polling.
+    with CommandWatcher(STATE_FILE) as watcher:
+        while True:
+            controller.apply()
+            watcher.wait()
@@ -0,0 +1,27 @@
+# gunicorn.conf.py
+# Gunicorn loads this file automatically from the working directory.
+
+import npu_manager
+import shared_state
+
+def on_starting(server):
+    """Runs once in the master before any worker starts."""
+    # Start every deployment from the default system state; the first worker
+    # to import main recreates the shared segment.
+    shared_state.remove_segment()
+    npu_manager.ensure_storage()
+
+def post_worker_init(worker):
+    """Runs in each worker after it loaded the app, before it accepts requests."""
+    import main
+    # The first worker to get here maintains the file search index.
+    main.search_index.start()
+    if main.executor.name == "celery":
+        # Publish this worker's metrics, so whichever worker serves /metrics reports all of them.
+        main.metrics_publisher.start()
+    if main.executor.name == "local":
+        if worker.cfg.workers > 1:
+            # Local tasks live in the worker that ran them; polls reaching another worker get 404.
+            print("WARNING: NPU_EXECUTOR=local needs a single worker (--workers 1 --threads N).")
+        # Inference runs in the worker itself, so warm the models up first.
+        npu_manager.preload_models()
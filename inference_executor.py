@@ -0,0 +1,183 @@
+# inference_executor.py
+# This file selects where /api/npu/inference requests are executed.
+#
+#   celery  Requests are queued through Redis to a Celery worker and the client
+#           polls for the result (the default; needs Redis and a worker).
+#   local   Requests run on a thread pool inside the app process. If one
+#           finishes within a short deadline, the API returns its result inline
+#           instead of a task id, avoiding the broker round trip altogether.
+#           Tasks are only known to the process that ran them, so the app must
+#           run as a single process (gunicorn --workers 1, with threads).
+#
+# Both executors give each request a task id, so result polling, long-polling
+# and SSE result delivery work the same either way. Celery (and Redis) are
+# only imported when the celery executor is used.
+
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import celeryconfig
+# Import the NPU manager, which will point to the correct implementation (real or mock)
+import npu_manager as npu
+# Requests running concurrently in this process are grouped into NPU batches here.
+from npu_batcher import batcher
+from npu_scheduler import DEFAULT_PRIORITY
+from prompts import AGENT_PROMPT_PREFIX
+from result_cache import is_cacheable, result_cache
+
+# --- Executor Configuration ---
+NPU_EXECUTOR = os.environ.get('NPU_EXECUTOR', 'celery')
+# Number of inferences the local executor runs at once.
+LOCAL_MAX_WORKERS = int(os.environ.get('NPU_LOCAL_MAX_WORKERS', 16))
+# How long a request waits for a local inference before answering with a task id.
+LOCAL_INLINE_DEADLINE_MS = float(os.environ.get('NPU_INLINE_DEADLINE_MS', 50))
+# How long finished local results are kept for polling clients (seconds).
+LOCAL_RESULT_TTL_S = 600
+
+# The agent preamble is shared by every agent prompt; cache its KV state.
+npu.register_prompt_prefix("gemma-2b-int4", AGENT_PROMPT_PREFIX)
+
+
+def run_inference_job(model_name, input_data, priority=DEFAULT_PRIORITY):
+    """
+    Loads the model if needed and runs one inference; returns the result dict.
+    This is the body of the Celery task run_npu_inference_task, and what the
+    local executor runs on its thread pool.
+
+    Inference goes through the process's micro-batcher, so requests for the
+    same model and priority that run concurrently share a single NPU pass.
+    Critical requests skip the batching window and are granted an NPU core
+    ahead of any queued normal or bulk work; normal batches likewise go
+    ahead of bulk ones.
+    """
+    # Preloaded models are already resident, so this is only a lookup; models
+    # that were not preloaded (or were evicted since) are loaded here.
+    loaded, msg = npu.load_model(model_name)
+    if not loaded:
+        # If the model fails to load, we can't proceed.
+        return {"error": f"Model ({model_name}) could not be loaded in worker: {msg}"}
+
+    print(f"WORKER: Starting {priority} inference for model '{model_name}'.")
+
+    if priority == "critical":
+        results, message = npu.run_inference(model_name, input_data, priority=priority)
+    else:
+        # Hand the request to the batcher and wait for this request's own result.
+        # The batch itself runs through either the real or mock implementation.
+        results, message = batcher.run(model_name, input_data, priority)
+
+    if results is None:
+        return {"error": message}
+
+    return {"results": results, "message": message}
+
+
+class CeleryExecutor:
+    """Runs inferences on Celery workers; results are read from the Redis result backend."""
+
+    name = "celery"
+    inline_deadline_s = 0.0
+
+    def __init__(self, redis_url=celeryconfig.result_backend):
+        from celery.result import AsyncResult
+        from result_notifier import TaskResultNotifier
+        import tasks
+
+        self._async_result = lambda task_id: AsyncResult(task_id, app=tasks.celery)
+        self._submit = tasks.submit_inference
+        # Wakes up waiting result requests as soon as a task finishes.
+        self._notifier = TaskResultNotifier(redis_url)
+
+    def submit(self, model_name, input_data, priority=DEFAULT_PRIORITY, cache_key=None):
+        """
+        Queues an inference and returns its task id. With a cache_key, the
+        worker stores a successful result in the shared result cache.
+        """
+        return self._submit(model_name, input_data, priority, cache_key).id
+
+    def wait(self, task_id, timeout):
+        """Blocks until the task finishes or timeout seconds pass; returns True if it finished."""
+        return self._notifier.wait(task_id, timeout, is_ready=lambda: self._async_result(task_id).ready())
+
+    def state(self, task_id):
+        """
+        Returns (status, value): ("pending", None), ("completed", result) or
+        ("failed", error). The result backend cannot tell an unknown id from a
+        queued task, so "not_found" is never returned here.
+        """
+        task_result = self._async_result(task_id)
+        if not task_result.ready():
+            return "pending", None
+        if task_result.successful():
+            return "completed", task_result.result
+        return "failed", str(task_result.info)
+
+
+class LocalExecutor:
+    """Runs inferences on a thread pool in this process, sharing its batcher and NPU scheduler."""
+
+    name = "local"
+
+    def __init__(self, max_workers=LOCAL_MAX_WORKERS, inline_deadline_ms=LOCAL_INLINE_DEADLINE_MS,
+                 result_ttl_s=LOCAL_RESULT_TTL_S):
+        self.inline_deadline_s = inline_deadline_ms / 1000.0
+        self.result_ttl_s = result_ttl_s
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="npu-local")
+        # task_id -> (future, submitted_at)
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def submit(self, model_name, input_data, priority=DEFAULT_PRIORITY, cache_key=None):
+        task_id = str(uuid.uuid4())
+        future = self._pool.submit(run_inference_job, model_name, input_data, priority)
+        if cache_key is not None:
+            # Cache the result as soon as it is ready, whether or not anyone polls for it.
+            future.add_done_callback(lambda f: self._cache_result(cache_key, f))
+        with self._lock:
+            self._expire()
+            self._tasks[task_id] = (future, time.monotonic())
+        return task_id
+
+    def wait(self, task_id, timeout):
+        future = self._future(task_id)
+        if future is None:
+            return False
+        done, _ = wait([future], timeout=timeout)
+        return bool(done)
+
+    def state(self, task_id):
+        """Like CeleryExecutor.state(), plus ("not_found", None) for ids this process does not know (or has expired)."""
+        future = self._future(task_id)
+        if future is None:
+            return "not_found", None
+        if not future.done():
+            return "pending", None
+        if future.exception() is not None:
+            return "failed", str(future.exception())
+        return "completed", future.result()
+
+    @staticmethod
+    def _cache_result(cache_key, future):
+        if future.exception() is None and is_cacheable(future.result()):
+            result_cache.put(cache_key, future.result())
+
+    def _future(self, task_id):
+        with self._lock:
+            entry = self._tasks.get(task_id)
+        return entry[0] if entry else None
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.result_ttl_s
+        for task_id in [t for t, (future, submitted) in self._tasks.items() if future.done() and submitted < cutoff]:
+            del self._tasks[task_id]
+
+
+def create_executor(name=NPU_EXECUTOR):
+    if name == "local":
+        return LocalExecutor()
+    if name == "celery":
+        return CeleryExecutor()
+    raise ValueError(f"Unknown NPU_EXECUTOR '{name}' (expected 'celery' or 'local')")
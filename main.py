@@ -1,40 +1,137 @@
 
 import os
-import psutil
+import json
+import math
+import time
 import shutil
+import threading
 import random
 import subprocess
-from flask import Flask, send_file, jsonify, request, abort
+from flask import Flask, Response, g, send_file, jsonify, request, abort, stream_with_context
 from werkzeug.utils import secure_filename
-from celery.result import AsyncResult
+from werkzeug.wsgi import get_input_stream
 
-# Import the NPU manager and the Celery task
+# Import the NPU manager. Celery is only imported by the code paths that use it,
+# so the app starts without it when inference runs in-process.
 import npu_manager as npu
-from tasks import celery, run_npu_inference_task
+from npu_scheduler import DEFAULT_PRIORITY, PRIORITIES
+import celeryconfig
+from inference_executor import create_executor
+from result_cache import SharedResultStore, result_cache
+from telemetry import MAX_HISTORY_SPAN_S, telemetry
+from disk_sampler import disk_sampler
+from search_index import DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT, SEARCH_SORT_COLUMNS, StorageSearchIndex
+from resumable_upload import STAGING_DIR_NAME, OffsetMismatch, ResumableUploads, UploadBusy, UploadNotFound
+from directory_index import (DEFAULT_PAGE_SIZE, ENTRY_TYPES, MAX_PAGE_SIZE, SORT_KEYS, DirectoryIndex,
+                             InvalidCursor)
+from actuator_ipc import write_command, read_ack, ack_path, drain_latencies, latency_log_path, claim_latency_logs
+from shared_state import SharedSystemState
+import metrics
+from metrics import registry
 
 # --- Configuration ---
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = os.path.join(npu.STORAGE_PATH, 'uploads')
+# Largest request body Flask accepts (413 beyond it), which bounds multipart
+# uploads. Resumable upload chunks are streamed to disk and exempt from it.
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 64)) * 1024 * 1024
+# Resumable uploads are staged here: on the same filesystem as the storage
+# tree, so finished files are renamed into place, but hidden from the file APIs.
+UPLOAD_STAGING_DIR = os.path.join(npu.STORAGE_PATH, STAGING_DIR_NAME)
+
+# Long-poll and SSE limits for task result delivery (seconds).
+RESULT_MAX_WAIT_S = 30.0
+RESULT_STREAM_MAX_S = 300.0
+SSE_KEEPALIVE_S = 15.0
+
+# Runs /api/npu/inference requests on Celery workers or in-process (NPU_EXECUTOR).
+executor = create_executor()
+if executor.name == "celery":
+    # Celery workers store their results in Redis; look there on a local cache miss.
+    result_cache.use_shared_store(SharedResultStore(celeryconfig.result_backend))
 
 # --- Global State Management ---
-# Centralized dictionary to hold the state of various simulated components
-system_state = {
+# Centralized state of the various simulated components. It lives in a
+# shared-memory segment, so every gunicorn worker sees the same values.
+DEFAULT_SYSTEM_STATE = {
     "temperature_c": 55.0,
     "fan_speed_percent": 0,
     "diode_state": "off",
     "power_supply_state": "on"
 }
+system_state = SharedSystemState(DEFAULT_SYSTEM_STATE)
+
+# Above this temperature the fan is forced to 100%.
+CRITICAL_TEMP_C = 80.0
 
 # State file paths for controllers
 FAN_STATE_FILE = "/tmp/fan_speed.state"
 DIODE_STATE_FILE = "/tmp/diode_state.state"
 
 
+# --- Metrics ---
+HTTP_REQUESTS = registry.counter("http_requests_total", "HTTP requests handled.", ["method", "route", "status"])
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "http_request_duration_seconds", "Time to produce an HTTP response (until headers for streams).", ["method", "route"])
+QUEUE_DEPTH = registry.gauge("celery_queue_depth", "Tasks waiting in each Celery queue.", ["queue"])
+ACTUATION_SECONDS = registry.histogram(
+    "actuator_actuation_latency_seconds", "Time from issuing an actuator command to the controller applying it.",
+    ["actuator"])
+# Workers publish their metric snapshots here; created on the first scrape.
+_metrics_redis = None
+# Each gunicorn worker publishes its metrics too, so any worker can serve the
+# whole deployment's /metrics (started from gunicorn.conf.py).
+metrics_publisher = metrics.SnapshotPublisher(registry, celeryconfig.result_backend)
+
+@app.before_request
+def _start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def _record_request_metrics(response):
+    # Label by URL rule, not path, so task ids and file paths do not create new series.
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    HTTP_REQUESTS.inc(method=request.method, route=route, status=response.status_code)
+    if "request_start" in g:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, method=request.method, route=route)
+    return response
+
+def _collect_queue_depths():
+    if executor.name != "celery":
+        return
+    import redis
+    from tasks import queue_depths
+
+    try:
+        depths = queue_depths()
+    except redis.exceptions.RedisError:
+        return
+    for queue, depth in depths.items():
+        QUEUE_DEPTH.set(depth, queue=queue)
+
+def _collect_actuations():
+    # Controllers log every command's latency when they ack it; observe all logged since the last
+    # snapshot. Draining empties the log, so only one process does it and publishes the histogram.
+    if not claim_latency_logs():
+        return
+    for actuator, state_file in (("fan", FAN_STATE_FILE), ("diode", DIODE_STATE_FILE)):
+        for latency_ms in drain_latencies(state_file):
+            ACTUATION_SECONDS.observe(latency_ms / 1000.0, actuator=actuator)
+
+registry.add_collector(_collect_queue_depths)
+registry.add_collector(_collect_actuations)
+
 # --- Helper Functions ---
 def is_safe_path(path):
     """Security check to prevent directory traversal attacks."""
-    requested_path = os.path.abspath(os.path.join(npu.STORAGE_PATH, path.lstrip('/')))
-    return requested_path.startswith(npu.STORAGE_PATH)
+    requested_path = storage_path(path)
+    if requested_path == UPLOAD_STAGING_DIR or requested_path.startswith(UPLOAD_STAGING_DIR + os.sep):
+        return False
+    return requested_path == npu.STORAGE_PATH or requested_path.startswith(npu.STORAGE_PATH + os.sep)
+
+def storage_path(path):
+    """Maps an API path ('/' is the storage root) to an absolute path."""
+    return os.path.abspath(os.path.join(npu.STORAGE_PATH, path.lstrip('/')))
 
 # --- HTML Frontend ---
 @app.route("/")
@@ -42,23 +139,46 @@ def index():
     return send_file('src/index.html')
 
 # --- System & Simulator API ---
+@app.route("/metrics")
+def metrics_route():
+    """
+    Prometheus metrics for this process, merged with the latest snapshots
+    published by Celery workers and the other gunicorn workers.
+    """
+    global _metrics_redis
+
+    # Label this process like its published snapshot, so series do not depend on which worker is scraped.
+    own_name = metrics_publisher.name if metrics_publisher.running else None
+    snapshots = [(registry.snapshot(), {"worker": own_name} if own_name else {})]
+    # Without Celery there is no Redis, and nothing else publishes snapshots.
+    if executor.name == "celery":
+        import redis
+
+        if _metrics_redis is None:
+            _metrics_redis = redis.Redis.from_url(celeryconfig.result_backend)
+        try:
+            snapshots.extend(metrics.read_worker_snapshots(_metrics_redis, exclude=own_name))
+        except redis.exceptions.RedisError:
+            pass
+    return Response(metrics.render(snapshots), mimetype="text/plain; version=0.0.4")
+
 @app.route("/api/system/disks")
 def get_disks():
-    partitions = psutil.disk_partitions()
-    disks = []
-    for p in partitions:
-        try:
-            usage = psutil.disk_usage(p.mountpoint)
-            disks.append({
-                "device": p.device, "mountpoint": p.mountpoint, "fstype": p.fstype,
-                "total": f"{usage.total / (1024**3):.2f} GB",
-                "used": f"{usage.used / (1024**3):.2f} GB",
-                "free": f"{usage.free / (1024**3):.2f} GB",
-                "percent": usage.percent
-            })
-        except (PermissionError, FileNotFoundError):
-            continue
-    return jsonify(disks)
+    """
+    Serves the background sampler's disk snapshot. Supports If-None-Match
+    (304 when unchanged) and ?max_age=<seconds> to require a fresher sample.
+    """
+    max_age = request.args.get("max_age")
+    try:
+        max_age = float(max_age) if max_age is not None else None
+    except ValueError:
+        return jsonify({"error": "max_age must be a number of seconds"}), 400
+
+    snapshot = disk_sampler.get(max_age)
+    response = jsonify(snapshot["disks"])
+    response.set_etag(snapshot["etag"])
+    response.headers["X-Sampled-At"] = f"{snapshot['sampled_at']:.3f}"
+    return response.make_conditional(request)
 
 @app.route("/api/system/health")
 def get_system_health():
@@ -72,9 +192,18 @@ def get_system_health():
     return jsonify({
         "drives": [seagate_health], 
         "raid_arrays": [],
-        "system_state": system_state
+        "system_state": system_state.snapshot(),
+        "temperature_sensors": telemetry.sensor_latest(max_age_s=None)
     })
 
+def apply_temperature_rule(temp):
+    """Reactive logic: if temp is critical, force the fan to 100%. Returns True if the fan was forced."""
+    if temp > CRITICAL_TEMP_C and system_state['fan_speed_percent'] < 100:
+        print("MAIN APP: CRITICAL TEMP DETECTED! Forcing fan to 100%.")
+        set_fan_speed(100)
+        return True
+    return False
+
 @app.route('/api/system/temperature', methods=['POST'])
 def system_temperature():
     """Endpoint for the temperature simulator to post data to."""
@@ -83,15 +212,106 @@ def system_temperature():
         return jsonify({"error": "temperature_c not provided"}), 400
     
     system_state['temperature_c'] = temp
+    telemetry.record('temperature_c', temp)
     print(f"MAIN APP: Received temperature update: {temp}°C")
 
-    # Reactive logic: if temp is critical, force the fan to 100%
-    if temp > 80.0 and system_state['fan_speed_percent'] < 100:
-        print("MAIN APP: CRITICAL TEMP DETECTED! Forcing fan to 100%.")
-        set_fan_speed(100)
+    apply_temperature_rule(temp)
         
     return jsonify({"status": "temperature_received"}), 200
 
+@app.route('/api/system/temperature/batch', methods=['POST'])
+def system_temperature_batch():
+    """
+    Batch ingestion endpoint for many timestamped readings from many sensors:
+        {"sensors": [{"id": "cpu", "timestamps": [...], "temperature_c": [...]}, ...]}
+    Timestamps are epoch seconds. Each sensor's readings go to its own
+    "temperature_c.<id>" series, in time order even when they arrive late.
+    The system temperature becomes the hottest latest reading among sensors
+    that reported within the last TELEMETRY_SENSOR_STALE_S seconds (a sensor
+    that went quiet no longer counts), and the critical temperature rule is
+    applied once, to the hottest reading in the batch.
+    """
+    import numpy as np
+
+    sensors = request.json.get('sensors')
+    if not isinstance(sensors, list) or not sensors:
+        return jsonify({"error": "sensors must be a non-empty list"}), 400
+
+    readings = []
+    for sensor in sensors:
+        sensor_ts = sensor.get('timestamps') if isinstance(sensor, dict) else None
+        sensor_temps = sensor.get('temperature_c') if isinstance(sensor, dict) else None
+        if not isinstance(sensor_ts, list) or not isinstance(sensor_temps, list) or len(sensor_ts) != len(sensor_temps):
+            return jsonify({"error": "each sensor needs equal-length timestamps and temperature_c lists"}), 400
+        try:
+            sensor_ts = np.asarray(sensor_ts, dtype=np.float64)
+            sensor_temps = np.asarray(sensor_temps, dtype=np.float64)
+        except (TypeError, ValueError):
+            return jsonify({"error": "timestamps and temperature_c must be numbers"}), 400
+        if not (np.isfinite(sensor_ts).all() and np.isfinite(sensor_temps).all()):
+            return jsonify({"error": "timestamps and temperature_c must be finite numbers"}), 400
+        if len(sensor_temps):
+            readings.append((sensor.get('id'), sensor_ts, sensor_temps))
+    if not readings:
+        return jsonify({"error": "no readings provided"}), 400
+    try:
+        telemetry.add_sensors([sensor_id for sensor_id, _, _ in readings])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    for sensor_id, sensor_ts, sensor_temps in readings:
+        telemetry.extend(telemetry.sensor_metric(sensor_id), sensor_ts, sensor_temps)
+    latest = telemetry.sensor_latest()
+    if latest:
+        system_state['temperature_c'] = max(sample['temperature_c'] for sample in latest.values())
+
+    count = sum(len(sensor_temps) for _, _, sensor_temps in readings)
+    max_temp = max(float(sensor_temps.max()) for _, _, sensor_temps in readings)
+    fan_forced = apply_temperature_rule(max_temp)
+    print(f"MAIN APP: Received {count} temperature readings from {len(readings)} sensors (max {max_temp:.2f}°C)")
+
+    return jsonify({
+        "status": "batch_received",
+        "readings": count,
+        "max_temperature_c": max_temp,
+        "fan_forced": fan_forced,
+        "sensors": {sensor_id: latest.get(sensor_id) for sensor_id, _, _ in readings}
+    }), 200
+
+@app.route('/api/system/telemetry/history')
+def telemetry_history():
+    """
+    Returns downsampled telemetry history as min/max/mean windows.
+    Query parameters: metric (default: all), start and end (epoch seconds,
+    default: the last hour) and either step (seconds per window) or buckets.
+    """
+    try:
+        end = float(request.args.get('end', time.time()))
+        start = float(request.args.get('start', end - 3600))
+        buckets = int(request.args.get('buckets', 120))
+        step = float(request.args.get('step', 0)) or (end - start) / max(1, buckets)
+    except ValueError:
+        return jsonify({"error": "start, end, step and buckets must be numbers"}), 400
+    if not all(math.isfinite(value) for value in (start, end, step)):
+        return jsonify({"error": "start, end and step must be finite numbers"}), 400
+    if end <= start:
+        return jsonify({"error": "end must be after start"}), 400
+    if end - start > MAX_HISTORY_SPAN_S:
+        return jsonify({"error": f"start and end may be at most {MAX_HISTORY_SPAN_S:.0f} seconds apart"}), 400
+    if step <= 0 or buckets <= 0:
+        return jsonify({"error": "step and buckets must be positive"}), 400
+    # Never return more than 10000 windows, whatever step was asked for.
+    step = max(step, (end - start) / 10000)
+
+    metric = request.args.get('metric')
+    if metric is not None and metric not in telemetry.metrics:
+        return jsonify({"error": f"Unknown metric. Choose from: {', '.join(telemetry.metrics)}"}), 400
+    metrics = [metric] if metric else list(telemetry.metrics)
+    return jsonify({
+        "start": start, "end": end, "step": step,
+        "metrics": {name: telemetry.history(name, start, end, step) for name in metrics}
+    })
+
 @app.route('/api/system/fan', methods=['GET', 'POST'])
 def system_fan():
     """Controls the PWM fan simulator."""
@@ -103,13 +323,17 @@ def system_fan():
         set_fan_speed(speed)
         return jsonify({"message": f"Fan speed set to {speed}%"}), 200
     
-    return jsonify({"fan_speed_percent": system_state['fan_speed_percent']})
+    return jsonify({
+        "fan_speed_percent": system_state['fan_speed_percent'],
+        "last_actuation": read_ack(FAN_STATE_FILE)
+    })
 
 def set_fan_speed(speed):
     """Helper to update fan speed state and write to the state file."""
     system_state['fan_speed_percent'] = speed
-    with open(FAN_STATE_FILE, 'w') as f:
-        f.write(str(speed))
+    telemetry.record('fan_speed_percent', speed)
+    # Writes the state file and wakes the fan controller immediately.
+    write_command(FAN_STATE_FILE, speed)
 
 @app.route('/api/system/diode', methods=['GET', 'POST'])
 def system_diode():
@@ -120,11 +344,14 @@ def system_diode():
             return jsonify({"error": "Invalid state. Must be 'on' or 'off'."}), 400
         
         system_state['diode_state'] = state
-        with open(DIODE_STATE_FILE, 'w') as f:
-            f.write(state)
+        telemetry.record('diode_on', state == 'on')
+        write_command(DIODE_STATE_FILE, state)
         return jsonify({"message": f"Fault diode set to {state}"}), 200
         
-    return jsonify({"diode_state": system_state['diode_state']})
+    return jsonify({
+        "diode_state": system_state['diode_state'],
+        "last_actuation": read_ack(DIODE_STATE_FILE)
+    })
 
 
 @app.route('/api/power/array', methods=['GET', 'POST'])
@@ -134,6 +361,7 @@ def power_array():
         state = request.json.get('state')
         if state in ['on', 'off']:
             system_state['power_supply_state'] = state
+            telemetry.record('power_supply_on', state == 'on')
             print(f"MOCK: Optocoupler triggered to turn power supply {state}")
             return jsonify({"message": f"Power supply turning {state}"}), 200
         return jsonify({"error": "Invalid state"}), 400
@@ -144,65 +372,533 @@ def power_array():
 def npu_status_route():
     return jsonify(npu.get_npu_status())
 
+@app.route("/api/npu/cache", methods=['GET', 'DELETE'])
+def npu_cache_route():
+    """Reports inference result cache statistics, or clears the cache on DELETE."""
+    if request.method == 'DELETE':
+        result_cache.invalidate(request.args.get("model_name"))
+        return jsonify({"message": "Inference cache cleared"}), 200
+    return jsonify(result_cache.stats())
+
 @app.route("/api/npu/models")
 def npu_models_route():
     return jsonify(npu.get_available_models())
 
 @app.route("/api/npu/inference", methods=['POST'])
 def npu_inference_route():
+    """
+    Queues an inference. The optional 'priority' ("critical", "normal" or
+    "bulk", default "normal") picks the task queue; critical requests are
+    served ahead of any queued bulk work. With the local executor, a result
+    that is ready within the inline deadline is returned directly (200).
+    """
+    model_name = request.json.get("model_name")
+    input_data = request.json.get("input_data")
+    priority = request.json.get("priority", DEFAULT_PRIORITY)
+    if not model_name or not input_data:
+        return jsonify({"error": "model_name and input_data are required"}), 400
+    if priority not in PRIORITIES:
+        return jsonify({"error": f"priority must be one of: {', '.join(PRIORITIES)}"}), 400
+
+    # Answer repeated (model, input) pairs from the result cache without queuing a task.
+    cache_key = result_cache.make_key(model_name, npu.get_model_version(model_name), input_data)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return jsonify({"task_id": None, "status": "completed", "cached": True, "result": cached})
+
+    task_id = executor.submit(model_name, input_data, priority, cache_key)
+    if executor.inline_deadline_s > 0 and executor.wait(task_id, executor.inline_deadline_s):
+        payload, status_code = task_result_payload(task_id)
+        return jsonify(payload), status_code
+    return jsonify({"task_id": task_id, "status": "pending", "priority": priority}), 202
+
+def list_input_files(directory, recursive=False):
+    """Lists regular files under a storage directory as paths relative to STORAGE_PATH."""
+    import bulk_jobs
+
+    root = os.path.abspath(os.path.join(npu.STORAGE_PATH, directory.lstrip('/')))
+    files = []
+    pending = [root]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    files.append(os.path.relpath(entry.path, npu.STORAGE_PATH))
+                elif recursive and entry.is_dir(follow_symlinks=False) and entry.path != UPLOAD_STAGING_DIR:
+                    pending.append(entry.path)
+        if len(files) > bulk_jobs.BULK_MAX_ITEMS:
+            break
+    return sorted(files)
+
+@app.route("/api/npu/inference/batch", methods=['POST'])
+def npu_inference_batch_route():
+    """
+    Runs inference over many inputs as one job. Accepts either a list of
+    'inputs', or a 'directory' under the storage folder whose files are used
+    as inputs (each passed to the model as {"file": <relative path>}).
+    """
+    import bulk_jobs
+
+    model_name = request.json.get("model_name")
+    inputs = request.json.get("inputs")
+    directory = request.json.get("directory")
+    if not model_name or (inputs is None) == (directory is None):
+        return jsonify({"error": "model_name and exactly one of inputs or directory are required"}), 400
+
+    if directory is not None:
+        if not is_safe_path(directory):
+            abort(403)
+        if not os.path.isdir(os.path.join(npu.STORAGE_PATH, directory.lstrip('/'))):
+            return jsonify({"error": "Directory not found"}), 404
+        inputs = [{"file": path} for path in list_input_files(directory, bool(request.json.get("recursive")))]
+    elif not isinstance(inputs, list):
+        return jsonify({"error": "inputs must be a list"}), 400
+
+    if not inputs:
+        return jsonify({"error": "No inputs to process"}), 400
+    if len(inputs) > bulk_jobs.BULK_MAX_ITEMS:
+        return jsonify({"error": f"Too many inputs (maximum is {bulk_jobs.BULK_MAX_ITEMS})"}), 400
+
+    job_id = bulk_jobs.submit_job(model_name, inputs)
+    return jsonify({"job_id": job_id, "status": "pending", "total": len(inputs)}), 202
+
+@app.route("/api/npu/inference/batch/<string:job_id>", methods=['GET'])
+def npu_inference_batch_result_route(job_id):
+    """Returns bulk job progress and a page of results (?offset=&limit=, limit up to 1000)."""
+    import bulk_jobs
+
+    try:
+        offset = int(request.args.get("offset", 0))
+        limit = min(int(request.args.get("limit", 100)), 1000)
+    except ValueError:
+        return jsonify({"error": "offset and limit must be integers"}), 400
+
+    job = bulk_jobs.get_job(job_id, offset, limit)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200 if job["status"] != "pending" else 202
+
+def token_event_stream(task_id, request_start):
+    """Turns a task's token stream into Server-Sent Events."""
+    from token_stream import read_tokens
+
+    first_token_ms = None
+    for event in read_tokens(celeryconfig.result_backend, task_id, RESULT_STREAM_MAX_S, block_ms=int(SSE_KEEPALIVE_S * 1000)):
+        if event.get("keepalive"):
+            yield ": keep-alive\n\n"
+        elif "token" in event:
+            if first_token_ms is None:
+                first_token_ms = round((time.monotonic() - request_start) * 1000, 1)
+            yield f"event: token\ndata: {json.dumps(event['token'])}\n\n"
+        elif event.get("timeout"):
+            # Tell the client the stream is over instead of just closing it.
+            error = f"No result within {RESULT_STREAM_MAX_S:g}s"
+            yield f"event: error\ndata: {json.dumps({'error': error, 'timeout': True})}\n\n"
+        else:
+            # The worker measures TTFT from task start; this adds queueing and delivery time.
+            event["done"]["http_ttft_ms"] = first_token_ms
+            name = "error" if "error" in event else "done"
+            yield f"event: {name}\ndata: {json.dumps(event)}\n\n"
+
+@app.route("/api/npu/inference/stream", methods=['POST'])
+def npu_inference_stream_route():
+    """Starts a streaming inference task and returns its tokens as Server-Sent Events."""
+    request_start = time.monotonic()
     model_name = request.json.get("model_name")
     input_data = request.json.get("input_data")
     if not model_name or not input_data:
         return jsonify({"error": "model_name and input_data are required"}), 400
-    task = run_npu_inference_task.delay(model_name, input_data)
-    return jsonify({"task_id": task.id, "status": "pending"}), 202
+
+    from tasks import run_npu_stream_task
+
+    task = run_npu_stream_task.delay(model_name, input_data)
+    return Response(stream_with_context(token_event_stream(task.id, request_start)), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Task-Id": task.id})
+
+@app.route("/api/npu/stream/<string:task_id>", methods=['GET'])
+def npu_stream_route(task_id):
+    """Reattaches to the token stream of a running or recently finished streaming task."""
+    return Response(stream_with_context(token_event_stream(task_id, time.monotonic())), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def task_result_payload(task_id):
+    """Reads a task's state from the executor; returns (payload, http_status)."""
+    status, value = executor.state(task_id)
+    if status == "completed":
+        return {
+            "task_id": task_id,
+            "status": "completed",
+            "result": value
+        }, 200
+    elif status == "failed":
+        return {
+            "task_id": task_id,
+            "status": "failed",
+            "error": value
+        }, 500
+    elif status == "not_found":
+        return {
+            "task_id": task_id,
+            "status": "not_found",
+            "error": "Unknown task id, or its result has expired"
+        }, 404
+    else:
+        return {"task_id": task_id, "status": "pending"}, 202
 
 @app.route("/api/npu/result/<string:task_id>", methods=['GET'])
 def get_npu_result_route(task_id):
-    task_result = AsyncResult(task_id, app=celery)
-    if task_result.ready():
-        if task_result.successful():
-            return jsonify({
-                "task_id": task_id,
-                "status": "completed",
-                "result": task_result.result
-            })
+    """
+    Returns the task result. With ?wait=<seconds> the request long-polls:
+    it is held open until the task finishes or the wait runs out.
+    """
+    try:
+        wait = min(float(request.args.get("wait", 0)), RESULT_MAX_WAIT_S)
+    except ValueError:
+        return jsonify({"error": "wait must be a number of seconds"}), 400
+
+    if wait > 0:
+        executor.wait(task_id, wait)
+    payload, status_code = task_result_payload(task_id)
+    return jsonify(payload), status_code
+
+@app.route("/api/npu/result/<string:task_id>/stream", methods=['GET'])
+def stream_npu_result_route(task_id):
+    """Server-Sent Events stream that emits a single 'result' event when the task finishes."""
+    def generate():
+        deadline = time.monotonic() + RESULT_STREAM_MAX_S
+        payload, _ = task_result_payload(task_id)
+        while payload["status"] == "pending" and time.monotonic() < deadline:
+            yield ": keep-alive\n\n"
+            notified = executor.wait(task_id, SSE_KEEPALIVE_S)
+            if notified:
+                payload, _ = task_result_payload(task_id)
+        if payload["status"] == "pending":
+            yield f"event: timeout\ndata: {json.dumps(payload)}\n\n"
+        elif payload["status"] == "not_found":
+            yield f"event: error\ndata: {json.dumps(payload)}\n\n"
         else:
-            return jsonify({
-                "task_id": task_id,
-                "status": "failed",
-                "error": str(task_result.info)
-            }), 500
+            yield f"event: result\ndata: {json.dumps(payload)}\n\n"
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# --- File Management API ---
+# Listings of storage directories, cached per directory (see directory_index.py).
+directory_index = DirectoryIndex(npu.STORAGE_PATH, excluded=[UPLOAD_STAGING_DIR])
+
+def _json_path(key="path"):
+    """Returns the storage path named in the request body, None if it is missing; aborts on an unsafe one."""
+    path = (request.json or {}).get(key)
+    if not isinstance(path, str) or not path:
+        return None
+    if not is_safe_path(path):
+        abort(403)
+    return path
+
+@app.route("/api/files/browse")
+def browse_files():
+    """
+    Lists a storage directory a page at a time. The body is a JSON array of
+    {name, path, is_dir, size, modified}; if there are more entries, the
+    X-Next-Cursor header holds the cursor to pass as ?cursor= for the next page.
+
+    Query parameters: path, cursor, limit (up to 1000), sort (name, size,
+    modified, or none for directory order), order (asc or desc),
+    type (file or dir) and q (a case-insensitive substring of the name).
+    """
+    path = request.args.get("path", "/")
+    sort = request.args.get("sort", "name")
+    order = request.args.get("order", "asc")
+    entry_type = request.args.get("type")
+    try:
+        limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"}), 400
+    if sort not in SORT_KEYS or order not in ("asc", "desc") or entry_type not in ENTRY_TYPES + (None,):
+        return jsonify({"error": f"sort must be one of {', '.join(SORT_KEYS)}, order asc or desc, "
+                                 f"and type one of {', '.join(ENTRY_TYPES)}"}), 400
+    if not is_safe_path(path):
+        abort(403)
+    if not os.path.isdir(storage_path(path)):
+        return jsonify({"error": "Directory not found"}), 404
+
+    try:
+        items, next_cursor = directory_index.list_page(
+            storage_path(path), request.args.get("cursor"), limit, sort, order == "desc", entry_type,
+            request.args.get("q"))
+    except InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
+    response = jsonify(items)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
+
+@app.route("/api/files/folder", methods=['POST'])
+def create_folder():
+    path = _json_path()
+    if path is None:
+        return jsonify({"error": "path is required"}), 400
+    try:
+        os.makedirs(storage_path(path))
+    except FileExistsError:
+        return jsonify({"error": "Path already exists"}), 409
+    directory_index.invalidate(os.path.dirname(storage_path(path)))
+    return jsonify({"success": True, "message": f"Folder '{path}' created."}), 201
+
+@app.route("/api/files/manage", methods=['PUT', 'DELETE'])
+def manage_file():
+    """Renames or moves (PUT, with a destination) or deletes (DELETE) a file or folder."""
+    path = _json_path()
+    if path is None:
+        return jsonify({"error": "path is required"}), 400
+    source = storage_path(path)
+    if source == npu.STORAGE_PATH:
+        return jsonify({"error": "The storage root cannot be changed"}), 400
+    if not os.path.lexists(source):
+        return jsonify({"error": "Path not found"}), 404
+
+    if request.method == 'PUT':
+        destination_path = _json_path("destination")
+        if destination_path is None:
+            return jsonify({"error": "destination is required"}), 400
+        destination = storage_path(destination_path)
+        if destination == npu.STORAGE_PATH or destination.startswith(source + os.sep):
+            return jsonify({"error": "Invalid destination"}), 400
+        if os.path.lexists(destination):
+            return jsonify({"error": "Destination already exists"}), 409
+        shutil.move(source, destination)
+        for changed in (source, os.path.dirname(source), os.path.dirname(destination)):
+            directory_index.invalidate(changed)
+        return jsonify({"success": True, "message": f"Moved '{path}' to '{destination_path}'."})
+
+    if os.path.isdir(source) and not os.path.islink(source):
+        shutil.rmtree(source)
     else:
-        return jsonify({"task_id": task_id, "status": "pending"}), 202
+        os.remove(source)
+    for changed in (source, os.path.dirname(source)):
+        directory_index.invalidate(changed)
+    return jsonify({"success": True, "message": f"Deleted '{path}'."})
+
+# --- File Search API ---
+# An on-disk index of the storage tree, kept current from inotify events (see search_index.py).
+search_index = StorageSearchIndex(npu.STORAGE_PATH, excluded=[UPLOAD_STAGING_DIR])
+
+@app.route("/api/files/search")
+def search_files():
+    """
+    Finds files and folders anywhere under the storage folder, answered from
+    the search index without touching the disks.
+
+    Query parameters (all optional): q (part of the name), ext, type (file or
+    dir), min_size and max_size (bytes), min_age and max_age (seconds since
+    last modification), path (only below this folder), sort (name, size,
+    modified or path), order (asc or desc) and limit (up to 1000).
+    """
+    search_index.start()
+    args = request.args
+    try:
+        numbers = {name: (float if name.endswith("age") else int)(args[name])
+                   for name in ("min_size", "max_size", "min_age", "max_age", "limit") if name in args}
+    except ValueError:
+        return jsonify({"error": "min_size, max_size, min_age, max_age and limit must be numbers"}), 400
+    limit = numbers.get("limit", DEFAULT_SEARCH_LIMIT)
+    sort = args.get("sort", "name")
+    if not 1 <= limit <= MAX_SEARCH_LIMIT:
+        return jsonify({"error": f"limit must be between 1 and {MAX_SEARCH_LIMIT}"}), 400
+    if sort not in SEARCH_SORT_COLUMNS or args.get("order", "asc") not in ("asc", "desc") or \
+            args.get("type") not in ENTRY_TYPES + (None,):
+        return jsonify({"error": f"sort must be one of {', '.join(SEARCH_SORT_COLUMNS)}, order asc or desc, "
+                                 f"and type one of {', '.join(ENTRY_TYPES)}"}), 400
+    if "path" in args and not is_safe_path(args["path"]):
+        abort(403)
+
+    results = search_index.search(
+        args.get("q"), args.get("ext"), args.get("type"), numbers.get("min_size"), numbers.get("max_size"),
+        numbers.get("min_age"), numbers.get("max_age"), args.get("path"), sort, args.get("order") == "desc", limit)
+    if results is None:
+        return jsonify({"error": "The search index is still being built", "index": search_index.status()}), 503
+    return jsonify({"results": results, "count": len(results), "index": search_index.status()})
+
+# --- File Transfer API ---
+uploads = ResumableUploads(UPLOAD_STAGING_DIR)
+
+def _api_path(absolute_path):
+    return "/" + os.path.relpath(absolute_path, npu.STORAGE_PATH)
+
+def _upload_status_response(upload_id, status, status_code=200):
+    response = jsonify({
+        "upload_id": upload_id,
+        "path": _api_path(status["destination"]),
+        "size": status["size"],
+        "offset": status["offset"],
+        "complete": status["complete"]
+    })
+    response.status_code = status_code
+    response.headers["Upload-Offset"] = str(status["offset"])
+    response.headers["Upload-Length"] = str(status["size"])
+    return response
+
+@app.route("/api/files/upload", methods=['POST'])
+def upload_file():
+    """
+    Uploads a file from a multipart form ('file', and the target directory
+    as 'path', default /uploads) in one request of at most MAX_UPLOAD_MB.
+    The file is written to a temporary name and renamed into place. Larger
+    files must use the resumable protocol under /api/files/uploads, which
+    streams the request body to disk.
+    """
+    if request.content_length is not None and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({"error": "File too large; use the resumable upload API (/api/files/uploads)"}), 413
+    file = request.files.get("file")
+    if file is None or not secure_filename(file.filename or ""):
+        return jsonify({"error": "A file is required"}), 400
+    directory = request.form.get("path") or _api_path(app.config['UPLOAD_FOLDER'])
+    if not is_safe_path(directory):
+        abort(403)
+    if not os.path.isdir(storage_path(directory)):
+        return jsonify({"error": "Directory not found"}), 404
+
+    destination = os.path.join(storage_path(directory), secure_filename(file.filename))
+    tmp_path = f"{destination}.{os.getpid()}.{threading.get_ident()}.upload"
+    try:
+        file.save(tmp_path)
+        os.replace(tmp_path, destination)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    directory_index.invalidate(os.path.dirname(destination))
+    return jsonify({"success": True, "path": _api_path(destination)}), 201
+
+@app.route("/api/files/uploads", methods=['POST'])
+def create_upload():
+    """
+    Starts a resumable upload of {"path", "size"} (the file's full path and
+    length in bytes; "overwrite": true replaces an existing file).
 
-# --- File Management API (Omitted for brevity, assumed unchanged) ---
-# ...
+    The client then sends the file with PATCH /api/files/uploads/<upload_id>,
+    raw bytes in the body and the offset they start at in the Upload-Offset
+    header. A chunk may be the whole rest of the file: if the connection
+    drops, GET (or HEAD) the upload to read its Upload-Offset and send the
+    rest from there. The file appears at its path once the last byte arrives;
+    the upload can still be looked up (as complete) for an hour after that.
+    """
+    path = _json_path()
+    size = (request.json or {}).get("size")
+    if path is None or not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        return jsonify({"error": "path and a non-negative integer size are required"}), 400
+    destination = storage_path(path)
+    if destination == npu.STORAGE_PATH or os.path.isdir(destination):
+        return jsonify({"error": "path must name a file"}), 400
+    if os.path.lexists(destination) and not request.json.get("overwrite"):
+        return jsonify({"error": "Path already exists"}), 409
+
+    upload_id = uploads.create(destination, size)
+    if size == 0:
+        # Nothing to wait for: complete the upload straight away.
+        status = uploads.append(upload_id, 0, request.stream)
+        directory_index.invalidate(os.path.dirname(destination))
+    else:
+        status = uploads.status(upload_id)
+    response = _upload_status_response(upload_id, status, 201)
+    response.headers["Location"] = f"/api/files/uploads/{upload_id}"
+    return response
+
+@app.route("/api/files/uploads/<string:upload_id>", methods=['GET', 'PATCH', 'DELETE'])
+def resumable_upload(upload_id):
+    """Reports (GET/HEAD), continues (PATCH) or cancels (DELETE) a resumable upload."""
+    try:
+        if request.method in ('GET', 'HEAD'):
+            return _upload_status_response(upload_id, uploads.status(upload_id))
+        if request.method == 'DELETE':
+            uploads.cancel(upload_id)
+            return jsonify({"success": True, "message": "Upload cancelled."})
+
+        try:
+            offset = int(request.headers["Upload-Offset"])
+        except (KeyError, ValueError):
+            return jsonify({"error": "The Upload-Offset header is required"}), 400
+        try:
+            # The raw WSGI input: a chunk may be the whole rest of the file, so
+            # MAX_CONTENT_LENGTH does not apply (append stops at the upload's size).
+            status = uploads.append(upload_id, offset, get_input_stream(request.environ))
+        except OffsetMismatch as e:
+            response = jsonify({"error": str(e), "offset": e.offset})
+            response.status_code = 409
+            response.headers["Upload-Offset"] = str(e.offset)
+            return response
+        except UploadBusy:
+            return jsonify({"error": "Another request is writing to this upload"}), 409
+    except UploadNotFound:
+        return jsonify({"error": "Upload not found"}), 404
+
+    if status["complete"]:
+        directory_index.invalidate(os.path.dirname(status["destination"]))
+    return _upload_status_response(upload_id, status)
+
+@app.route("/api/files/download")
+def download_file():
+    """
+    Downloads a file (?path=). Supports Range requests (206 Partial Content)
+    and conditional requests, so interrupted downloads resume with
+    'curl -C -'. The file (or the requested range of it) is handed to the
+    server as a file object, which gunicorn sends with sendfile() without
+    copying it through Python.
+    """
+    path = request.args.get("path")
+    if not path:
+        return jsonify({"error": "path is required"}), 400
+    if not is_safe_path(path):
+        abort(403)
+    if not os.path.isfile(storage_path(path)):
+        return jsonify({"error": "File not found"}), 404
+
+    response = send_file(storage_path(path), as_attachment=True, conditional=True)
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if response.status_code == 206 and file_wrapper is not None and \
+            request.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn"):
+        # Werkzeug serves ranges through a Python iterator. Hand gunicorn a
+        # file positioned at the range start instead: it sends Content-Length
+        # bytes from there with sendfile().
+        response.response.close()
+        f = open(storage_path(path), 'rb')
+        f.seek(response.content_range.start)
+        response.response = file_wrapper(f)
+    return response
 
 # --- Main Application Runner ---
 def main():
-    # Clean up old state files on start
+    # Reset the shared system state and clean up old state files on start
+    system_state.reset(DEFAULT_SYSTEM_STATE)
     for state_file in [FAN_STATE_FILE, DIODE_STATE_FILE]:
-        if os.path.exists(state_file):
-            os.remove(state_file)
+        for path in [state_file, ack_path(state_file), latency_log_path(state_file)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    npu.ensure_storage()
+    search_index.start()
+    if executor.name == "local":
+        # Inference runs in this process, so warm the models up before serving.
+        npu.preload_models()
 
     print("--- Starting All Simulators ---")
-    simulators = [
-        "overcurrent_simulator.py",
-        "temperature_simulator.py",
-        "fan_controller.py",
-        "diode_controller.py"
-    ]
-    for sim in simulators:
-        try:
-            subprocess.Popen([".venv/bin/python", sim])
-            print(f"Launched {sim}.")
-        except FileNotFoundError:
-            print(f"ERROR: Could not find {sim}. Make sure it exists.")
+    # A single process runs every simulator and controller as an asyncio task.
+    try:
+        subprocess.Popen([".venv/bin/python", "simulator_supervisor.py"])
+        print("Launched simulator_supervisor.py.")
+    except FileNotFoundError:
+        print("ERROR: Could not find simulator_supervisor.py. Make sure it exists.")
 
-    print("\nReminder: Start Redis and the Celery worker in separate terminals.")
+    if executor.name == "local":
+        print("\nInference runs in-process (NPU_EXECUTOR=local). Redis and the Celery workers are only")
+        print("needed for streaming and bulk inference:")
+    else:
+        print("\nReminder: Start Redis and the Celery worker in separate terminals.")
     print("  docker run -d -p 6379:6379 redis")
-    print("  celery -A tasks.celery worker --loglevel=info\n")
+    print("  celery -A tasks.celery worker -Q npu-critical --pool threads --concurrency 2 -n critical@%h --loglevel=info")
+    print("  celery -A tasks.celery worker -Q npu-critical,npu-normal,npu-bulk --pool threads --concurrency 16 "
+          "-n general@%h --loglevel=info\n")
     
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 3177)))
 
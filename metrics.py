@@ -0,0 +1,273 @@
+# metrics.py
+# This file implements lightweight Prometheus-style metrics: counters, gauges
+# and histograms kept in process memory, rendered in the Prometheus text
+# exposition format by the /metrics endpoint.
+#
+# Recording a value is a dict lookup and a few additions under a lock, cheap
+# enough to leave on in production. Celery workers and gunicorn workers run in
+# separate processes, so each periodically publishes a snapshot of its
+# registry to Redis and the /metrics endpoint merges them, labelled by worker.
+
+import bisect
+import json
+import math
+import os
+import socket
+import threading
+import time
+
+# Default latency buckets in seconds, from sub-millisecond API calls up to
+# multi-second language model generations.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# How often a worker publishes its snapshot, and how long a snapshot is kept
+# once its worker stops publishing (seconds).
+SNAPSHOT_INTERVAL_S = float(os.environ.get('METRICS_SNAPSHOT_INTERVAL_S', 10))
+SNAPSHOT_TTL_S = 60
+SNAPSHOT_KEY_PREFIX = "npu-metrics-"
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            samples = [[dict(zip(self.labelnames, key)), self._copy(value)] for key, value in self._values.items()]
+        return {"type": self.type, "help": self.documentation, "samples": samples}
+
+    def _copy(self, value):
+        return value
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (not cumulative) counts; the last slot is +Inf.
+                state = self._values[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0}
+            state["counts"][index] += 1
+            state["sum"] += value
+
+    def time(self, **labels):
+        """Context manager that observes the duration of its block."""
+        return _Timer(self, labels)
+
+    def snapshot(self):
+        snap = super().snapshot()
+        snap["buckets"] = list(self.buckets)
+        return snap
+
+    def _copy(self, value):
+        return {"counts": list(value["counts"]), "sum": value["sum"]}
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start, **self._labels)
+
+
+class Registry:
+    """
+    Holds a process's metrics. Collectors are callables run on every scrape,
+    for values that are cheaper to read on demand than to keep up to date
+    (e.g. queue lengths).
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, fn):
+        self._collectors.append(fn)
+
+    def snapshot(self):
+        """Returns {name: {"type", "help", "samples", ...}} after running the collectors."""
+        for collector in list(self._collectors):
+            try:
+                collector()
+            except Exception as e:
+                print(f"METRICS: Collector {getattr(collector, '__name__', collector)} failed: {e}")
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def render(snapshots):
+    """
+    Renders registry snapshots as Prometheus text. snapshots is a list of
+    (snapshot, extra_labels) pairs; families with the same name are merged.
+    """
+    families = {}
+    for snapshot, extra_labels in snapshots:
+        for name, family in snapshot.items():
+            merged = families.setdefault(name, {"type": family["type"], "help": family["help"],
+                                                "buckets": family.get("buckets"), "samples": []})
+            merged["samples"].extend((dict(labels, **extra_labels), value) for labels, value in family["samples"])
+
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for labels, value in family["samples"]:
+            if family["type"] != "histogram":
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(family["buckets"]) + [math.inf], value["counts"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(dict(labels, le=_format_value(float(bound))))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value['sum'])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class SnapshotPublisher:
+    """Periodically stores a registry snapshot in Redis for the /metrics endpoint to merge."""
+
+    def __init__(self, registry, redis_url, name=None, interval_s=SNAPSHOT_INTERVAL_S):
+        self.registry = registry
+        self.redis_url = redis_url
+        self._fixed_name = name
+        self.name = name
+        self.interval_s = interval_s
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts publishing from this process. Publishers are usually created
+        before a prefork pool forks, so the worker name (host:pid) is taken
+        here, in the process that publishes, and a child never shares its
+        parent's key or thread.
+        """
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self.name = self._fixed_name or worker_name()
+                self._thread = threading.Thread(target=self._run, args=(self.name,), name="metrics-publisher",
+                                                daemon=True)
+                self._thread.start()
+
+    @property
+    def running(self):
+        """True if this process publishes (a forked child must call start itself)."""
+        return self._thread is not None and self._pid == os.getpid()
+
+    def _run(self, name):
+        import redis
+
+        client = redis.Redis.from_url(self.redis_url)
+        while True:
+            try:
+                client.set(SNAPSHOT_KEY_PREFIX + name, json.dumps(self.registry.snapshot()), ex=SNAPSHOT_TTL_S)
+            except Exception as e:
+                print(f"METRICS: Could not publish snapshot ({e}).")
+            time.sleep(self.interval_s)
+
+
+def read_worker_snapshots(client, exclude=None):
+    """
+    Returns [(snapshot, {"worker": name})] for every live worker snapshot in
+    Redis, except the one published under the name exclude.
+    """
+    snapshots = []
+    for key in client.scan_iter(match=SNAPSHOT_KEY_PREFIX + "*", count=100):
+        key = key.decode() if isinstance(key, bytes) else key
+        name = key[len(SNAPSHOT_KEY_PREFIX):]
+        if name == exclude:
+            continue
+        raw = client.get(key)
+        if raw is None:
+            continue
+        snapshots.append((json.loads(raw), {"worker": name}))
+    return snapshots
+
+
+# The metrics of this process.
+registry = Registry()
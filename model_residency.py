@@ -0,0 +1,206 @@
+# model_residency.py
+# This file implements a residency manager that keeps several NPU models
+# loaded at once under a fixed memory budget, evicting the least recently
+# used model when a new one does not fit.
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ModelResidencyManager:
+    """
+    Tracks which models are resident and how much memory they use.
+
+    The actual loading and unloading is delegated to the NPU backend through
+    load_fn(model_name) and unload_fn(model_name), which return (ok, message)
+    like the rest of the NPU API. size_fn(model_name) returns the number of
+    bytes a model occupies once loaded.
+    """
+
+    def __init__(self, budget_bytes, load_fn, unload_fn, size_fn):
+        self.budget_bytes = budget_bytes
+        self._load_fn = load_fn
+        self._unload_fn = unload_fn
+        self._size_fn = size_fn
+        # model_name -> stats dict, ordered from least to most recently used.
+        self._resident = OrderedDict()
+        self._in_use = {}
+        # Models being loaded (outside the lock): model_name -> {"size", "victims", "done" event, "result"}.
+        # Their size is reserved in the budget until the load commits or fails.
+        self._loading = {}
+        # Models being unloaded (outside the lock): model_name -> {"size", "stats", "done" event}.
+        # Their memory stays reserved until the unload finishes.
+        self._unloading = {}
+        self._evictions = 0
+        self._lock = threading.RLock()
+
+    @property
+    def used_bytes(self):
+        """Bytes used by resident models plus those reserved for models being loaded or unloaded."""
+        with self._lock:
+            return sum(m["resident_bytes"] for m in self._resident.values()) + \
+                sum(self._reserved(m) for m in self._loading.values()) + \
+                sum(m["size"] for m in self._unloading.values())
+
+    def is_resident(self, model_name):
+        return model_name in self._resident
+
+    def load(self, model_name):
+        """Makes model_name resident, evicting LRU models if the budget requires it."""
+        return self._ensure(model_name, pin=False)
+
+    def unload(self, model_name):
+        with self._lock:
+            if self._in_use.get(model_name):
+                return False, f"Model {model_name} is busy and cannot be unloaded"
+            if model_name in self._loading:
+                return False, f"Model {model_name} is being loaded and cannot be unloaded"
+            if model_name in self._unloading:
+                return True, f"Model {model_name} is already being unloaded"
+            stats = self._resident.pop(model_name, None)
+            if stats is not None:
+                self._start_unload(model_name, stats["resident_bytes"])
+        if stats is None:
+            return self._unload_fn(model_name)
+        return self._finish_unloads([model_name])
+
+    def acquire(self, model_name, count=1):
+        """
+        Marks model_name as in use for count requests, loading it first if it was evicted.
+        Every acquire must be paired with a release.
+        """
+        return self._ensure(model_name, pin=True, hits=count)
+
+    def _pin(self, model_name, hits):
+        self._resident.move_to_end(model_name)
+        self._resident[model_name]["hits"] += hits
+        self._in_use[model_name] = self._in_use.get(model_name, 0) + 1
+
+    def _ensure(self, model_name, pin, hits=0):
+        """
+        Loads model_name unless it is resident and, with pin, marks it in use in
+        the same step so it cannot be evicted in between. The budget is reserved
+        under the lock, but the (slow) load itself runs without it, so requests
+        for resident models are not held up by another model's load. Requests
+        for a model that is already loading wait for that load instead. Evicted
+        models are unloaded by the same request, also without the lock, before
+        it loads its model; their memory stays reserved until then.
+        """
+        while True:
+            with self._lock:
+                if model_name in self._resident:
+                    if pin:
+                        self._pin(model_name, hits)
+                    else:
+                        self._resident.move_to_end(model_name)
+                    return True, "Model is already loaded"
+                pending = self._loading.get(model_name) or self._unloading.get(model_name)
+                if pending is None:
+                    size = self._size_fn(model_name)
+                    if size is None:
+                        return False, "Model not found"
+                    if size > self.budget_bytes:
+                        return False, (f"Model {model_name} needs {size} bytes, "
+                                       f"more than the {self.budget_bytes} byte NPU memory budget")
+                    victims = self._make_room(size)
+                    if victims is None:
+                        return False, "Not enough NPU memory: all resident models are in use"
+                    pending = self._loading[model_name] = {
+                        "size": size, "victims": victims, "done": threading.Event(), "result": None}
+                    break
+            pending["done"].wait()
+            if pending.get("result") is not None and not pending["result"][0]:
+                return pending["result"]
+            # Loaded by another request (or unloaded); pin it, or load it if it is not resident.
+
+        self._finish_unloads(victims)
+        start = time.monotonic()
+        try:
+            ok, msg = self._load_fn(model_name)
+        except Exception as e:
+            ok, msg = False, f"Model {model_name} failed to load: {e}"
+        with self._lock:
+            del self._loading[model_name]
+            if ok:
+                self._resident[model_name] = {
+                    "resident_bytes": pending["size"],
+                    "load_time_s": round(time.monotonic() - start, 4),
+                    "loaded_at": time.time(),
+                    "hits": 0
+                }
+                if pin:
+                    self._pin(model_name, hits)
+            pending["result"] = (ok, msg)
+        pending["done"].set()
+        return ok, msg
+
+    def release(self, model_name):
+        with self._lock:
+            remaining = self._in_use.get(model_name, 0) - 1
+            if remaining > 0:
+                self._in_use[model_name] = remaining
+            else:
+                self._in_use.pop(model_name, None)
+
+    def _reserved(self, pending):
+        # Until a load's victims are unloaded, the memory they hold covers part of the model.
+        return max(0, pending["size"] - sum(self._unloading[victim]["size"] for victim in pending["victims"]))
+
+    def _make_room(self, size):
+        """
+        Evicts idle models, least recently used first, until size bytes fit.
+        Called with the lock held; returns the evicted models, which the caller
+        must unload with _finish_unloads, or None if they cannot be made to fit.
+        """
+        victims, freed = [], 0
+        while self.used_bytes + max(0, size - freed) > self.budget_bytes:
+            victim = next((name for name in self._resident if not self._in_use.get(name)), None)
+            if victim is None:
+                for name in reversed(victims):
+                    # Nothing was unloaded yet, so the victims simply stay resident.
+                    self._resident[name] = self._unloading.pop(name)["stats"]
+                    self._resident.move_to_end(name, last=False)
+                return None
+            print(f"INFO: Evicting model {victim} to stay within the NPU memory budget.")
+            stats = self._resident.pop(victim)
+            self._start_unload(victim, stats["resident_bytes"], stats)
+            victims.append(victim)
+            freed += stats["resident_bytes"]
+        self._evictions += len(victims)
+        return victims
+
+    def _start_unload(self, model_name, size, stats=None):
+        # Called with the lock held; keeps the memory reserved until _finish_unloads.
+        self._unloading[model_name] = {"size": size, "stats": stats, "done": threading.Event()}
+
+    def _finish_unloads(self, model_names):
+        """
+        Unloads models taken out of residency by _start_unload, removing each
+        from model_names once it is unloaded. Called without the lock.
+        """
+        ok, msg = True, "OK"
+        for model_name in list(model_names):
+            try:
+                ok, msg = self._unload_fn(model_name)
+            except Exception as e:
+                ok, msg = False, f"Model {model_name} failed to unload: {e}"
+            with self._lock:
+                pending = self._unloading.pop(model_name)
+                model_names.remove(model_name)
+            pending["done"].set()
+        return ok, msg
+
+    def status(self):
+        with self._lock:
+            return {
+                "budget_bytes": self.budget_bytes,
+                "used_bytes": self.used_bytes,
+                "evictions": self._evictions,
+                "loading": list(self._loading),
+                "unloading": list(self._unloading),
+                "models": {
+                    name: dict(stats, in_use=self._in_use.get(name, 0))
+                    for name, stats in self._resident.items()
+                }
+            }
@@ -0,0 +1,94 @@
+# npu_batcher.py
+# This file implements dynamic micro-batching for NPU inference.
+# Requests for the same model that arrive within a short window are collected
+# and sent to the NPU as a single batch, then each caller gets its own result.
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import npu_manager as npu
+from npu_scheduler import DEFAULT_PRIORITY
+
+# --- Batching Configuration ---
+# The largest number of requests that will be sent to the NPU in one pass.
+BATCH_MAX_SIZE = int(os.environ.get('NPU_BATCH_MAX_SIZE', 8))
+# How long (in milliseconds) to wait for more requests before running a partial batch.
+BATCH_MAX_WAIT_MS = float(os.environ.get('NPU_BATCH_MAX_WAIT_MS', 10))
+
+
+class MicroBatcher:
+    """
+    Collects inference requests per model and runs them as batches.
+
+    Each model and priority class gets its own queue, drained by one daemon
+    thread per NPU runtime context of the model, so batches run on all of its
+    cores at once. Requests of different priorities never share a batch, and
+    each batch asks the scheduler for a core with its own priority.
+
+    A batch is dispatched as soon as it reaches max_batch_size, or when
+    max_wait_ms has passed since the first request in the batch arrived.
+    """
+
+    def __init__(self, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS):
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait_s = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queues = {}
+        self._lock = threading.Lock()
+
+    def submit(self, model_name, input_data, priority=DEFAULT_PRIORITY):
+        """Queues one request and returns a Future resolving to (results, message)."""
+        future = Future()
+        self._get_queue(model_name, priority).put((input_data, future))
+        return future
+
+    def run(self, model_name, input_data, priority=DEFAULT_PRIORITY, timeout=None):
+        """Blocking helper: submits a request and waits for its own result."""
+        return self.submit(model_name, input_data, priority).result(timeout=timeout)
+
+    def _get_queue(self, model_name, priority):
+        with self._lock:
+            q = self._queues.get((model_name, priority))
+            if q is None:
+                q = queue.Queue()
+                self._queues[(model_name, priority)] = q
+                for i in range(npu.scheduler.concurrency(model_name)):
+                    worker = threading.Thread(
+                        target=self._drain, args=(model_name, priority, q),
+                        name=f"npu-batcher-{model_name}-{priority}-{i}", daemon=True
+                    )
+                    worker.start()
+            return q
+
+    def _collect(self, q):
+        """Blocks for the first request, then gathers more until the window closes."""
+        batch = [q.get()]
+        deadline = time.monotonic() + self.max_wait_s
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self, model_name, priority, q):
+        while True:
+            batch = self._collect(q)
+            inputs = [input_data for input_data, _ in batch]
+            try:
+                outputs = npu.run_inference_batch(model_name, inputs, priority=priority)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), output in zip(batch, outputs):
+                future.set_result(output)
+
+
+# A single batcher per worker process, shared by all tasks running in it.
+batcher = MicroBatcher()
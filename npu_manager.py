@@ -3,52 +3,267 @@
 # and managing data storage paths for real vs. mock environments.
 
 import os
+import threading
+import time
+
+from metrics import registry
+from model_residency import ModelResidencyManager
+from npu_scheduler import DEFAULT_PRIORITY, NPU_CORE_PLACEMENT, NPUScheduler, parse_placements
+from prefix_cache import PrefixKVCache, prompt_text
 
 # --- Configuration for Data Storage ---
 REAL_STORAGE_PATH = os.path.abspath("storage_real")
 MOCK_STORAGE_PATH = os.path.abspath("storage_mock")
 
+# --- Configuration for Model Residency ---
+# How much NPU/DRAM memory loaded models may occupy in total.
+NPU_MEMORY_BUDGET_MB = int(os.environ.get('NPU_MEMORY_BUDGET_MB', 3072))
+
 # --- Hardware Detection ---
 # This is the single source of truth for hardware detection.
 # It checks for a device tree file unique to Orange Pi boards with RK chips.
-IS_ORANGE_PI = os.path.exists("/proc/device-tree/compatible") and \
-                 "rockchip" in open("/proc/device-tree/compatible").read()
+def detect_orange_pi():
+    try:
+        with open("/proc/device-tree/compatible", "rb") as f:
+            return b"rockchip" in f.read()
+    except OSError:
+        return False
 
 # --- Strategy Pattern Implementation ---
 # Based on the hardware detection, we select the appropriate implementation
-# and set the active storage path.
-
-if IS_ORANGE_PI:
-    print("INFO: Real Orange Pi hardware detected. Loading REAL NPU implementation.")
-    IS_REAL_MODE = True
-    STORAGE_PATH = REAL_STORAGE_PATH
-    
-    # The following functions are now sourced directly from npu_real.py
-    from npu_real import (
-        get_npu_status,
-        get_available_models,
-        load_model,
-        unload_model,
-        run_inference
-    )
-else:
-    print("INFO: No Orange Pi hardware detected. Loading MOCK NPU implementation.")
-    IS_REAL_MODE = False
-    STORAGE_PATH = MOCK_STORAGE_PATH
-    
-    # The following functions are now sourced directly from npu_mock.py
-    from npu_mock import (
-        get_npu_status,
-        get_available_models,
-        load_model,
-        unload_model,
-        run_inference
-    )
-
-# Ensure the selected storage directory exists.
-if not os.path.exists(STORAGE_PATH):
-    print(f"INFO: Creating storage directory at {STORAGE_PATH}")
-    os.makedirs(os.path.join(STORAGE_PATH, 'uploads'))
+# and set the active storage path. Detection (and importing the backend)
+# happens on first use, not on import: IS_ORANGE_PI, IS_REAL_MODE and
+# STORAGE_PATH are resolved when first read (see __getattr__ below).
+_backend = None
+_backend_lock = threading.Lock()
+
+def _get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if detect_orange_pi():
+                print("INFO: Real Orange Pi hardware detected. Loading REAL NPU implementation.")
+                # The backend functions are sourced directly from npu_real.py
+                import npu_real as backend
+            else:
+                print("INFO: No Orange Pi hardware detected. Loading MOCK NPU implementation.")
+                # The backend functions are sourced directly from npu_mock.py
+                import npu_mock as backend
+            _backend = backend
+        return _backend
+
+def _is_real_mode():
+    return _get_backend().__name__ == "npu_real"
+
+def _storage_path():
+    return REAL_STORAGE_PATH if _is_real_mode() else MOCK_STORAGE_PATH
+
+def __getattr__(name):
+    if name in ("IS_ORANGE_PI", "IS_REAL_MODE"):
+        return _is_real_mode()
+    if name == "STORAGE_PATH":
+        return _storage_path()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# These functions are passed through unchanged.
+def get_available_models():
+    return _get_backend().get_available_models()
+
+def get_model_version(model_name):
+    return _get_backend().get_model_version(model_name)
+
+# --- Metrics ---
+MODEL_LOAD_SECONDS = registry.histogram("npu_model_load_seconds", "Time to load a model onto the NPU.", ["model"])
+MODEL_UNLOAD_SECONDS = registry.histogram("npu_model_unload_seconds", "Time to unload a model from the NPU.", ["model"])
+INFERENCE_SECONDS = registry.histogram(
+    "npu_inference_seconds", "NPU inference latency, including waiting for a core.", ["model", "kind"])
+INFERENCE_INPUTS = registry.counter("npu_inference_inputs_total", "Inputs run through the NPU.", ["model", "kind"])
+
+# --- Prompt Prefix Cache ---
+# KV states of shared prompt prefixes (e.g. the agent preamble), so language
+# models only prefill the part of each prompt that differs.
+prefix_cache = PrefixKVCache()
+
+def _unload_and_forget(model_name):
+    # Cached KV states belong to the model's runtime context.
+    prefix_cache.invalidate(model_name)
+    with MODEL_UNLOAD_SECONDS.time(model=model_name):
+        return _get_backend().unload_model(model_name)
+
+def _prefix_state(model_name, input_data, slot=None):
+    """Returns the cached KV state for the longest cacheable prefix of the prompt, prefilling it if needed."""
+    prompt = prompt_text(input_data)
+    if prompt is None:
+        return None
+    prefix, state = prefix_cache.lookup(model_name, prompt)
+    if prefix and state is None:
+        try:
+            state = _get_backend().prefill(model_name, prefix, slot=slot)
+        except Exception as e:
+            print(f"WARNING: Could not prefill prompt prefix for {model_name}: {e}")
+            return None
+        prefix_cache.put(model_name, prefix, state)
+    return state
+
+def register_prompt_prefix(model_name, prefix):
+    """Marks a prompt prefix as worth caching for model_name."""
+    prefix_cache.register(model_name, prefix)
+
+# --- Per-Core Scheduling ---
+# Each model is loaded with one runtime context per NPU core (or one context
+# spanning all cores for large models), and every request runs on the
+# least-loaded of its model's contexts.
+scheduler = NPUScheduler(size_fn=lambda model_name: _get_backend().get_model_size(model_name),
+                         placements=parse_placements(NPU_CORE_PLACEMENT))
+
+def _load_on_cores(model_name):
+    with MODEL_LOAD_SECONDS.time(model=model_name):
+        return _get_backend().load_model(model_name, slots=scheduler.slots_for(model_name))
+
+def _resident_size(model_name):
+    # Every runtime context holds its own copy of the model.
+    size = _get_backend().get_model_size(model_name)
+    return None if size is None else size * scheduler.concurrency(model_name)
+
+def set_core_placement(model_name, placement):
+    """
+    Pins model_name to a tuple of NPU cores, spans it over all cores ("all"),
+    or restores the default placement (None). A loaded model is reloaded so
+    the new placement takes effect.
+    """
+    scheduler.set_placement(model_name, placement)
+    if residency.is_resident(model_name):
+        ok, msg = residency.unload(model_name)
+        if not ok:
+            return False, msg
+        return residency.load(model_name)
+    return True, "Placement updated"
+
+# --- Model Residency ---
+# The residency manager decides which models stay loaded. Several models can
+# be resident at once; the least recently used one is evicted when a new load
+# would exceed the memory budget.
+residency = ModelResidencyManager(
+    budget_bytes=NPU_MEMORY_BUDGET_MB * 1024 * 1024,
+    load_fn=_load_on_cores,
+    unload_fn=_unload_and_forget,
+    size_fn=_resident_size
+)
+
+# --- NPU Metrics ---
+# Collected in every process that imports this module, so Celery workers
+# (where inference runs by default) publish their cores' state too.
+NPU_CORE_UTILIZATION = registry.gauge("npu_core_utilization_percent", "Recent NPU core utilization.", ["core"])
+NPU_CORE_QUEUE_DEPTH = registry.gauge("npu_core_queue_depth", "Requests waiting for an NPU core.", ["core"])
+NPU_RESIDENT_BYTES = registry.gauge("npu_resident_bytes", "Memory used by models loaded in this process.")
+
+def _collect_npu():
+    for core in scheduler.status()["cores"]:
+        NPU_CORE_UTILIZATION.set(core["utilization_percent"], core=core["core"])
+        NPU_CORE_QUEUE_DEPTH.set(core["queue_depth"], core=core["core"])
+    NPU_RESIDENT_BYTES.set(residency.used_bytes)
+
+registry.add_collector(_collect_npu)
+
+def get_npu_status():
+    """Returns the backend's NPU status, plus scheduler, residency and prefix cache statistics."""
+    status = _get_backend().get_npu_status()
+    status["scheduler"] = scheduler.status()
+    status["residency"] = residency.status()
+    status["prefix_cache"] = prefix_cache.stats()
+    return status
+
+def load_model(model_name):
+    return residency.load(model_name)
+
+def unload_model(model_name):
+    return residency.unload(model_name)
+
+def run_inference(model_name, input_data, priority=DEFAULT_PRIORITY):
+    ok, msg = residency.acquire(model_name)
+    if not ok:
+        return None, msg
+    INFERENCE_INPUTS.inc(model=model_name, kind="single")
+    try:
+        with INFERENCE_SECONDS.time(model=model_name, kind="single"), scheduler.reserve(model_name, priority) as slot:
+            return _get_backend().run_inference(model_name, input_data, _prefix_state(model_name, input_data, slot), slot=slot)
+    finally:
+        residency.release(model_name)
+
+def run_inference_batch(model_name, inputs, priority=DEFAULT_PRIORITY):
+    ok, msg = residency.acquire(model_name, count=len(inputs))
+    if not ok:
+        return [(None, msg)] * len(inputs)
+    INFERENCE_INPUTS.inc(len(inputs), model=model_name, kind="batch")
+    try:
+        with INFERENCE_SECONDS.time(model=model_name, kind="batch"), scheduler.reserve(model_name, priority) as slot:
+            prefix_states = [_prefix_state(model_name, input_data, slot) for input_data in inputs]
+            return _get_backend().run_inference_batch(model_name, inputs, prefix_states, slot=slot)
+    finally:
+        residency.release(model_name)
+
+def run_inference_stream(model_name, input_data, priority=DEFAULT_PRIORITY):
+    """Yields generated tokens, keeping the model marked in use (and its cores held) until the stream ends."""
+    ok, msg = residency.acquire(model_name)
+    if not ok:
+        raise RuntimeError(msg)
+    INFERENCE_INPUTS.inc(model=model_name, kind="stream")
+    try:
+        with INFERENCE_SECONDS.time(model=model_name, kind="stream"), scheduler.reserve(model_name, priority) as slot:
+            yield from _get_backend().run_inference_stream(model_name, input_data, _prefix_state(model_name, input_data, slot),
+                                                     slot=slot)
+    finally:
+        residency.release(model_name)
+
+# --- Preloading ---
+# Models loaded and warmed up when a worker starts, before it takes traffic.
+# Celery workers do this in worker_init, before the pool starts. Forked
+# children share the mapped model files but re-create their runtime contexts
+# (see reinit_after_fork), and prefill prompt prefixes again on first use.
+NPU_PRELOAD_MODELS = [name.strip() for name in os.environ.get('NPU_PRELOAD_MODELS', 'gemma-2b-int4').split(',')
+                      if name.strip()]
+# Prompt of the warm-up inference for language models; other models get a dummy input.
+WARMUP_PROMPT = "Warm-up."
+WARMUP_INPUT = {"warmup": True}
+
+def _warmup_inputs(model_name):
+    # A registered prefix is prefilled by the warm-up, so its KV state is cached too.
+    prefixes = prefix_cache.registered(model_name)
+    return [prefix + WARMUP_PROMPT for prefix in prefixes] or [WARMUP_INPUT]
+
+def preload_models(model_names=None):
+    """
+    Loads each model and runs a dummy inference on it, so the first real
+    request pays for neither. Returns {model: {"ok", "message", "seconds"}}.
+    """
+    report = {}
+    for model_name in NPU_PRELOAD_MODELS if model_names is None else model_names:
+        start = time.monotonic()
+        ok, msg = load_model(model_name)
+        for input_data in _warmup_inputs(model_name) if ok else []:
+            result, msg = run_inference(model_name, input_data)
+            ok = ok and result is not None
+        report[model_name] = {"ok": ok, "message": msg, "seconds": round(time.monotonic() - start, 3)}
+        print(f"INFO: Preloaded {model_name} in {report[model_name]['seconds']}s: {msg}")
+    return report
+
+def reinit_after_fork():
+    """Called in every forked worker process, before it runs any task."""
+    reinit = getattr(_get_backend(), "reinit_after_fork", None)
+    if reinit is not None:
+        # Prefilled KV states belong to the parent's runtime contexts, which are replaced.
+        for model_name in reinit():
+            prefix_cache.invalidate(model_name)
+
+def ensure_storage():
+    """
+    Ensures the selected storage directory exists. Called once at startup
+    (main() or the gunicorn master) rather than on import.
+    """
+    storage_path = _storage_path()
+    if not os.path.exists(storage_path):
+        print(f"INFO: Creating storage directory at {storage_path}")
+    os.makedirs(os.path.join(storage_path, 'uploads'), exist_ok=True)
 
 # By the time another module imports from 'npu_manager', the functions and constants
-# above will be correctly pointing to either the real or mock version.
\ No newline at end of file
+# above will be correctly pointing to either the real or mock version.
@@ -1,23 +1,139 @@
 # npu_mock.py
 # This file contains the mock implementation for the NPU.
 # It allows the application to run on any machine for development and testing.
+#
+# The mock emulates the NPU's performance as well as its API: inference takes
+# time drawn from a per-model latency distribution, runs on a limited number
+# of NPU cores (so concurrent requests contend for them), models occupy
+# memory while loaded, and loading/unloading takes time.
 
+import json
+import math
+import os
 import random
+import threading
+import time
+from contextlib import contextmanager
+
+from npu_scheduler import NPU_CORES, CoreUtilization
+
+# --- Mock Performance Model ---
+# Number of NPU cores (the RK3588 has three); each runs one piece of work at a time.
+MOCK_NPU_CORES = int(os.environ.get('MOCK_NPU_CORES', NPU_CORES))
+# Memory available to loaded models.
+MOCK_NPU_MEMORY_MB = int(os.environ.get('MOCK_NPU_MEMORY_MB', 4096))
+# Multiplies every simulated delay; 0 makes the mock instant (for functional tests).
+MOCK_LATENCY_SCALE = float(os.environ.get('MOCK_LATENCY_SCALE', 1.0))
+# Model loading reads the model file at this rate; unloading takes a fixed time.
+MOCK_LOAD_MB_PER_S = float(os.environ.get('MOCK_LOAD_MB_PER_S', 400))
+MOCK_UNLOAD_MS = float(os.environ.get('MOCK_UNLOAD_MS', 20))
+# Each extra input in a batch adds this fraction of a single inference's latency.
+MOCK_BATCH_ITEM_COST = float(os.environ.get('MOCK_BATCH_ITEM_COST', 0.3))
+# npu_load_percent is averaged over this many seconds.
+MOCK_LOAD_WINDOW_S = 5.0
+
+# --- Mock Token Streaming ---
+# Rate at which the mock language model emits tokens, and the delay before the
+# first token (on top of prompt prefill).
+MOCK_TOKENS_PER_SECOND = float(os.environ.get('MOCK_TOKENS_PER_SECOND', 20))
+MOCK_FIRST_TOKEN_MS = float(os.environ.get('MOCK_FIRST_TOKEN_MS', 200))
+# Simulated prefill cost per 1000 prompt characters not covered by a cached prefix.
+MOCK_PREFILL_MS_PER_KCHAR = float(os.environ.get('MOCK_PREFILL_MS_PER_KCHAR', 150))
+MOCK_GENERATION = ("Drive 2 is reporting reallocated sectors . The array is still healthy , "
+                   "but I recommend scheduling a replacement and checking the backup status .").split()
 
 # --- Mock Data and State ---
 MOCK_MODEL_PATH = "models/yolov5s.rknn"
+# latency_ms is a log-normal distribution: its median and the sigma of its logarithm.
 mock_models = {
-    "yolov5s": {"path": MOCK_MODEL_PATH, "state": "unloaded"},
-    "resnet18": {"path": "models/resnet18.rknn", "state": "unloaded"}
+    "yolov5s": {"path": MOCK_MODEL_PATH, "state": "unloaded", "size_mb": 14,
+                "latency_ms": {"median": 25, "sigma": 0.2}},
+    "resnet18": {"path": "models/resnet18.rknn", "state": "unloaded", "size_mb": 45,
+                 "latency_ms": {"median": 8, "sigma": 0.15}},
+    "gemma-2b-int4": {"path": "models/gemma-2b-int4.rknn", "state": "unloaded", "size_mb": 1900,
+                      "latency_ms": {"median": 1500, "sigma": 0.3}}
 }
+_models_lock = threading.Lock()
+
+
+class _SimulatedCore:
+    """
+    One emulated NPU core: a worker that runs one piece of work at a time
+    for its simulated duration. Callers queue while it is busy.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.utilization = CoreUtilization(MOCK_LOAD_WINDOW_S)
+
+
+npu_cores = [_SimulatedCore(i) for i in range(MOCK_NPU_CORES)]
+_cores_lock = threading.Lock()
+
+@contextmanager
+def _occupy(slot):
+    """
+    Holds the cores of slot (a tuple of core indexes) for the duration of the
+    block. Without a slot, the least busy single core is used.
+    """
+    with _cores_lock:
+        if slot is None:
+            slot = (min(npu_cores, key=lambda c: c.waiting + c.lock.locked()).index,)
+        cores = [npu_cores[i % len(npu_cores)] for i in sorted(set(slot))]
+        for core in cores:
+            core.waiting += 1
+    for core in cores:
+        core.lock.acquire()
+    with _cores_lock:
+        for core in cores:
+            core.waiting -= 1
+            core.utilization.start()
+    try:
+        yield
+    finally:
+        with _cores_lock:
+            for core in cores:
+                core.utilization.stop()
+        for core in reversed(cores):
+            core.lock.release()
+
+def _run_on(slot, seconds):
+    """Occupies the slot's cores for `seconds` (waiting for them first)."""
+    with _occupy(slot):
+        if seconds > 0:
+            time.sleep(seconds)
+
+def _sample_latency_s(model_name):
+    """Draws one inference latency (seconds) from the model's distribution."""
+    latency = mock_models[model_name]["latency_ms"]
+    return random.lognormvariate(math.log(latency["median"]), latency["sigma"]) / 1000.0 * MOCK_LATENCY_SCALE
+
+def _memory_used_mb():
+    # Every runtime context holds its own copy of the model.
+    return sum(m["size_mb"] * len(m.get("slots", ())) for m in mock_models.values() if m["state"] in ("loaded", "loading", "unloading"))
 
 def get_npu_status():
-    """Mock status for non-Orange Pi systems."""
+    """Mock status for non-Orange Pi systems, with live load and memory from the performance model."""
+    with _cores_lock:
+        cores = [{
+            "core": core.index,
+            "busy": core.lock.locked(),
+            "queue_depth": core.waiting,
+            "load_percent": core.utilization.percent()
+        } for core in npu_cores]
+    used_mb = _memory_used_mb()
     return {
         "npu_type": "Mock NPU",
         "driver_version": "N/A",
-        "npu_load_percent": 0,
-        "available_memory_mb": 0,
+        "npu_load_percent": round(sum(c["load_percent"] for c in cores) / len(cores), 1),
+        "npu_cores": cores,
+        "npu_cores_busy": sum(c["busy"] for c in cores),
+        "npu_queue_depth": sum(c["queue_depth"] for c in cores),
+        "memory_usage_mb": used_mb,
+        "available_memory_mb": MOCK_NPU_MEMORY_MB - used_mb,
+        "loaded_models": [name for name, m in mock_models.items() if m["state"] == "loaded"],
         "cpu_temperature_c": 0,
         "npu_status": "unavailable",
         "errors": ["Running on a non-Orange Pi device. NPU is mocked."]
@@ -26,28 +142,115 @@ def get_npu_status():
 def get_available_models():
     return list(mock_models.keys())
 
-def load_model(model_name):
+def get_model_version(model_name):
+    """Returns a version string for the mock model file (path, plus mtime and size if it exists)."""
+    if model_name not in mock_models:
+        return None
+    path = mock_models[model_name]["path"]
+    try:
+        st = os.stat(path)
+    except OSError:
+        return path
+    return f"{path}:{st.st_mtime_ns}:{st.st_size}"
+
+def get_model_size(model_name):
+    """Returns the bytes the mock model would occupy once loaded."""
+    if model_name not in mock_models:
+        return None
+    return mock_models[model_name]["size_mb"] * 1024 * 1024
+
+def load_model(model_name, slots=None):
+    """Loads the mock model with one runtime context per slot (a tuple of cores); default one on core 0."""
     if model_name not in mock_models:
         return False, "Model not found"
-    if mock_models[model_name]["state"] == "loaded":
-        return True, "Model is already loaded"
-    
-    print(f"MOCK: Loading model {model_name}")
-    mock_models[model_name]["state"] = "loaded"
+    slots = [tuple(slot) for slot in slots or [(0,)]]
+    with _models_lock:
+        if mock_models[model_name]["state"] == "loaded":
+            return True, "Model is already loaded"
+        if mock_models[model_name]["state"] == "loading":
+            return False, "Model is already being loaded (mock)"
+        if mock_models[model_name]["state"] == "unloading":
+            return False, "Model is still being unloaded (mock)"
+        if _memory_used_mb() + mock_models[model_name]["size_mb"] * len(slots) > MOCK_NPU_MEMORY_MB:
+            return False, "Not enough NPU memory to load the model (mock)"
+        # Reserve the memory; the load itself runs without the lock, like a real driver call.
+        mock_models[model_name]["slots"] = slots
+        mock_models[model_name]["state"] = "loading"
+
+    print(f"MOCK: Loading model {model_name} on cores {slots}")
+    # Loading costs time proportional to the model file size, once per context.
+    time.sleep(mock_models[model_name]["size_mb"] * len(slots) / MOCK_LOAD_MB_PER_S * MOCK_LATENCY_SCALE)
+    with _models_lock:
+        mock_models[model_name]["state"] = "loaded"
     return True, f"{model_name} loaded successfully (mock)"
 
 def unload_model(model_name):
-    if model_name not in mock_models or mock_models[model_name]["state"] == "unloaded":
-        return True, "Model is not loaded or already unloaded"
+    with _models_lock:
+        if model_name not in mock_models or mock_models[model_name]["state"] in ("unloaded", "unloading"):
+            return True, "Model is not loaded or already unloaded"
+        if mock_models[model_name]["state"] == "loading":
+            return False, "Model is being loaded (mock)"
+        # The memory stays in use until the unload finishes, which runs without the lock.
+        mock_models[model_name]["state"] = "unloading"
 
     print(f"MOCK: Unloading model {model_name}")
-    mock_models[model_name]["state"] = "unloaded"
+    time.sleep(MOCK_UNLOAD_MS / 1000.0 * MOCK_LATENCY_SCALE)
+    with _models_lock:
+        mock_models[model_name]["state"] = "unloaded"
+        mock_models[model_name].pop("slots", None)
     return True, f"{model_name} unloaded successfully (mock)"
 
-def run_inference(model_name, input_data):
+def run_inference(model_name, input_data, prefix_state=None, slot=None):
     if model_name not in mock_models or mock_models[model_name]["state"] != "loaded":
         return None, "Model is not loaded"
 
     print(f"MOCK: Running inference with {model_name}")
+    _run_on(slot, _sample_latency_s(model_name) + _prefill_seconds(input_data, prefix_state))
     # Return a generic, predictable mock result
     return {"results": [{"label": "cat", "confidence": 0.92, "box": [100, 150, 300, 400]}]}, "Inference complete (mock)"
+
+def run_inference_batch(model_name, inputs, prefix_states=None, slot=None):
+    """Runs a batch of inputs through the mock model in a single pass."""
+    if model_name not in mock_models or mock_models[model_name]["state"] != "loaded":
+        return [(None, "Model is not loaded")] * len(inputs)
+
+    print(f"MOCK: Running batched inference with {model_name} (batch size {len(inputs)})")
+    # One pass costs a single latency plus a fraction of it per extra input.
+    prefix_states = prefix_states or [None] * len(inputs)
+    prefill_s = sum(_prefill_seconds(i, p) for i, p in zip(inputs, prefix_states))
+    _run_on(slot, _sample_latency_s(model_name) * (1 + MOCK_BATCH_ITEM_COST * (len(inputs) - 1)) + prefill_s)
+    return [
+        ({"results": [{"label": "cat", "confidence": 0.92, "box": [100, 150, 300, 400]}]}, "Inference complete (mock)")
+        for _ in inputs
+    ]
+
+def _prefill_seconds(input_data, prefix_state):
+    """Simulated prefill time for the part of the prompt not covered by prefix_state."""
+    prompt = input_data if isinstance(input_data, str) else json.dumps(input_data)
+    cached_chars = prefix_state["prefix_chars"] if prefix_state else 0
+    return max(0, len(prompt) - cached_chars) * MOCK_PREFILL_MS_PER_KCHAR / 1e6 * MOCK_LATENCY_SCALE
+
+def prefill(model_name, prefix, slot=None):
+    """Simulates encoding a prompt prefix and returns its (mock) KV state."""
+    if model_name not in mock_models or mock_models[model_name]["state"] != "loaded":
+        raise RuntimeError("Model is not loaded")
+    _run_on(slot, len(prefix) * MOCK_PREFILL_MS_PER_KCHAR / 1e6 * MOCK_LATENCY_SCALE)
+    return {"prefix_chars": len(prefix)}
+
+def run_inference_stream(model_name, input_data, prefix_state=None, slot=None):
+    """
+    Yields synthetic tokens from the mock model at MOCK_TOKENS_PER_SECOND.
+    prefix_state is a state from prefill(); only the rest of the prompt is prefilled.
+    """
+    if model_name not in mock_models or mock_models[model_name]["state"] != "loaded":
+        raise RuntimeError("Model is not loaded")
+
+    print(f"MOCK: Streaming inference with {model_name}")
+    # The generation holds its cores from prefill until the last token.
+    with _occupy(slot):
+        time.sleep((MOCK_FIRST_TOKEN_MS / 1000.0) * MOCK_LATENCY_SCALE + _prefill_seconds(input_data, prefix_state))
+        interval = MOCK_LATENCY_SCALE / MOCK_TOKENS_PER_SECOND if MOCK_TOKENS_PER_SECOND > 0 else 0
+        for i, token in enumerate(MOCK_GENERATION):
+            if i:
+                time.sleep(interval)
+            yield token + " "
@@ -1,7 +1,9 @@
 # npu_real.py
 # This file contains the REAL implementation for the Rockchip NPU.
 
+import mmap
 import os
+import re
 # from rknnlite.api import RKNNLite # Use this when on actual hardware
 
 # --- Constants ---
@@ -9,100 +11,297 @@ import os
 # The conversion to this format is done offline using the RKNN-Toolkit2.
 QUANTIZED_MODEL_PATH = "models/gemma-2b-int4.rknn"
 
+# All models this backend knows how to load, by name.
+MODEL_PATHS = {
+    "gemma-2b-int4": QUANTIZED_MODEL_PATH,
+    "yolov5s": "models/yolov5s.rknn",
+    "resnet18": "models/resnet18.rknn"
+}
+DEFAULT_MODEL = "gemma-2b-int4"
+
+# Per-core load as reported by the rknpu kernel driver.
+NPU_LOAD_PATH = "/sys/kernel/debug/rknpu/load"
+# Peak INT8 throughput of the RK3588 NPU (all three cores), from the datasheet.
+NPU_PEAK_TOPS = 6.0
+
 # --- Global State ---
-# This will hold the loaded RKNNLite model instance.
-# We load the model only once to save memory and startup time.
-_rknn_lite = None
+# This holds the loaded RKNNLite instances per model name, so several models
+# can stay resident at once. Which models stay loaded is decided by the
+# residency manager in npu_manager.
+# Each model has one instance per slot: a tuple of the NPU cores that
+# instance runs on (see npu_scheduler), e.g. {(0,): ctx, (1,): ctx, (2,): ctx}
+# or {(0, 1, 2): ctx} for a model spanning all cores.
+_rknn_contexts = {}
+# Read-only memory mappings of the loaded model files. Every context is
+# initialised from the mapping rather than from its own read of the file, so
+# the model's pages sit in the page cache once and are shared by all contexts
+# and by every worker process forked after the model was loaded.
+_model_files = {}
+
+def _core_mask(slot):
+    """RKNNLite core mask for a slot: NPU_CORE_0 = 1, NPU_CORE_1 = 2, NPU_CORE_2 = 4, combined with |."""
+    mask = 0
+    for core in slot:
+        mask |= 1 << core
+    return mask
+
+def _context(name, slot):
+    """Returns the model's runtime context for slot, or its first one if slot is None."""
+    contexts = _rknn_contexts[name]
+    return contexts.get(tuple(slot)) if slot is not None else next(iter(contexts.values()))
+
+def _map_model_file(name):
+    """Returns the read-only mapping of the model's file, mapping it on first use."""
+    mapping = _model_files.get(name)
+    if mapping is None:
+        with open(MODEL_PATHS[name], 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _model_files[name] = mapping
+    return mapping
+
+def _init_context(name, slot):
+    """Creates a runtime context for the model on the slot's cores, from its mapped file."""
+    model_data = _map_model_file(name)
+    rknn_lite = None
+    # rknn_lite = RKNNLite()
+    # RKNNLite.load_rknn(path) would read the file into a private buffer. The
+    # runtime's rknn_init() also accepts the model as a buffer, so it is given
+    # the shared mapping instead:
+    #    rknn_init(&ctx, model_data, len(model_data), 0, NULL)
+    # Further contexts of the same model can share its weights with
+    #    rknn_dup_context(&first_ctx, &ctx)
+    # if ret != 0:
+    #     raise RuntimeError("Failed to load RKNN model.")
+    # Bind the runtime to the slot's cores.
+    # rknn_lite.init_runtime(core_mask=_core_mask(slot))
+    return rknn_lite
+
+def _resolve_model(model_name):
+    """Maps a model name or file name (e.g. 'gemma-2b-int4.rknn') to a key in MODEL_PATHS."""
+    if model_name is None:
+        return DEFAULT_MODEL
+    name = os.path.splitext(os.path.basename(model_name))[0]
+    return name if name in MODEL_PATHS else None
+
+def _read_npu_load():
+    """
+    Reads per-core NPU load from the rknpu driver, e.g. "NPU load:  Core0: 12%, Core1:  0%, Core2:  0%,".
+    Returns a list of percentages, or None if the file is not readable (debugfs needs root).
+    """
+    try:
+        with open(NPU_LOAD_PATH) as f:
+            text = f.read()
+    except OSError:
+        return None
+    return [int(value) for value in re.findall(r"Core\d+:\s*(\d+)%", text)] or None
 
 def get_npu_status():
     """Returns the detailed status of the NPU."""
-    global _rknn_lite
-    if _rknn_lite is None:
-        # In a real scenario, you might query the driver for temperature, clock speed, etc.
-        return {"npu_status": "available", "loaded_model": None}
-    
-    # Once loaded, you could add more details.
-    return {
-        "npu_status": "active",
-        "loaded_model": os.path.basename(QUANTIZED_MODEL_PATH),
-        "memory_usage_mb": 3800, # Placeholder for INT8, would be ~1900 for INT4
-        "performance_tops": 0.7 # Based on hardware specs
+    core_load = _read_npu_load()
+    status = {
+        "npu_load_percent": round(sum(core_load) / len(core_load), 1) if core_load else None,
+        "npu_core_load_percent": core_load,
+        "performance_tops": NPU_PEAK_TOPS
     }
+    if not _rknn_contexts:
+        status.update({"npu_status": "available", "loaded_model": None, "loaded_models": [], "memory_usage_mb": 0})
+        return status
 
-def load_model(model_name=None):
+    loaded = [os.path.basename(MODEL_PATHS[name]) for name in _rknn_contexts]
+    # Each runtime context holds its own copy of the model.
+    memory_bytes = sum((get_model_size(name) or 0) * len(contexts) for name, contexts in _rknn_contexts.items())
+    status.update({
+        "npu_status": "active",
+        "loaded_model": loaded[-1],
+        "loaded_models": loaded,
+        "memory_usage_mb": round(memory_bytes / (1024 * 1024), 1)
+    })
+    return status
+
+def get_model_size(model_name):
+    """Returns the bytes a model occupies once loaded, estimated from its file size."""
+    name = _resolve_model(model_name)
+    if name is None or not os.path.exists(MODEL_PATHS[name]):
+        return None
+    return os.path.getsize(MODEL_PATHS[name])
+
+def load_model(model_name=None, slots=None):
     """
-    Loads the quantized model into memory using RKNNLite.
+    Loads the quantized model into memory using RKNNLite, with one runtime
+    context per slot (a tuple of NPU cores). By default a single context
+    on core 0 is created.
     """
-    global _rknn_lite
-    if _rknn_lite is not None:
+    name = _resolve_model(model_name)
+    if name is None:
+        return False, "Model not found"
+    if name in _rknn_contexts:
         print("INFO: Model is already loaded.")
         return True, "Model already loaded."
 
-    if not os.path.exists(QUANTIZED_MODEL_PATH):
-        msg = f"ERROR: Model file not found at {QUANTIZED_MODEL_PATH}. Run conversion scripts first."
+    model_path = MODEL_PATHS[name]
+    if not os.path.exists(model_path):
+        msg = f"ERROR: Model file not found at {model_path}. Run conversion scripts first."
         print(msg)
         return False, msg
 
-    print(f"INFO: Loading quantized model from {QUANTIZED_MODEL_PATH}...")
+    slots = [tuple(slot) for slot in slots or [(0,)]]
+    print(f"INFO: Loading quantized model from {model_path} on cores {slots}...")
     try:
-        # _rknn_lite = RKNNLite()
-        # ret = _rknn_lite.load_rknn(QUANTIZED_MODEL_PATH)
-        # if ret != 0:
-        #     print("ERROR: Failed to load RKNN model.")
-        #     _rknn_lite = None
-        #     return False, "Failed to load RKNN model file."
-        # print("INFO: Model loaded successfully.")
-        # This is where you would initialize the NPU context if needed.
-        # _rknn_lite.init_runtime()
-        pass # Placeholder for actual loading
+        contexts = {slot: _init_context(name, slot) for slot in slots}
+        print("INFO: Model loaded successfully.")
+        _rknn_contexts[name] = contexts
     except Exception as e:
         print(f"ERROR: An exception occurred while loading the model: {e}")
-        _rknn_lite = None
+        _rknn_contexts.pop(name, None)
+        _close_model_file(name)
         return False, str(e)
 
     return True, "Model loaded successfully."
 
 def unload_model(model_name=None):
     """Releases the model from memory."""
-    global _rknn_lite
-    if _rknn_lite is not None:
-        # _rknn_lite.release()
-        _rknn_lite = None
-        print("INFO: Model unloaded.")
+    name = _resolve_model(model_name)
+    if name in _rknn_contexts:
+        # for rknn_lite in _rknn_contexts[name].values():
+        #     rknn_lite.release()
+        del _rknn_contexts[name]
+        _close_model_file(name)
+        print(f"INFO: Model {name} unloaded.")
     return True, "Model unloaded."
 
-def run_inference(model_name, input_data):
+def _close_model_file(name):
+    mapping = _model_files.pop(name, None)
+    if mapping is not None:
+        mapping.close()
+
+def reinit_after_fork():
+    """
+    Re-creates the runtime contexts in a forked worker process. Driver
+    handles cannot be shared with the parent, but the model files are still
+    mapped, so this initialises from pages already in memory rather than
+    reading each file again. Returns the names of the re-created models.
+    """
+    for name, contexts in _rknn_contexts.items():
+        for slot in contexts:
+            contexts[slot] = _init_context(name, slot)
+    return list(_rknn_contexts)
+
+def prefill(model_name, prefix, slot=None):
+    """
+    Encodes a prompt prefix on the NPU and returns its KV state, so later
+    prompts starting with it can skip re-encoding it.
+    """
+    name = _resolve_model(model_name)
+    if name not in _rknn_contexts:
+        raise RuntimeError("ERROR: Model is not loaded. Cannot run inference.")
+
+    # Run prefill over the tokenized prefix and keep the resulting KV cache.
+    # With the RKLLM runtime this is its prompt cache:
+    #    rkllm_run(handle, prefix_input, {"save_prompt_cache": 1, "prompt_cache_path": path})
+    #    (on the runtime context _context(name, slot))
+    # Placeholder for the actual KV state
+    return {"model": name, "prefix_chars": len(prefix)}
+
+def run_inference(model_name, input_data, prefix_state=None, slot=None):
     """
     Runs inference on the loaded RKNN model.
     This function is now a placeholder and will be called by a Celery task.
+    If prefix_state (from prefill) is given, decoding resumes after that prefix.
+    slot selects the runtime context (and so the NPU cores) to run on.
     """
-    global _rknn_lite
-    if _rknn_lite is None:
+    name = _resolve_model(model_name)
+    if name not in _rknn_contexts:
         msg = "ERROR: Model is not loaded. Cannot run inference."
         print(msg)
         return None, msg
-    
+
     print(f"INFO: Running inference on NPU with input: {input_data}")
-    
+
     # 1. Pre-process the input_data into the format the model expects.
-    #    (e.g., tokenization for a language model).
-    
+    #    (e.g., tokenization for a language model). With a prefix_state, restore
+    #    its KV cache and only tokenize and prefill the rest of the prompt.
+
     # 2. Run the inference.
-    #    outputs = _rknn_lite.inference(inputs=[pre_processed_data])
-    
+    #    outputs = _context(name, slot).inference(inputs=[pre_processed_data])
+
     # 3. Post-process the output to a human-readable format.
-    
+
     # Placeholder for the actual inference result
     mock_result = {
         "prediction": "degraded",
         "confidence": 0.85,
         "recommendation": "Check disk 2 immediately."
     }
-    
+
     return mock_result, "Inference completed successfully."
 
+def run_inference_batch(model_name, inputs, prefix_states=None, slot=None):
+    """
+    Runs a batch of inputs on the loaded RKNN model in a single NPU pass.
+    Returns one (result, message) tuple per input, in the same order.
+    prefix_states optionally gives a prefill() state (or None) per input.
+    """
+    name = _resolve_model(model_name)
+    if name not in _rknn_contexts:
+        msg = "ERROR: Model is not loaded. Cannot run inference."
+        print(msg)
+        return [(None, msg)] * len(inputs)
+
+    print(f"INFO: Running batched inference on NPU (batch size {len(inputs)})")
+
+    # 1. Pre-process every input and stack them along the batch dimension.
+    # 2. Run a single inference for the whole batch.
+    #    outputs = _context(name, slot).inference(inputs=[stacked_data])
+    # 3. Split the outputs back into one post-processed result per input.
+
+    # Placeholder for the actual inference results
+    return [
+        ({
+            "prediction": "degraded",
+            "confidence": 0.85,
+            "recommendation": "Check disk 2 immediately."
+        }, "Inference completed successfully.")
+        for _ in inputs
+    ]
+
+def run_inference_stream(model_name, input_data, prefix_state=None, slot=None):
+    """
+    Runs the language model and yields generated tokens one at a time.
+    Raises RuntimeError if the model is not loaded.
+    If prefix_state (from prefill) is given, decoding resumes after that prefix.
+    """
+    name = _resolve_model(model_name)
+    if name not in _rknn_contexts:
+        raise RuntimeError("ERROR: Model is not loaded. Cannot run inference.")
+
+    print(f"INFO: Streaming inference on NPU with input: {input_data}")
+
+    # 1. Tokenize the prompt and run prefill over it, starting from the
+    #    prefix_state KV cache if there is one.
+    # 2. Decode one token per NPU call, feeding each token back in,
+    #    and yield it as soon as it is detokenized:
+    #    while not eos: token = _context(name, slot).inference(inputs=[last_token]); yield text
+    # 3. Stop on EOS or the maximum number of new tokens.
+
+    # Placeholder for the actual generated tokens
+    for token in "Check disk 2 immediately .".split():
+        yield token + " "
+
+def get_model_version(model_name=None):
+    """
+    Returns a version string for the model file (path, mtime and size).
+    It changes whenever a different model file is put in place.
+    """
+    name = _resolve_model(model_name)
+    if name is None:
+        return None
+    model_path = MODEL_PATHS[name]
+    try:
+        st = os.stat(model_path)
+    except OSError:
+        return f"{model_path}:missing"
+    return f"{model_path}:{st.st_mtime_ns}:{st.st_size}"
+
 def get_available_models():
     """Returns a list of models available for the real NPU."""
-    if os.path.exists(QUANTIZED_MODEL_PATH):
-        return [os.path.basename(QUANTIZED_MODEL_PATH)]
-    return []
+    return [os.path.basename(path) for path in MODEL_PATHS.values() if os.path.exists(path)]
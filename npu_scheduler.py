@@ -0,0 +1,210 @@
+# npu_scheduler.py
+# This file schedules NPU work across the RK3588's three NPU cores.
+#
+# Each loaded model has one runtime context per "slot": a slot is a tuple of
+# the cores a context runs on. Small models get one single-core context per
+# core, so up to three requests run in parallel; large models get a single
+# context spanning all cores. A model can also be pinned to specific cores.
+# Every request is dispatched to the least-loaded slot of its model, and a
+# core runs one request at a time. When several requests wait for the same
+# core, the one in the most urgent priority class gets it next.
+
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# --- Scheduler Configuration ---
+# Number of NPU cores on the SoC (the RK3588 has three).
+NPU_CORES = int(os.environ.get('NPU_CORES', 3))
+# Models at least this large get one context spanning all cores by default.
+NPU_SPAN_MIN_MB = int(os.environ.get('NPU_SPAN_MIN_MB', 1024))
+# Explicit placements, e.g. "gemma-2b-int4=all,yolov5s=0+1".
+NPU_CORE_PLACEMENT = os.environ.get('NPU_CORE_PLACEMENT', '')
+# Utilization is averaged over this many seconds.
+UTILIZATION_WINDOW_S = 5.0
+
+SPAN_ALL = "all"
+
+# Priority classes, most urgent first. Critical work (e.g. deciding whether to
+# cut array power) is granted a core before any queued normal or bulk work.
+PRIORITIES = {"critical": 0, "normal": 1, "bulk": 2}
+DEFAULT_PRIORITY = "normal"
+
+
+def parse_placements(text):
+    """Parses 'model=all,other=0+2' into {'model': 'all', 'other': (0, 2)}."""
+    placements = {}
+    for part in text.split(","):
+        if not part.strip():
+            continue
+        model_name, _, cores = part.partition("=")
+        cores = cores.strip()
+        placements[model_name.strip()] = SPAN_ALL if cores == SPAN_ALL else \
+            tuple(sorted(int(c) for c in cores.split("+")))
+    return placements
+
+
+class CoreUtilization:
+    """Tracks when a core was busy over the last few seconds."""
+
+    def __init__(self, window_s=UTILIZATION_WINDOW_S):
+        self.window_s = window_s
+        self._busy_since = None
+        self._finished = deque()
+
+    def start(self):
+        self._busy_since = time.monotonic()
+
+    def stop(self):
+        self._finished.append((self._busy_since, time.monotonic()))
+        self._busy_since = None
+
+    def percent(self):
+        now = time.monotonic()
+        window_start = now - self.window_s
+        while self._finished and self._finished[0][1] < window_start:
+            self._finished.popleft()
+        intervals = list(self._finished)
+        if self._busy_since is not None:
+            intervals.append((self._busy_since, now))
+        busy = sum(end - max(start, window_start) for start, end in intervals if end > window_start)
+        return round(min(100.0, 100.0 * busy / self.window_s), 1)
+
+
+class _Core:
+    def __init__(self, index):
+        self.index = index
+        # Heap of (priority, arrival order) for the requests waiting for this core.
+        self.waiters = []
+        self.running = 0
+        self.dispatched = 0
+        self.utilization = CoreUtilization()
+
+    @property
+    def queued(self):
+        return len(self.waiters)
+
+
+class NPUScheduler:
+    """
+    Dispatches requests to per-core runtime contexts.
+
+    size_fn(model_name) returns a model's size in bytes and is used to decide
+    whether it spans all cores when no placement is configured for it.
+    """
+
+    def __init__(self, num_cores=NPU_CORES, size_fn=None, span_min_bytes=NPU_SPAN_MIN_MB * 1024 * 1024,
+                 placements=None):
+        self.num_cores = num_cores
+        self._size_fn = size_fn
+        self.span_min_bytes = span_min_bytes
+        self._placements = dict(placements or {})
+        self._cores = [_Core(i) for i in range(num_cores)]
+        self._lock = threading.Condition()
+        self._arrivals = itertools.count()
+
+    def set_placement(self, model_name, placement):
+        """
+        Pins model_name to a tuple of cores, spans it over all cores (SPAN_ALL),
+        or restores the default (None). Takes effect the next time the model is loaded.
+        """
+        with self._lock:
+            if placement is None:
+                self._placements.pop(model_name, None)
+                return
+            if placement != SPAN_ALL:
+                placement = tuple(sorted(set(placement)))
+                if not placement or not all(0 <= c < self.num_cores for c in placement):
+                    raise ValueError(f"Cores must be between 0 and {self.num_cores - 1}")
+            self._placements[model_name] = placement
+
+    def slots_for(self, model_name):
+        """Returns the core tuples model_name gets one runtime context for."""
+        placement = self._placements.get(model_name)
+        if placement is None:
+            size = self._size_fn(model_name) if self._size_fn else None
+            placement = SPAN_ALL if size is not None and size >= self.span_min_bytes else tuple(range(self.num_cores))
+        if placement == SPAN_ALL:
+            return [tuple(range(self.num_cores))]
+        return [(core,) for core in placement]
+
+    def concurrency(self, model_name):
+        """How many requests for model_name can run at the same time."""
+        return len(self.slots_for(model_name))
+
+    def _acquire_core(self, core, priority):
+        """Waits (holding self._lock) until core is idle and this is its most urgent waiter."""
+        ticket = (priority, next(self._arrivals))
+        heapq.heappush(core.waiters, ticket)
+        try:
+            while core.running or core.waiters[0] != ticket:
+                self._lock.wait()
+        except BaseException:
+            core.waiters.remove(ticket)
+            heapq.heapify(core.waiters)
+            self._lock.notify_all()
+            raise
+        heapq.heappop(core.waiters)
+        core.running += 1
+        core.utilization.start()
+
+    @contextmanager
+    def reserve(self, model_name, priority=DEFAULT_PRIORITY):
+        """
+        Waits until the least-loaded slot of model_name is free and holds its
+        cores for the duration of the block. Yields the slot (a tuple of cores).
+        """
+        level = PRIORITIES[priority]
+        slots = self.slots_for(model_name)
+        with self._lock:
+            # Only work at least as urgent as this request can delay it.
+            slot = min(slots, key=lambda s: (
+                sum(self._cores[c].running + sum(1 for p, _ in self._cores[c].waiters if p <= level) for c in s),
+                sum(self._cores[c].dispatched for c in s)))
+            # Cores are always taken in ascending order, so spanning requests cannot deadlock.
+            acquired = []
+            try:
+                for c in slot:
+                    self._acquire_core(self._cores[c], level)
+                    acquired.append(c)
+            except BaseException:
+                self._release_cores(acquired)
+                raise
+        try:
+            yield slot
+        finally:
+            with self._lock:
+                self._release_cores(slot, finished=True)
+
+    def _release_cores(self, slot, finished=False):
+        for c in slot:
+            core = self._cores[c]
+            core.running -= 1
+            core.utilization.stop()
+            if finished:
+                core.dispatched += 1
+        self._lock.notify_all()
+
+    def run(self, model_name, fn, priority=DEFAULT_PRIORITY):
+        """Calls fn(slot) on the least-loaded slot of model_name and returns its result."""
+        with self.reserve(model_name, priority) as slot:
+            return fn(slot)
+
+    def status(self):
+        with self._lock:
+            return {
+                "cores": [{
+                    "core": core.index,
+                    "busy": bool(core.running),
+                    "queue_depth": core.queued,
+                    "queue_depth_by_priority": {name: sum(1 for p, _ in core.waiters if p == level)
+                                                for name, level in PRIORITIES.items()},
+                    "dispatched": core.dispatched,
+                    "utilization_percent": core.utilization.percent()
+                } for core in self._cores],
+                "placements": {name: p if p == SPAN_ALL else list(p) for name, p in self._placements.items()}
+            }
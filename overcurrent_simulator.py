@@ -1,4 +1,5 @@
 
+import asyncio
 import requests
 import time
 import random
@@ -6,7 +7,7 @@ import random
 # URL of the Flask app's alert endpoint
 ALERT_URL = "http://localhost:5000/api/system/alert"
 
-def simulate_overcurrent_detection():
+def simulate_overcurrent_detection(http_session=None):
     """
     Simulates a microcontroller detecting an overcurrent and reporting it.
     """
@@ -25,7 +26,7 @@ def simulate_overcurrent_detection():
         }
         
         try:
-            response = requests.post(ALERT_URL, json=payload)
+            response = (http_session or requests).post(ALERT_URL, json=payload, timeout=2)
             response.raise_for_status() # Raise an exception for bad status codes
             print(f"Successfully sent overcurrent alert: {payload}")
         except requests.exceptions.RequestException as e:
@@ -33,6 +34,12 @@ def simulate_overcurrent_detection():
     else:
         print("No overcurrent detected in this cycle.")
 
+async def run_async(http_session=None):
+    """Runs the simulator as an asyncio task (see simulator_supervisor.py)."""
+    while True:
+        await asyncio.to_thread(simulate_overcurrent_detection, http_session)
+        await asyncio.sleep(5)
+
 if __name__ == "__main__":
     print("Starting overcurrent event simulator...")
     while True:
@@ -0,0 +1,137 @@
+# prefix_cache.py
+# This file caches the KV state produced by prefilling common prompt prefixes,
+# so a language model can resume decoding after a shared preamble instead of
+# re-encoding it on every request.
+#
+# Prefixes become cacheable in two ways: they are registered explicitly, or
+# they are detected automatically when the same leading lines show up in
+# several prompts. The KV states themselves live in a small LRU cache.
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+# --- Prefix Cache Configuration ---
+# Maximum number of prefix KV states kept in memory.
+PREFIX_CACHE_MAX_ENTRIES = int(os.environ.get('PREFIX_CACHE_MAX_ENTRIES', 16))
+# A prefix is cached automatically once it has been seen this many times.
+AUTO_PREFIX_MIN_REPEATS = int(os.environ.get('PREFIX_CACHE_MIN_REPEATS', 2))
+# Shorter prefixes are not worth caching.
+MIN_PREFIX_CHARS = 64
+# Automatic detection only considers prefixes ending at one of the first few line breaks.
+MAX_CANDIDATE_LINES = 8
+# Upper bound on how many candidate prefixes are being counted at once.
+MAX_TRACKED_CANDIDATES = 4096
+
+
+def prompt_text(input_data):
+    """Returns the prompt string of an inference input, or None if it has none."""
+    if isinstance(input_data, str):
+        return input_data
+    if isinstance(input_data, dict) and isinstance(input_data.get("prompt"), str):
+        return input_data["prompt"]
+    return None
+
+
+class PrefixKVCache:
+    """
+    Maps (model_name, prefix text) to the backend's KV state for that prefix.
+
+    The KV state is opaque here; it is whatever the backend's prefill()
+    returns. All entries for a model must be dropped when the model is
+    unloaded, since the states belong to its runtime context.
+    """
+
+    def __init__(self, max_entries=PREFIX_CACHE_MAX_ENTRIES, min_repeats=AUTO_PREFIX_MIN_REPEATS):
+        self.max_entries = max_entries
+        self.min_repeats = min_repeats
+        self._registered = {}
+        self._candidates = OrderedDict()
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.prefill_chars_saved = 0
+
+    def register(self, model_name, prefix):
+        """Marks a prefix as cacheable for model_name; its state is computed on first use."""
+        with self._lock:
+            self._registered.setdefault(model_name, set()).add(prefix)
+
+    def registered(self, model_name):
+        """Returns the prefixes registered for model_name."""
+        with self._lock:
+            return sorted(self._registered.get(model_name, ()))
+
+    def lookup(self, model_name, prompt):
+        """
+        Finds the longest cacheable prefix of prompt.
+
+        Returns (prefix, state): state is None if the prefix is cacheable but
+        has not been prefilled yet, and prefix is "" if nothing applies.
+        """
+        with self._lock:
+            self.lookups += 1
+            best = ""
+            for cached_model, prefix in self._states:
+                if cached_model == model_name and len(prefix) > len(best) and prompt.startswith(prefix):
+                    best = prefix
+            if best:
+                self._states.move_to_end((model_name, best))
+                self.hits += 1
+                self.prefill_chars_saved += len(best)
+                return best, self._states[(model_name, best)]
+
+            for prefix in self._registered.get(model_name, ()):
+                if len(prefix) > len(best) and prompt.startswith(prefix):
+                    best = prefix
+            detected = self._observe(model_name, prompt)
+            if len(detected) > len(best):
+                best = detected
+            return best, None
+
+    def put(self, model_name, prefix, state):
+        with self._lock:
+            self._states[(model_name, prefix)] = state
+            self._states.move_to_end((model_name, prefix))
+            while len(self._states) > self.max_entries:
+                self._states.popitem(last=False)
+
+    def invalidate(self, model_name):
+        """Drops every KV state belonging to model_name."""
+        with self._lock:
+            for key in [k for k in self._states if k[0] == model_name]:
+                del self._states[key]
+
+    def _observe(self, model_name, prompt):
+        """Counts the prompt's leading-line prefixes; returns the longest seen often enough."""
+        detected = ""
+        end = -1
+        for _ in range(MAX_CANDIDATE_LINES):
+            end = prompt.find("\n", end + 1)
+            if end == -1:
+                break
+            if end + 1 < MIN_PREFIX_CHARS:
+                continue
+            prefix = prompt[:end + 1]
+            key = (model_name, hashlib.blake2b(prefix.encode(), digest_size=8).digest())
+            count = self._candidates.pop(key, 0) + 1
+            self._candidates[key] = count
+            if count >= self.min_repeats:
+                detected = prefix
+        while len(self._candidates) > MAX_TRACKED_CANDIDATES:
+            self._candidates.popitem(last=False)
+        return detected
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._states),
+                "max_entries": self.max_entries,
+                "registered_prefixes": sum(len(p) for p in self._registered.values()),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                "prefill_chars_saved": self.prefill_chars_saved
+            }
@@ -0,0 +1,9 @@
+# prompts.py
+# Prompt text shared by the training data generator and the inference layer,
+# kept apart from both so the app does not import the generator (and its
+# dependencies) just to read a string.
+
+# --- Prompt Preamble ---
+# Every agent prompt starts with this text. The inference layer registers it
+# as a cacheable prefix, so it is only prefilled once per loaded model.
+AGENT_PROMPT_PREFIX = "USER: Assess system status and take necessary action.\nASSISTANT (thought): I need to check the status of the Orange Pi and the storage array. First, I will call the system health and NPU status APIs.\n"
@@ -0,0 +1,176 @@
+# result_cache.py
+# This file implements a content-addressed cache for NPU inference results.
+# Repeated (model, input) pairs are answered from memory instead of going
+# through Redis, a Celery worker and the NPU again.
+#
+# Results are stored by whoever computes them: the local executor fills the
+# in-process cache when a task finishes, and Celery workers write to a shared
+# tier in Redis, which every app process reads on a local miss. So the cache
+# fills whether or not a client polls for the result, and whichever process
+# serves the poll.
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# --- Cache Configuration ---
+CACHE_MAX_ENTRIES = int(os.environ.get('INFERENCE_CACHE_MAX_ENTRIES', 1024))
+CACHE_TTL_S = float(os.environ.get('INFERENCE_CACHE_TTL_S', 300))
+# Keys of the shared tier: <prefix><model>|<model version>|<input hash>.
+SHARED_KEY_PREFIX = "npu-result-cache:"
+
+
+def hash_input(input_data):
+    """Returns a stable hash of input_data, independent of dict key order."""
+    canonical = json.dumps(input_data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _shared_key(key):
+    return SHARED_KEY_PREFIX + "|".join(str(part) for part in key)
+
+
+class SharedResultStore:
+    """The Redis tier of the cache, written by Celery workers and read by every app process."""
+
+    def __init__(self, redis_url, ttl_s=CACHE_TTL_S):
+        self.redis_url = redis_url
+        self.ttl_s = ttl_s
+        self._client = None
+
+    def _redis(self):
+        import redis
+
+        if self._client is None:
+            self._client = redis.Redis.from_url(self.redis_url)
+        return self._client
+
+    def get(self, key):
+        raw = self._redis().get(_shared_key(key))
+        return None if raw is None else json.loads(raw)
+
+    def put(self, key, result):
+        self._redis().set(_shared_key(key), json.dumps(result), ex=max(1, int(self.ttl_s)))
+
+    def invalidate(self, model_name=None):
+        # Escape glob characters, so the pattern only matches this model's keys.
+        prefix = SHARED_KEY_PREFIX + ("" if model_name is None else re.sub(r'([*?\[\]\\])', r'\\\1', model_name) + "|")
+        client = self._redis()
+        keys = list(client.scan_iter(match=prefix + "*", count=500))
+        if keys:
+            client.delete(*keys)
+
+
+def is_cacheable(result):
+    """Only successful inference results are cached."""
+    return isinstance(result, dict) and "error" not in result
+
+
+class InferenceResultCache:
+    """
+    A size-bounded LRU cache with a TTL, keyed by
+    (model_name, model_version, hash(input_data)).
+
+    When a model is seen with a different file version than before, every
+    entry for that model is dropped, so results from the old file are never served.
+    With a shared store (see use_shared_store), local misses are looked up
+    there, and hits are copied into the local cache.
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl_s=CACHE_TTL_S):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.shared = None
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def use_shared_store(self, store):
+        self.shared = store
+
+    def make_key(self, model_name, model_version, input_data):
+        with self._lock:
+            if self._versions.get(model_name, model_version) != model_version:
+                self._invalidate_locked(model_name)
+            self._versions[model_name] = model_version
+        return (model_name, model_version, hash_input(input_data))
+
+    def get(self, key):
+        """Returns the cached result for key, or None on a miss or expired entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+        result = self._get_shared(key)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.shared_hits += 1
+        self.put(key, result)
+        return result
+
+    def _get_shared(self, key):
+        if self.shared is None:
+            return None
+        import redis
+
+        try:
+            return self.shared.get(key)
+        except redis.exceptions.RedisError:
+            return None
+
+    def put(self, key, result):
+        with self._lock:
+            if self._versions.get(key[0]) != key[1]:
+                # The model file changed while this result was being computed.
+                return
+            self._entries[key] = (time.monotonic() + self.ttl_s, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, model_name=None):
+        """Drops all entries for model_name, or everything when no model is given."""
+        with self._lock:
+            self._invalidate_locked(model_name)
+        if self.shared is not None:
+            import redis
+
+            try:
+                self.shared.invalidate(model_name)
+            except redis.exceptions.RedisError as e:
+                print(f"CACHE: Could not clear the shared result cache: {e}")
+
+    def _invalidate_locked(self, model_name):
+        if model_name is None:
+            self._entries.clear()
+            return
+        for key in [k for k in self._entries if k[0] == model_name]:
+            del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_s": self.ttl_s,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses
+            }
+
+
+# A single cache shared by all requests handled in this process.
+result_cache = InferenceResultCache()
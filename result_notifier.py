@@ -0,0 +1,95 @@
+# result_notifier.py
+# This file delivers task completion notifications to waiting HTTP requests.
+# A single background thread subscribes to the Redis result backend, so
+# waiting clients are woken up the moment their task finishes instead of
+# each one polling Redis on its own.
+
+import json
+import threading
+import time
+
+# Celery's Redis result backend publishes every state change on a channel
+# named after the result key.
+TASK_CHANNEL_PREFIX = "celery-task-meta-"
+READY_STATES = {"SUCCESS", "FAILURE", "REVOKED"}
+# How long to wait before reconnecting after the subscription drops.
+RECONNECT_DELAY_S = 2.0
+
+
+class TaskResultNotifier:
+    """
+    Lets request handlers block until a Celery task finishes.
+
+    The subscription thread is started lazily on the first wait(). If Redis
+    is unreachable, waits simply time out and callers fall back to reading
+    the result backend directly.
+    """
+
+    def __init__(self, redis_url):
+        self.redis_url = redis_url
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def wait(self, task_id, timeout, is_ready=None):
+        """
+        Blocks until task_id finishes or timeout seconds pass; returns True if notified.
+
+        is_ready is an optional callable checked once after subscribing, so a
+        task that finished just before the call is not missed.
+        """
+        self._ensure_started()
+        event = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(task_id, []).append(event)
+        try:
+            if is_ready is not None and is_ready():
+                return True
+            return event.wait(timeout)
+        finally:
+            with self._lock:
+                events = self._waiters.get(task_id, [])
+                if event in events:
+                    events.remove(event)
+                if not events:
+                    self._waiters.pop(task_id, None)
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen_forever, name="task-result-notifier", daemon=True)
+                self._thread.start()
+
+    def _notify(self, task_id):
+        with self._lock:
+            events = list(self._waiters.get(task_id, []))
+        for event in events:
+            event.set()
+
+    def _listen_forever(self):
+        import redis
+
+        while True:
+            try:
+                client = redis.Redis.from_url(self.redis_url)
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(TASK_CHANNEL_PREFIX + "*")
+                for message in pubsub.listen():
+                    self._handle_message(message)
+            except Exception as e:
+                print(f"NOTIFIER: Result subscription lost ({e}). Reconnecting in {RECONNECT_DELAY_S}s.")
+                time.sleep(RECONNECT_DELAY_S)
+
+    def _handle_message(self, message):
+        channel = message.get("channel")
+        if isinstance(channel, bytes):
+            channel = channel.decode()
+        if not channel or not channel.startswith(TASK_CHANNEL_PREFIX):
+            return
+        try:
+            status = json.loads(message["data"]).get("status")
+        except (ValueError, TypeError, AttributeError):
+            status = None
+        # Wake waiters on anything unparseable too; they re-check the backend anyway.
+        if status is None or status in READY_STATES:
+            self._notify(channel[len(TASK_CHANNEL_PREFIX):])
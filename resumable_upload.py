@@ -0,0 +1,190 @@
+# resumable_upload.py
+# This file implements resumable, chunked uploads into the storage folder.
+#
+# A client creates an upload for a destination path and total size, then
+# sends the file in chunks, each tagged with the offset it starts at. Chunks
+# are streamed straight to a staging file, so nothing is buffered in memory.
+# If the connection drops, the client asks for the current offset and
+# continues from there. Once the last byte arrives, the staging file is
+# fsync()ed and renamed over the destination in one atomic step.
+#
+# All state lives in the staging directory (the partial file and a small JSON
+# sidecar), so uploads survive app restarts and work across gunicorn workers.
+# After the rename the sidecar is kept for a while marked complete, so a
+# client that lost the final response can still confirm the upload finished.
+
+import errno
+import fcntl
+import json
+import os
+import time
+import uuid
+
+# --- Upload Configuration ---
+# Bytes copied from the request to disk per write.
+UPLOAD_COPY_CHUNK_BYTES = 1024 * 1024
+# Unfinished uploads untouched for this long are deleted (seconds).
+UPLOAD_STALE_S = float(os.environ.get('UPLOAD_STALE_S', 24 * 3600))
+# How long a finished upload can still be looked up (seconds).
+UPLOAD_COMPLETE_TTL_S = float(os.environ.get('UPLOAD_COMPLETE_TTL_S', 3600))
+# Name of the staging directory, created at the top of the storage tree (so
+# finished files are renamed within one filesystem) and hidden from the file APIs.
+STAGING_DIR_NAME = ".upload-staging"
+
+
+class UploadNotFound(KeyError):
+    pass
+
+
+class OffsetMismatch(ValueError):
+    """A chunk did not start where the upload currently ends."""
+
+    def __init__(self, offset):
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
+
+
+class UploadBusy(RuntimeError):
+    """Another request is writing to the same upload."""
+
+
+class ResumableUploads:
+    """
+    Upload sessions staged in staging_dir, which must be on the same
+    filesystem as the destinations so the final rename is atomic.
+    """
+
+    def __init__(self, staging_dir):
+        self.staging_dir = staging_dir
+
+    def _paths(self, upload_id):
+        if not upload_id or not all(c in "0123456789abcdef" for c in upload_id):
+            raise UploadNotFound(upload_id)
+        base = os.path.join(self.staging_dir, upload_id)
+        return base + ".part", base + ".json"
+
+    def create(self, destination, size):
+        """Starts an upload of size bytes to the absolute path destination; returns its id."""
+        os.makedirs(self.staging_dir, exist_ok=True)
+        self.remove_stale()
+        upload_id = uuid.uuid4().hex
+        part_path, meta_path = self._paths(upload_id)
+        open(part_path, 'wb').close()
+        with open(meta_path, 'w') as f:
+            json.dump({"destination": destination, "size": size, "created": time.time()}, f)
+        return upload_id
+
+    def status(self, upload_id):
+        """
+        Returns {"destination", "size", "offset", "complete"}; offset is how
+        many bytes have been received.
+        """
+        part_path, meta_path = self._paths(upload_id)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if not meta.get("complete"):
+                meta["offset"] = os.path.getsize(part_path)
+                meta["complete"] = False
+        except FileNotFoundError:
+            raise UploadNotFound(upload_id) from None
+        return meta
+
+    def append(self, upload_id, offset, stream):
+        """
+        Writes the bytes of stream (a file-like object) at offset, which must
+        be the upload's current offset. Returns the upload's status afterwards;
+        when the upload is complete the file has been moved to its destination.
+        """
+        meta = self.status(upload_id)
+        if meta["complete"]:
+            return self._completed(meta, offset)
+        part_path, meta_path = self._paths(upload_id)
+        try:
+            f = open(part_path, 'r+b')
+        except FileNotFoundError:
+            # Another request finished the upload in the meantime.
+            return self._completed(self.status(upload_id), offset)
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    raise UploadBusy(upload_id) from None
+                raise
+            done = self.status(upload_id)
+            if done["complete"]:
+                # Another request finished the upload while this one waited to open it.
+                return self._completed(done, offset)
+            current = os.fstat(f.fileno()).st_size
+            if offset != current:
+                raise OffsetMismatch(current)
+            f.seek(offset)
+            remaining = meta["size"] - offset
+            # A dropped connection ends the stream early; what arrived is kept.
+            while remaining > 0:
+                chunk = stream.read(min(UPLOAD_COPY_CHUNK_BYTES, remaining))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+            f.flush()
+            meta["offset"] = meta["size"] - remaining
+            if remaining == 0:
+                os.fsync(f.fileno())
+                os.makedirs(os.path.dirname(meta["destination"]), exist_ok=True)
+                os.replace(part_path, meta["destination"])
+                meta["complete"] = True
+                tmp_path = meta_path + ".tmp"
+                with open(tmp_path, 'w') as meta_file:
+                    json.dump(meta, meta_file)
+                os.replace(tmp_path, meta_path)
+        return meta
+
+    @staticmethod
+    def _completed(meta, offset):
+        # Resending the final chunk (after its response was lost) reports the
+        # finished upload; any other offset is out of date.
+        if offset != meta["size"]:
+            raise OffsetMismatch(meta["size"])
+        return meta
+
+    def cancel(self, upload_id):
+        part_path, meta_path = self._paths(upload_id)
+        found = False
+        for path in (part_path, meta_path):
+            try:
+                os.remove(path)
+                found = True
+            except FileNotFoundError:
+                pass
+        if not found:
+            raise UploadNotFound(upload_id)
+
+    def remove_stale(self):
+        """
+        Deletes unfinished uploads that have not received any data for
+        UPLOAD_STALE_S, and completion records older than UPLOAD_COMPLETE_TTL_S.
+        A record of an unfinished upload whose .part file is gone (left by a
+        crash between the final rename and rewriting the record) is deleted
+        like a completion record.
+        """
+        now = time.time()
+        try:
+            entries = list(os.scandir(self.staging_dir))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            upload_id, ext = os.path.splitext(entry.name)
+            try:
+                if ext == ".part" and entry.stat().st_mtime < now - UPLOAD_STALE_S:
+                    self.cancel(upload_id)
+                elif ext == ".json" and entry.stat().st_mtime < now - UPLOAD_COMPLETE_TTL_S:
+                    try:
+                        expired = self.status(upload_id)["complete"]
+                    except UploadNotFound:
+                        expired = True
+                    if expired:
+                        self.cancel(upload_id)
+            except (FileNotFoundError, UploadNotFound):
+                pass
@@ -0,0 +1,444 @@
+# search_index.py
+# This file keeps a searchable index of every file and folder under the
+# storage tree, so finding files by name, extension, size or age never walks
+# (and spins up) the array's disks.
+#
+# The index is an SQLite database outside the storage tree, with a full-text
+# (trigram) index on names for substring search. It is built once by a
+# parallel directory walker and then kept current from inotify events: every
+# directory is watched, and only the paths an event names are stat()ed again.
+# If the kernel's event queue overflows, the index is rebuilt. Readers keep
+# searching the previous index while a rebuild runs (SQLite WAL mode).
+#
+# Only one process per host maintains the index (whichever holds the lock
+# file); every process can search it.
+
+import ctypes
+import ctypes.util
+import fcntl
+import os
+import select
+import sqlite3
+import struct
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# --- Index Configuration ---
+SEARCH_INDEX_PATH = os.environ.get('SEARCH_INDEX_PATH', os.path.abspath("search_index.sqlite3"))
+# Directories scanned in parallel while building the index.
+SEARCH_INDEX_WALK_THREADS = int(os.environ.get('SEARCH_INDEX_WALK_THREADS', 8))
+# An index older than this is rebuilt on startup, to pick up changes made
+# while nothing was watching (seconds).
+SEARCH_INDEX_MAX_AGE_S = float(os.environ.get('SEARCH_INDEX_MAX_AGE_S', 24 * 3600))
+# Rows written per transaction while building.
+BUILD_BATCH_ROWS = 5000
+DEFAULT_SEARCH_LIMIT = 100
+MAX_SEARCH_LIMIT = 1000
+SEARCH_SORT_COLUMNS = {"name": "files.name COLLATE NOCASE", "size": "files.size", "modified": "files.mtime",
+                       "path": "files.path"}
+
+# --- inotify ---
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+_EVENT_HEADER = struct.Struct("iIII")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    ext TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_ext ON files (ext);
+CREATE INDEX IF NOT EXISTS files_size ON files (size);
+CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime);
+CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5 (name, content='files', content_rowid='id',
+                                                         tokenize='trigram');
+"""
+
+# Keep the full-text index in step with the files table (external content).
+TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS files_ai AFTER INSERT ON files BEGIN
+           INSERT INTO files_fts (rowid, name) VALUES (new.id, new.name);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS files_ad AFTER DELETE ON files BEGIN
+           INSERT INTO files_fts (files_fts, rowid, name) VALUES ('delete', old.id, old.name);
+       END"""
+]
+DROP_TRIGGERS = ["DROP TRIGGER IF EXISTS files_ai", "DROP TRIGGER IF EXISTS files_ad"]
+INSERT_ROWS = "INSERT OR REPLACE INTO files (path, name, ext, is_dir, size, mtime) VALUES (?, ?, ?, ?, ?, ?)"
+
+
+class _Inotify:
+    """A minimal inotify wrapper (Linux only) that maps watch descriptors to directories."""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}
+        self._lock = threading.Lock()
+
+    def add(self, directory):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            return ctypes.get_errno()
+        with self._lock:
+            self.paths[wd] = directory
+        return 0
+
+    def remove_tree(self, directory):
+        """Stops watching directory and everything below it."""
+        with self._lock:
+            wds = [wd for wd, path in self.paths.items() if path == directory or path.startswith(directory + os.sep)]
+            for wd in wds:
+                del self.paths[wd]
+        for wd in wds:
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    def close(self):
+        os.close(self.fd)
+
+    def read(self, timeout):
+        """Returns [(mask, absolute path)] for the events that arrived within timeout."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            buffer = os.read(self.fd, 1024 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b"\0")
+            offset += length
+            with self._lock:
+                directory = self.paths.get(wd) if not mask & IN_IGNORED else self.paths.pop(wd, None)
+            if mask & IN_Q_OVERFLOW:
+                events.append((mask, None))
+            elif directory is not None and name:
+                events.append((mask, os.path.join(directory, os.fsdecode(name))))
+        return events
+
+
+def _extension(name):
+    return os.path.splitext(name)[1][1:].lower()
+
+
+class StorageSearchIndex:
+    """Builds, maintains and queries the search index of the tree under root."""
+
+    def __init__(self, root, db_path=SEARCH_INDEX_PATH, excluded=()):
+        self.root = os.path.abspath(root)
+        self.db_path = db_path
+        # Paths (with everything below them) kept out of the index, e.g. internal staging directories.
+        self.excluded = tuple(os.path.abspath(path) for path in excluded)
+        self._local = threading.local()
+        self._start_lock = threading.Lock()
+        self._lock_file = None
+        self._last_start_attempt = None
+        self._thread = None
+        self._inotify = None
+        # Set once the index has been built; it stays built from then on.
+        self._ready = False
+        self.watch_errors = 0
+        self.building = False
+
+    # --- Maintenance (in the process that holds the lock file) ---
+    def start(self):
+        """
+        Starts maintaining the index in a background thread, unless another
+        process already does. Cheap to call often; retries at most every 30s.
+        """
+        with self._start_lock:
+            if self._thread is not None or (self._last_start_attempt is not None and
+                                            time.monotonic() - self._last_start_attempt < 30):
+                return
+            self._last_start_attempt = time.monotonic()
+            lock_file = open(self.db_path + ".lock", 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return
+            self._lock_file = lock_file
+            self._thread = threading.Thread(target=self._maintain, name="search-index", daemon=True)
+            self._thread.start()
+
+    def _writer(self):
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # So rows replaced by INSERT OR REPLACE also leave the full-text index.
+        conn.execute("PRAGMA recursive_triggers=ON")
+        conn.executescript(SCHEMA)
+        for statement in TRIGGERS:
+            conn.execute(statement)
+        return conn
+
+    def _maintain(self):
+        conn = None
+        try:
+            conn = self._writer()
+            try:
+                self._inotify = _Inotify()
+            except (OSError, AttributeError) as e:
+                print(f"SEARCH INDEX: inotify is unavailable ({e}); the index is only rebuilt on startup.")
+            meta = dict(conn.execute("SELECT key, value FROM meta"))
+            fresh = meta.get("root") == self.root and \
+                time.time() - float(meta.get("built_at", 0)) < SEARCH_INDEX_MAX_AGE_S
+            if fresh:
+                # Reuse the index; only the directories need watching again.
+                self._watch(self.root)
+                for (path,) in conn.execute("SELECT path FROM files WHERE is_dir = 1"):
+                    self._watch(self.root + path)
+            else:
+                self.rebuild(conn)
+        except Exception as e:
+            # Hand maintenance back, so this or another process retries from start().
+            print(f"SEARCH INDEX: Could not build the index ({e}).")
+            self._stop(conn)
+            return
+        if self._inotify is None:
+            return
+        while True:
+            events = self._inotify.read(timeout=60)
+            try:
+                if any(path is None for _, path in events):
+                    print("SEARCH INDEX: inotify queue overflowed; rebuilding the index.")
+                    self.rebuild(conn)
+                elif events:
+                    self._apply(conn, events)
+            except Exception as e:
+                print(f"SEARCH INDEX: Could not update the index ({e}).")
+
+    def _stop(self, conn):
+        if conn is not None:
+            conn.close()
+        with self._start_lock:
+            if self._inotify is not None:
+                self._inotify.close()
+                self._inotify = None
+            # Closing the lock file releases the lock.
+            self._lock_file.close()
+            self._lock_file = None
+            self._thread = None
+
+    def _watch(self, directory):
+        if self._inotify is None:
+            return
+        error = self._inotify.add(directory)
+        if error:
+            self.watch_errors += 1
+            if self.watch_errors == 1:
+                print(f"SEARCH INDEX: Could not watch {directory} ({os.strerror(error)}); raise "
+                      "fs.inotify.max_user_watches to keep the whole tree current.")
+
+    def _is_excluded(self, path):
+        return any(path == excluded or path.startswith(excluded + os.sep) for excluded in self.excluded)
+
+    def _scan(self, directory):
+        """Returns (rows, subdirectories) for one directory; watches it first so no change is missed."""
+        self._watch(directory)
+        rows, subdirs = [], []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if self._is_excluded(entry.path):
+                        continue
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    rows.append(("/" + os.path.relpath(entry.path, self.root), entry.name,
+                                 "" if is_dir else _extension(entry.name), int(is_dir), st.st_size, st.st_mtime))
+                    if is_dir:
+                        subdirs.append(entry.path)
+        except OSError:
+            pass
+        return rows, subdirs
+
+    def _walk(self, directory):
+        """Yields batches of rows for everything below directory, scanning directories in parallel."""
+        with ThreadPoolExecutor(max_workers=SEARCH_INDEX_WALK_THREADS) as pool:
+            pending = {pool.submit(self._scan, directory)}
+            batch = []
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    rows, subdirs = future.result()
+                    batch.extend(rows)
+                    pending.update(pool.submit(self._scan, subdir) for subdir in subdirs)
+                if len(batch) >= BUILD_BATCH_ROWS:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+    def rebuild(self, conn):
+        """Re-walks the whole tree. Searches keep using the previous index until it is committed."""
+        self.building = True
+        started = time.monotonic()
+        count = 0
+        os.makedirs(self.root, exist_ok=True)
+        conn.execute("BEGIN")
+        try:
+            # Bulk load without the per-row full-text triggers, then index every name at once.
+            for statement in DROP_TRIGGERS:
+                conn.execute(statement)
+            conn.execute("DELETE FROM files")
+            conn.execute("INSERT INTO files_fts (files_fts) VALUES ('delete-all')")
+            for batch in self._walk(self.root):
+                conn.executemany(INSERT_ROWS, batch)
+                count += len(batch)
+            conn.execute("INSERT INTO files_fts (files_fts) VALUES ('rebuild')")
+            for statement in TRIGGERS:
+                conn.execute(statement)
+            conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                             [("root", self.root), ("built_at", str(time.time()))])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            self.building = False
+        print(f"SEARCH INDEX: Indexed {count} entries under {self.root} in {time.monotonic() - started:.1f}s.")
+
+    def _delete_tree(self, conn, path):
+        rel = "/" + os.path.relpath(path, self.root)
+        # Everything below rel sorts between rel + "/" and rel + "0" ("0" follows "/").
+        conn.execute("DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)", (rel, rel + "/", rel + "0"))
+
+    def _apply(self, conn, events):
+        """Applies a batch of inotify events in one transaction."""
+        conn.execute("BEGIN")
+        try:
+            for mask, path in events:
+                if self._is_excluded(path):
+                    continue
+                if mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._delete_tree(conn, path)
+                    if mask & IN_ISDIR and self._inotify is not None:
+                        self._inotify.remove_tree(path)
+                    continue
+                try:
+                    st = os.lstat(path)
+                except FileNotFoundError:
+                    # Already gone again; a later event in this batch removes it.
+                    continue
+                name = os.path.basename(path)
+                is_dir = bool(mask & IN_ISDIR)
+                new_dir = is_dir and mask & (IN_CREATE | IN_MOVED_TO)
+                if new_dir:
+                    # Drop whatever was indexed under this path before.
+                    self._delete_tree(conn, path)
+                conn.execute(INSERT_ROWS, ("/" + os.path.relpath(path, self.root), name,
+                                           "" if is_dir else _extension(name), int(is_dir), st.st_size, st.st_mtime))
+                if new_dir:
+                    # A new or moved-in directory: index (and watch) everything below it.
+                    for batch in self._walk(path):
+                        conn.executemany(INSERT_ROWS, batch)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    # --- Queries (any process) ---
+    def _reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if not os.path.exists(self.db_path):
+                return None
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            conn.execute("PRAGMA query_only=ON")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def status(self):
+        conn = self._reader()
+        try:
+            meta = dict(conn.execute("SELECT key, value FROM meta")) if conn is not None else {}
+        except sqlite3.OperationalError:
+            meta = {}  # The maintainer has not created the schema yet.
+        built_at = meta.get("built_at")
+        return {
+            "ready": built_at is not None,
+            "built_at": float(built_at) if built_at else None,
+            "maintained_here": self._thread is not None,
+            "building": self.building,
+            "watch_errors": self.watch_errors
+        }
+
+    def search(self, text=None, ext=None, entry_type=None, min_size=None, max_size=None, min_age_s=None,
+               max_age_s=None, under=None, sort="name", descending=False, limit=DEFAULT_SEARCH_LIMIT):
+        """
+        Returns matching entries as dicts with name, path, is_dir, size and
+        modified, or None if the index has not been built yet. text matches
+        anywhere in the name (case-insensitive); under restricts results to a
+        folder (an API path such as '/photos').
+        """
+        conn = self._reader()
+        if conn is None:
+            return None
+        if not self._ready:
+            self._ready = self.status()["ready"]
+            if not self._ready:
+                return None
+        clauses, params = [], []
+        if text:
+            if len(text) >= 3:
+                # The trigram index answers substring matches of three or more characters.
+                clauses.append("files.id IN (SELECT rowid FROM files_fts WHERE files_fts MATCH ?)")
+                params.append('"' + text.replace('"', '""') + '"')
+            else:
+                clauses.append("files.name LIKE ? ESCAPE '\\'")
+                params.append("%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+        if ext is not None:
+            clauses.append("files.ext = ?")
+            params.append(ext.lstrip(".").lower())
+        if entry_type is not None:
+            clauses.append("files.is_dir = ?")
+            params.append(int(entry_type == "dir"))
+        for column, op, value in (("size", ">=", min_size), ("size", "<=", max_size)):
+            if value is not None:
+                clauses.append(f"files.{column} {op} ?")
+                params.append(value)
+        now = time.time()
+        if min_age_s is not None:
+            clauses.append("files.mtime <= ?")
+            params.append(now - min_age_s)
+        if max_age_s is not None:
+            clauses.append("files.mtime >= ?")
+            params.append(now - max_age_s)
+        if under is not None and under.strip("/"):
+            prefix = "/" + under.strip("/")
+            clauses.append("files.path >= ? AND files.path < ?")
+            params.extend([prefix + "/", prefix + "0"])
+
+        query = "SELECT name, path, is_dir, size, mtime FROM files"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += f" ORDER BY {SEARCH_SORT_COLUMNS[sort]} {'DESC' if descending else 'ASC'} LIMIT ?"
+        params.append(limit)
+        return [{"name": row["name"], "path": row["path"], "is_dir": bool(row["is_dir"]), "size": row["size"],
+                 "modified": row["mtime"]} for row in conn.execute(query, params)]
@@ -0,0 +1,146 @@
+# shared_state.py
+# This file provides the system state (temperature, fan speed, diode and
+# power supply state) as a fixed-layout shared-memory segment, so every
+# gunicorn worker reads and writes the same values.
+#
+# Reads are lock-free and use a seqlock: the writer makes the sequence number
+# odd while it updates the fields and even again when it is done, and a reader
+# retries whenever the sequence changed (or was odd) while it was reading.
+# Writers serialize on a file lock, which the kernel releases if a writer dies.
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+# --- Shared State Configuration ---
+_DEFAULT_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else "/tmp"
+SHARED_STATE_PATH = os.environ.get("SYSTEM_STATE_SHM", os.path.join(_DEFAULT_DIR, "tessr_system_state"))
+
+# --- Segment Layout ---
+# offset 0: sequence number (u64), offset 8: magic (u64), offset 16: fields.
+_SEQ = struct.Struct("<Q")
+_MAGIC = struct.Struct("<Q")
+_MAGIC_VALUE = 0x5445535352535431  # "TESSRST1"
+_FIELDS = struct.Struct("<diBB")  # temperature_c, fan_speed_percent, diode_on, power_on
+_FIELDS_OFFSET = 16
+SEGMENT_SIZE = 64
+
+KEYS = ("temperature_c", "fan_speed_percent", "diode_state", "power_supply_state")
+# A reader that sees an odd sequence this many times assumes the writer died.
+_MAX_SPINS = 10000
+
+
+def _encode(state):
+    return (float(state["temperature_c"]), int(state["fan_speed_percent"]),
+            state["diode_state"] == "on", state["power_supply_state"] == "on")
+
+
+def _decode(fields):
+    temperature_c, fan_speed_percent, diode_on, power_on = fields
+    return {
+        "temperature_c": temperature_c,
+        "fan_speed_percent": fan_speed_percent,
+        "diode_state": "on" if diode_on else "off",
+        "power_supply_state": "on" if power_on else "off"
+    }
+
+
+class SharedSystemState(MutableMapping):
+    """
+    A dict-like view of the shared system state.
+
+    Item reads and writes behave like the plain dict they replace, and
+    update() changes several fields in a single atomic step. The segment is
+    created and filled with `defaults` by the first process that opens it.
+    """
+
+    def __init__(self, defaults, path=SHARED_STATE_PATH):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._write_lock():
+            if os.fstat(self._fd).st_size < SEGMENT_SIZE:
+                os.ftruncate(self._fd, SEGMENT_SIZE)
+            self._mm = mmap.mmap(self._fd, SEGMENT_SIZE)
+            if _MAGIC.unpack_from(self._mm, 8)[0] != _MAGIC_VALUE:
+                _SEQ.pack_into(self._mm, 0, 0)
+                _FIELDS.pack_into(self._mm, _FIELDS_OFFSET, *_encode(defaults))
+                _MAGIC.pack_into(self._mm, 8, _MAGIC_VALUE)
+
+    # --- Locking ---
+    @contextmanager
+    def _write_lock(self):
+        # flock is per open file, so threads in this process need their own lock too.
+        with self._thread_lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    # --- Reads ---
+    def snapshot(self):
+        """Returns a consistent copy of all fields as a plain dict."""
+        for _ in range(_MAX_SPINS):
+            seq = _SEQ.unpack_from(self._mm, 0)[0]
+            if seq & 1:
+                time.sleep(0)
+                continue
+            fields = _FIELDS.unpack_from(self._mm, _FIELDS_OFFSET)
+            if _SEQ.unpack_from(self._mm, 0)[0] == seq:
+                return _decode(fields)
+        # A writer died mid-update; its lock is gone, so repair under the lock.
+        with self._write_lock():
+            seq = _SEQ.unpack_from(self._mm, 0)[0]
+            if seq & 1:
+                _SEQ.pack_into(self._mm, 0, seq + 1)
+            return _decode(_FIELDS.unpack_from(self._mm, _FIELDS_OFFSET))
+
+    def __getitem__(self, key):
+        if key not in KEYS:
+            raise KeyError(key)
+        return self.snapshot()[key]
+
+    def __iter__(self):
+        return iter(KEYS)
+
+    def __len__(self):
+        return len(KEYS)
+
+    # --- Writes ---
+    def update(self, *args, **kwargs):
+        changes = dict(*args, **kwargs)
+        unknown = set(changes) - set(KEYS)
+        if unknown:
+            raise KeyError(", ".join(sorted(unknown)))
+        with self._write_lock():
+            seq = _SEQ.unpack_from(self._mm, 0)[0] | 1  # also recovers from a dead writer
+            state = _decode(_FIELDS.unpack_from(self._mm, _FIELDS_OFFSET))
+            state.update(changes)
+            fields = _encode(state)
+            _SEQ.pack_into(self._mm, 0, seq)
+            _FIELDS.pack_into(self._mm, _FIELDS_OFFSET, *fields)
+            _SEQ.pack_into(self._mm, 0, seq + 1)
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def __delitem__(self, key):
+        raise TypeError("System state fields cannot be deleted")
+
+    def reset(self, defaults):
+        """Overwrites every field with defaults."""
+        self.update(defaults)
+
+
+def remove_segment(path=SHARED_STATE_PATH):
+    """Deletes the shared segment, so the next process to open it starts from defaults."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,79 @@
+# simulator_supervisor.py
+# This script runs every hardware simulator and controller as an asyncio task
+# in one process, instead of one Python interpreter each.
+#
+# All HTTP simulators share a single keep-alive session. If a simulator
+# crashes, it is restarted after a back-off that grows with repeated
+# failures and resets once it has run for a while.
+#
+# Usage:
+#     python simulator_supervisor.py                  # everything
+#     python simulator_supervisor.py temperature fan  # a subset
+
+import asyncio
+import importlib
+import sys
+import time
+import traceback
+
+# Simulator name -> module with an async run_async(http_session) entry point.
+# Modules are imported when the supervisor starts, not when this file is imported.
+SIMULATORS = {
+    "overcurrent": "overcurrent_simulator",
+    "temperature": "temperature_simulator",
+    "fan": "fan_controller",
+    "diode": "diode_controller"
+}
+
+# Restart back-off (seconds): doubles after each failure up to the maximum.
+RESTART_MIN_DELAY_S = 1.0
+RESTART_MAX_DELAY_S = 30.0
+# A simulator that ran at least this long before failing restarts quickly again.
+HEALTHY_RUN_S = 60.0
+
+
+async def supervise(name, run, http_session):
+    """Runs one simulator forever, restarting it whenever it exits or fails."""
+    delay = RESTART_MIN_DELAY_S
+    while True:
+        started = time.monotonic()
+        try:
+            await run(http_session)
+            print(f"SUPERVISOR: {name} exited.")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            print(f"SUPERVISOR: {name} failed:\n{traceback.format_exc()}")
+        if time.monotonic() - started >= HEALTHY_RUN_S:
+            delay = RESTART_MIN_DELAY_S
+        print(f"SUPERVISOR: Restarting {name} in {delay:.1f}s.")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, RESTART_MAX_DELAY_S)
+
+
+async def run_all(names=None):
+    names = names or list(SIMULATORS)
+    unknown = [name for name in names if name not in SIMULATORS]
+    if unknown:
+        raise ValueError(f"Unknown simulators: {', '.join(unknown)}. Choose from: {', '.join(SIMULATORS)}")
+
+    import temperature_simulator
+    # One pooled keep-alive session for every simulator that talks HTTP.
+    http_session = temperature_simulator.make_session()
+    runners = {name: importlib.import_module(SIMULATORS[name]).run_async for name in names}
+    print(f"SUPERVISOR: Running {', '.join(names)}.")
+    try:
+        await asyncio.gather(*(supervise(name, run, http_session) for name, run in runners.items()))
+    finally:
+        http_session.close()
+
+
+def main():
+    try:
+        asyncio.run(run_all(sys.argv[1:]))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+# slm_benchmark.py
+# This script is a load-generation benchmark built from the SLM simulator's
+# scenarios. It runs N concurrent virtual agents, each repeatedly picking a
+# scenario from a weighted mix and issuing its API calls, then reports
+# throughput and latency percentiles per endpoint and saves them as JSON so
+# runs can be compared across commits.
+#
+# The telemetry and actuator scenarios post temperatures and set the fan on
+# the box under test, so they only run with --allow-actuation.
+#
+# Usage:
+#     python slm_benchmark.py --agents 16 --duration 60 --output bench.json
+#     python slm_benchmark.py --mix status=3,inference=2,files=1 --output bench.json
+#     python slm_benchmark.py --allow-actuation --seed 1 --output bench.json
+#     python slm_benchmark.py --compare before.json after.json
+
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import requests
+
+# --- Configuration ---
+BASE_URL = os.environ.get("SLM_BASE_URL", f"http://127.0.0.1:{os.environ.get('PORT', 3177)}")
+DEFAULT_MIX = "status=4,inference=2,files=1"
+# Scenarios that change the system's state, and their share of the default mix when allowed.
+ACTUATING_SCENARIOS = ("telemetry", "actuators")
+ACTUATION_MIX = "telemetry=3,actuators=1"
+# Longest an agent waits for one inference result before counting it as an error.
+INFERENCE_TIMEOUT_S = 30.0
+
+# Histogram bucket upper bounds in milliseconds (the last bucket is open-ended).
+HISTOGRAM_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+class EndpointStats:
+    """Collects latencies and error counts for one endpoint."""
+
+    def __init__(self):
+        self.latencies_ms = []
+        self.errors = 0
+        self.status_codes = defaultdict(int)
+
+    def summary(self, elapsed_s):
+        lat = sorted(self.latencies_ms)
+        count = len(lat)
+
+        def percentile(p):
+            if not lat:
+                return None
+            return round(lat[min(count - 1, max(0, math.ceil(p / 100 * count) - 1))], 3)
+
+        histogram = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+        for value in lat:
+            histogram[next((i for i, bound in enumerate(HISTOGRAM_BUCKETS_MS) if value <= bound), -1)] += 1
+        return {
+            "requests": count,
+            "errors": self.errors,
+            "throughput_rps": round(count / elapsed_s, 3) if elapsed_s else 0.0,
+            "mean_ms": round(sum(lat) / count, 3) if count else None,
+            "p50_ms": percentile(50),
+            "p95_ms": percentile(95),
+            "p99_ms": percentile(99),
+            "max_ms": round(lat[-1], 3) if lat else None,
+            "histogram_ms": {"buckets": HISTOGRAM_BUCKETS_MS, "counts": histogram},
+            "status_codes": dict(self.status_codes)
+        }
+
+
+class VirtualAgent:
+    """One simulated SLM agent with its own keep-alive session and random generator."""
+
+    def __init__(self, agent_id, base_url, record, rng=None):
+        self.agent_id = agent_id
+        self.base_url = base_url
+        self.session = requests.Session()
+        self.rng = rng or random.Random()
+        self._record = record
+
+    def call(self, method, path, name=None, ok_statuses=(200,), **kwargs):
+        """Issues one request and records its latency under `name` (default: method and path without query)."""
+        name = name or f"{method} {path.split('?')[0]}"
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=INFERENCE_TIMEOUT_S, **kwargs)
+        except requests.exceptions.RequestException:
+            self._record(name, (time.perf_counter() - start) * 1000, None)
+            return None
+        self._record(name, (time.perf_counter() - start) * 1000, response.status_code,
+                     error=response.status_code not in ok_statuses)
+        return response
+
+    # --- Scenarios (mirroring slm_simulator.py) ---
+    def scenario_status(self):
+        """The SLM asks for the system's hardware status."""
+        self.call("GET", "/api/system/disks", ok_statuses=(200, 304))
+        self.call("GET", "/api/npu/status")
+        self.call("GET", "/api/system/health")
+
+    def scenario_telemetry(self):
+        """A sensor reports a temperature; the SLM checks fan state and history."""
+        self.call("POST", "/api/system/temperature", json={"temperature_c": 55.0 + self.rng.uniform(0, 5)})
+        self.call("GET", "/api/system/fan")
+        self.call("GET", "/api/system/telemetry/history?metric=temperature_c&buckets=60")
+
+    def scenario_actuators(self):
+        """The SLM reads and sets actuator state."""
+        self.call("GET", "/api/system/diode")
+        self.call("GET", "/api/power/array")
+        self.call("POST", "/api/system/fan", json={"speed": self.rng.choice([0, 30, 60])})
+
+    def scenario_inference(self):
+        """The SLM runs an inference and waits for its result."""
+        start = time.perf_counter()
+        response = self.call("POST", "/api/npu/inference", ok_statuses=(200, 202), json={
+            "model_name": self.rng.choice(["yolov5s", "resnet18"]),
+            "input_data": {"frame": self.rng.randint(0, 1000)}
+        })
+        ok = response is not None and response.status_code in (200, 202)
+        if ok and response.status_code == 202:
+            task_id = response.json()["task_id"]
+            deadline = time.perf_counter() + INFERENCE_TIMEOUT_S
+            while True:
+                result = self.call("GET", f"/api/npu/result/{task_id}?wait=5",
+                                   name="GET /api/npu/result/<task_id>", ok_statuses=(200, 202))
+                if result is None or result.status_code != 202:
+                    ok = result is not None and result.status_code == 200
+                    break
+                if time.perf_counter() > deadline:
+                    ok = False
+                    break
+        # End-to-end time from submission to result, including queueing.
+        self._record("inference end-to-end", (time.perf_counter() - start) * 1000, 200 if ok else None, error=not ok)
+
+    def scenario_files(self):
+        """The SLM creates, browses, renames and deletes a folder."""
+        folder = f"/bench-{self.agent_id}-{uuid.uuid4().hex[:8]}"
+        self.call("POST", "/api/files/folder", ok_statuses=(200, 201), json={"path": folder})
+        self.call("GET", "/api/files/browse?path=/")
+        self.call("PUT", "/api/files/manage", json={"path": folder, "destination": folder + "-renamed"})
+        self.call("DELETE", "/api/files/manage", json={"path": folder + "-renamed"})
+
+
+SCENARIOS = {
+    "status": VirtualAgent.scenario_status,
+    "telemetry": VirtualAgent.scenario_telemetry,
+    "actuators": VirtualAgent.scenario_actuators,
+    "inference": VirtualAgent.scenario_inference,
+    "files": VirtualAgent.scenario_files
+}
+
+
+def parse_mix(text, allow_actuation=False):
+    """Parses 'status=3,inference=1' into {'status': 3.0, 'inference': 1.0}."""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise ValueError(f"Unknown scenario '{name}'. Choose from: {', '.join(SCENARIOS)}")
+        if name in ACTUATING_SCENARIOS and not allow_actuation:
+            raise ValueError(f"Scenario '{name}' changes the system's state; pass --allow-actuation to run it.")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(base_url=BASE_URL, agents=8, duration_s=30.0, mix=None, seed=None):
+    """Runs the benchmark and returns the results dict."""
+    mix = mix or parse_mix(DEFAULT_MIX)
+    stats = defaultdict(EndpointStats)
+    scenario_counts = defaultdict(int)
+    lock = threading.Lock()
+
+    def record(name, latency_ms, status_code, error=False):
+        with lock:
+            endpoint = stats[name]
+            if status_code is None or error:
+                endpoint.errors += 1
+            if status_code is not None:
+                endpoint.latencies_ms.append(latency_ms)
+                endpoint.status_codes[str(status_code)] += 1
+
+    names, weights = list(mix), list(mix.values())
+    stop_at = time.perf_counter() + duration_s
+
+    def agent_loop(agent_id):
+        rng = random.Random(None if seed is None else f"{seed}:{agent_id}")
+        agent = VirtualAgent(agent_id, base_url, record, rng)
+        while time.perf_counter() < stop_at:
+            name = rng.choices(names, weights)[0]
+            SCENARIOS[name](agent)
+            with lock:
+                scenario_counts[name] += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=agent_loop, args=(i,), daemon=True) for i in range(agents)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    endpoints = {name: s.summary(elapsed) for name, s in sorted(stats.items())}
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "base_url": base_url,
+        "agents": agents,
+        "duration_s": round(elapsed, 3),
+        "mix": mix,
+        "scenarios_run": dict(scenario_counts),
+        "total_requests": sum(e["requests"] for e in endpoints.values()),
+        "total_throughput_rps": round(sum(e["requests"] for e in endpoints.values()) / elapsed, 3),
+        "endpoints": endpoints
+    }
+
+
+def print_report(results):
+    print("\n" + "=" * 100)
+    print(f"--- Benchmark: {results['agents']} agents, {results['duration_s']}s, commit {results['commit']} ---")
+    print("=" * 100)
+    print(f"{'endpoint':<44}{'reqs':>7}{'errs':>6}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, e in results["endpoints"].items():
+        def fmt(v):
+            return "-" if v is None else f"{v:.1f}"
+        print(f"{name:<44}{e['requests']:>7}{e['errors']:>6}{e['throughput_rps']:>9.1f}"
+              f"{fmt(e['p50_ms']):>9}{fmt(e['p95_ms']):>9}{fmt(e['p99_ms']):>9}")
+    print(f"\nTotal: {results['total_requests']} requests, {results['total_throughput_rps']:.1f} req/s")
+
+
+def compare(before_path, after_path):
+    """Prints per-endpoint throughput and p95 changes between two saved runs."""
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"Comparing {before.get('commit')} -> {after.get('commit')}")
+    print(f"{'endpoint':<44}{'rps before':>11}{'rps after':>11}{'p95 before':>12}{'p95 after':>11}{'p95 change':>12}")
+    for name in sorted(set(before["endpoints"]) | set(after["endpoints"])):
+        b, a = before["endpoints"].get(name, {}), after["endpoints"].get(name, {})
+        b95, a95 = b.get("p95_ms"), a.get("p95_ms")
+        change = f"{(a95 - b95) / b95 * 100:+.1f}%" if b95 and a95 is not None else "-"
+        print(f"{name:<44}{b.get('throughput_rps', 0):>11.1f}{a.get('throughput_rps', 0):>11.1f}"
+              f"{b95 if b95 is not None else '-':>12}{a95 if a95 is not None else '-':>11}{change:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent load benchmark built from the SLM simulator scenarios.")
+    parser.add_argument("--base-url", default=BASE_URL)
+    parser.add_argument("--agents", type=int, default=8, help="Number of concurrent virtual agents.")
+    parser.add_argument("--duration", type=float, default=30.0, help="Run time in seconds.")
+    parser.add_argument("--mix", help=f"Weighted scenario mix (default: {DEFAULT_MIX}, "
+                                      f"plus {ACTUATION_MIX} with --allow-actuation).")
+    parser.add_argument("--allow-actuation", action="store_true",
+                        help="Allow scenarios that post temperatures and set the fan on the target system.")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed for the agents' scenario choices and request contents.")
+    parser.add_argument("--output", help="Save machine-readable results to this JSON file.")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two saved result files.")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    print(f"--- SLM BENCHMARK STARTING against {args.base_url} ---")
+    mix = args.mix or (f"{DEFAULT_MIX},{ACTUATION_MIX}" if args.allow_actuation else DEFAULT_MIX)
+    try:
+        mix = parse_mix(mix, args.allow_actuation)
+    except ValueError as e:
+        parser.error(str(e))
+    results = run_benchmark(args.base_url, args.agents, args.duration, mix, args.seed)
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to '{args.output}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 
+import os
 import requests
 import json
 import time
@@ -6,7 +7,7 @@ import time
 # --- Configuration ---
 # This should be the address of your Flask application.
 # If running locally, it's likely localhost or 127.0.0.1
-BASE_URL = "http://127.0.0.1:8080"
+BASE_URL = os.environ.get("SLM_BASE_URL", f"http://127.0.0.1:{os.environ.get('PORT', 3177)}")
 
 # --- Helper Functions ---
 def print_header(title):
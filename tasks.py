@@ -2,43 +2,260 @@
 # This file defines the Celery tasks for background processing.
 
 import os
+import time
+import uuid
+
+import redis
 from celery import Celery
+from celery.signals import (before_task_publish, task_postrun, task_prerun, worker_init, worker_process_init,
+                            worker_ready, worker_shutdown)
 
+from metrics import SnapshotPublisher, registry
+import celeryconfig
 # Import the NPU manager, which will point to the correct implementation (real or mock)
 import npu_manager as npu
+# The inference job itself is shared with the in-process executor.
+from inference_executor import run_inference_job
+from npu_scheduler import DEFAULT_PRIORITY, PRIORITIES
+from result_cache import SharedResultStore, is_cacheable
+from token_stream import TokenPublisher
 
 # --- Celery Configuration ---
-# The broker URL points to Redis, which acts as the message queue.
-# The backend URL also points to Redis, where results will be stored.
-CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0')
-CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0')
+# The broker and result backend URLs both point to Redis (see celeryconfig.py).
+CELERY_BROKER_URL = celeryconfig.broker_url
+CELERY_RESULT_BACKEND = celeryconfig.result_backend
 
 # Initialize Celery
 celery = Celery(__name__, broker=CELERY_BROKER_URL, backend=CELERY_RESULT_BACKEND)
 
+# --- Priority Queues ---
+# Each priority class has its own queue, so a backlog of bulk work never sits
+# in front of critical decisions (e.g. cutting array power on overheating).
+# Capacity for critical work is reserved by running a worker that consumes
+# only the critical queue, next to the general worker:
+#     celery -A tasks.celery worker -Q npu-critical --pool threads --concurrency 2 -n critical@%h
+#     celery -A tasks.celery worker -Q npu-critical,npu-normal,npu-bulk --pool threads --concurrency 16 -n general@%h
+PRIORITY_QUEUES = {name: f"npu-{name}" for name in PRIORITIES}
+celery.conf.task_default_queue = PRIORITY_QUEUES[DEFAULT_PRIORITY]
+celery.conf.task_routes = {'tasks.run_npu_inference_chunk': {'queue': PRIORITY_QUEUES["bulk"]}}
+# Reserve one task at a time, so queued tasks are not stuck in a busy worker's prefetch buffer.
+celery.conf.worker_prefetch_multiplier = 1
+
+# Bulk chunks are deferred while any critical task is pending. Pending
+# critical tasks are kept in a sorted set scored by when they stop counting,
+# so a task whose worker died cannot hold bulk work back forever.
+CRITICAL_PENDING_KEY = "npu-critical-pending"
+CRITICAL_PENDING_TTL_S = 60
+# How long a deferred bulk chunk waits before it checks again.
+BULK_DEFER_S = float(os.environ.get('NPU_BULK_DEFER_S', 1.0))
+# Finished chunks of a bulk job are recorded as bits (one per chunk index) in
+# two Redis bitmaps, so the job's progress is read with two BITCOUNTs however
+# many chunks it has (see bulk_jobs.py).
+BULK_DONE_KEY = "npu-bulk-job-{}-done"
+BULK_FAILED_KEY = "npu-bulk-job-{}-failed"
+# How long bulk job state is kept in Redis (seconds).
+BULK_JOB_TTL_S = 24 * 3600
+
+_redis = None
+_broker_redis = None
+
+def _client():
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(CELERY_RESULT_BACKEND)
+    return _redis
+
+def queue_depths():
+    """Returns the number of tasks waiting in each priority queue (the Redis broker keeps a list per queue)."""
+    global _broker_redis
+    if _broker_redis is None:
+        _broker_redis = redis.Redis.from_url(CELERY_BROKER_URL)
+    pipe = _broker_redis.pipeline()
+    for queue in PRIORITY_QUEUES.values():
+        pipe.llen(queue)
+    return dict(zip(PRIORITY_QUEUES.values(), pipe.execute()))
+
+def critical_pending():
+    """True while a critical inference is queued or running."""
+    client = _client()
+    client.zremrangebyscore(CRITICAL_PENDING_KEY, "-inf", time.time())
+    return client.zcard(CRITICAL_PENDING_KEY) > 0
+
+def submit_inference(model_name, input_data, priority=DEFAULT_PRIORITY, cache_key=None):
+    """Queues an inference on its priority class's queue and returns the AsyncResult."""
+    task_id = str(uuid.uuid4())
+    if priority == "critical":
+        # Registered before publishing, so bulk chunks defer even if the task is still queued.
+        _client().zadd(CRITICAL_PENDING_KEY, {task_id: time.time() + CRITICAL_PENDING_TTL_S})
+    return run_npu_inference_task.apply_async((model_name, input_data, priority), {"cache_key": cache_key},
+                                              task_id=task_id, queue=PRIORITY_QUEUES[priority])
+
+# --- Worker Startup ---
+# Models in NPU_PRELOAD_MODELS are loaded and warmed up before the worker
+# consumes any task. Run the worker with the threads pool, so every task
+# shares one process's loaded models, NPU scheduler and memory budget:
+#     celery -A tasks.celery worker -Q npu-critical,npu-normal,npu-bulk --pool threads --concurrency 16 -n general@%h
+# With the prefork pool, only the mapped model file pages are shared with the
+# children: each child re-creates its runtime contexts, prefills prompt
+# prefixes again, and has its own scheduler and memory budget, so children do
+# not coordinate NPU cores or memory. Keep prefork workers at --concurrency 1.
+# Once warm, the worker writes a readiness file (for health checks and
+# deployment scripts), removed again when it shuts down.
+WORKER_READY_DIR = os.environ.get('NPU_WORKER_READY_DIR', '/tmp')
+
+def worker_ready_path(hostname):
+    return os.path.join(WORKER_READY_DIR, f"npu-worker-{hostname}.ready")
+
+@worker_init.connect
+def _preload_models(**kwargs):
+    report = npu.preload_models()
+    failed = [name for name, r in report.items() if not r["ok"]]
+    if failed:
+        print(f"WARNING: Could not preload {', '.join(failed)}; they will be loaded on first use.")
+
+@worker_process_init.connect
+def _reinit_npu_after_fork(**kwargs):
+    npu.reinit_after_fork()
+    # Each prefork child publishes its own metrics, under its own pid.
+    metrics_publisher.start()
+
+@worker_ready.connect
+def _mark_ready(sender=None, **kwargs):
+    with open(worker_ready_path(sender.hostname), 'w') as f:
+        f.write(f"{os.getpid()}\n")
+
+@worker_shutdown.connect
+def _mark_not_ready(sender=None, **kwargs):
+    try:
+        os.remove(worker_ready_path(sender.hostname))
+    except OSError:
+        pass
+
+# --- Task Metrics ---
+# Workers record how long tasks wait in the queue and how long they run, and
+# publish their metrics to Redis for the app's /metrics endpoint.
+TASK_WAIT_SECONDS = registry.histogram(
+    "celery_task_wait_seconds", "Time tasks spent queued before a worker started them.", ["task", "queue"])
+TASK_RUN_SECONDS = registry.histogram("celery_task_run_seconds", "Time tasks spent running.", ["task", "state"])
+metrics_publisher = SnapshotPublisher(registry, CELERY_RESULT_BACKEND)
+_task_started = {}
+
+@before_task_publish.connect
+def _stamp_publish_time(headers=None, **kwargs):
+    if headers is not None:
+        headers["published_at"] = time.time()
+
+@task_prerun.connect
+def _record_task_start(task_id=None, task=None, **kwargs):
+    metrics_publisher.start()
+    published_at = getattr(task.request, "published_at", None)
+    if published_at is not None:
+        queue = (task.request.delivery_info or {}).get("routing_key") or "unknown"
+        TASK_WAIT_SECONDS.observe(max(0.0, time.time() - published_at), task=task.name, queue=queue)
+    _task_started[task_id] = time.perf_counter()
+
+@task_postrun.connect
+def _record_task_end(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        TASK_RUN_SECONDS.observe(time.perf_counter() - started, task=task.name, state=state or "UNKNOWN")
+
+@task_postrun.connect
+def _record_chunk_done(task=None, kwargs=None, state=None, retval=None, **extra):
+    # Runs after the chunk's result is stored, so a chunk marked done can be read.
+    # A chunk with any failed item (e.g. the model could not be loaded) counts as failed.
+    if task is None or task.name != 'tasks.run_npu_inference_chunk' or state not in ("SUCCESS", "FAILURE"):
+        return
+    job_id, chunk_index = (kwargs or {}).get("job_id"), (kwargs or {}).get("chunk_index")
+    if job_id is None or chunk_index is None:
+        return
+    pipe = _client().pipeline()
+    pipe.setbit(BULK_DONE_KEY.format(job_id), chunk_index, 1)
+    pipe.expire(BULK_DONE_KEY.format(job_id), BULK_JOB_TTL_S)
+    if state == "FAILURE" or any("error" in output for output in retval or ()):
+        pipe.setbit(BULK_FAILED_KEY.format(job_id), chunk_index, 1)
+        pipe.expire(BULK_FAILED_KEY.format(job_id), BULK_JOB_TTL_S)
+    pipe.execute()
+
 # --- Asynchronous NPU Task ---
-@celery.task(name='tasks.run_npu_inference')
-def run_npu_inference_task(model_name, input_data):
+# Successful results are stored in the shared tier of the app's result cache
+# (see result_cache.py), so repeated requests are answered without a task.
+shared_results = SharedResultStore(CELERY_RESULT_BACKEND)
+
+@celery.task(name='tasks.run_npu_inference', bind=True)
+def run_npu_inference_task(self, model_name, input_data, priority=DEFAULT_PRIORITY, cache_key=None):
     """
-    A Celery task that wraps the run_inference function from the NPU manager.
-    
+    A Celery task that wraps run_inference_job (see inference_executor.py).
+
     This runs in a separate Celery worker process, so it doesn't block the main
-    Flask application. The NPU model is loaded once per worker.
+    Flask application. Models are preloaded when the worker starts. Batching only
+    kicks in when the worker runs several tasks at once, e.g.:
+        celery -A tasks.celery worker --pool threads --concurrency 16
+    """
+    try:
+        result = run_inference_job(model_name, input_data, priority)
+        if cache_key is not None and is_cacheable(result):
+            try:
+                shared_results.put(tuple(cache_key), result)
+            except redis.exceptions.RedisError as e:
+                print(f"WORKER: Could not cache the result of {self.request.id}: {e}")
+        return result
+    finally:
+        if priority == "critical":
+            _client().zrem(CRITICAL_PENDING_KEY, self.request.id)
+
+# --- Streaming NPU Task ---
+@celery.task(name='tasks.run_npu_stream', bind=True)
+def run_npu_stream_task(self, model_name, input_data):
+    """
+    A Celery task that runs a language model and streams its tokens.
+
+    Every token is pushed to the task's Redis stream as soon as it is generated,
+    where the Flask app forwards it to the client. The full text and the
+    time-to-first-token are also returned as the task result.
+    """
+    # Created first, so every outcome ends the client's stream with a terminal event.
+    publisher = TokenPublisher(CELERY_RESULT_BACKEND, self.request.id)
+    loaded, msg = npu.load_model(model_name)
+    if not loaded:
+        error = f"Model ({model_name}) could not be loaded in worker: {msg}"
+        publisher.finish(error=error)
+        return {"error": error}
+
+    print(f"CELERY WORKER: Starting streaming inference for model '{model_name}'.")
+
+    tokens = []
+    try:
+        for token in npu.run_inference_stream(model_name, input_data):
+            tokens.append(token)
+            publisher.publish(token)
+    except Exception as e:
+        publisher.finish(error=e)
+        return {"error": str(e)}
+
+    metrics = publisher.finish()
+    return {"text": "".join(tokens), "metrics": metrics}
+
+# --- Bulk NPU Task ---
+@celery.task(name='tasks.run_npu_inference_chunk', bind=True)
+def run_npu_inference_chunk_task(self, model_name, inputs, job_id=None, chunk_index=None):
     """
-    # Ensure the model is loaded in the worker process.
-    # Celery workers are long-lived, so this will only run on worker startup.
+    A Celery task that runs one chunk of a bulk job as a single NPU batch.
+    Returns one result dict per input, in the same order.
+    While critical work is pending, the chunk is put back on the queue.
+    Once it finishes, chunk_index is marked done in the job's progress bitmaps.
+    """
+    if critical_pending():
+        raise self.retry(countdown=BULK_DEFER_S, max_retries=None)
+
     loaded, msg = npu.load_model(model_name)
     if not loaded:
-        # If the model fails to load, we can't proceed.
-        return {"error": f"Model ({model_name}) could not be loaded in worker: {msg}"}
-    
-    print(f"CELERY WORKER: Starting inference for model '{model_name}'.")
-    
-    # Run the actual inference using the function provided by the NPU manager.
-    # This will call either the real or mock implementation.
-    results, message = npu.run_inference(model_name, input_data)
-    
-    if results is None:
-        return {"error": message}
-        
-    return {"results": results, "message": message}
+        error = {"error": f"Model ({model_name}) could not be loaded in worker: {msg}"}
+        return [error] * len(inputs)
+
+    print(f"CELERY WORKER: Running bulk chunk of {len(inputs)} inputs for model '{model_name}'.")
+
+    outputs = []
+    for results, message in npu.run_inference_batch(model_name, inputs, priority="bulk"):
+        outputs.append({"error": message} if results is None else {"results": results, "message": message})
+    return outputs
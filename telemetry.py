@@ -0,0 +1,370 @@
+# telemetry.py
+# This file keeps a fixed-memory history of system telemetry (temperature,
+# fan speed, diode state and power events). Each metric is stored in a
+# fixed-size ring buffer of typed numpy arrays, so memory use never grows
+# no matter how long the system runs.
+#
+# Each ring buffer is a file in shared memory (/dev/shm), mapped by every
+# process, so all gunicorn workers record into and read from the same
+# history. Writers serialize on a file lock; readers take it shared. A
+# buffer's file is created (and numpy is imported) when the first sample
+# arrives, not when the app starts.
+
+import fcntl
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import registry
+
+# --- Telemetry Configuration ---
+_DEFAULT_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else "/tmp"
+TELEMETRY_DIR = os.environ.get('TELEMETRY_DIR', os.path.join(_DEFAULT_DIR, "tessr_telemetry"))
+# Temperature arrives roughly once per second; keep two weeks of it by default.
+TEMPERATURE_CAPACITY = int(os.environ.get('TELEMETRY_TEMPERATURE_CAPACITY', 14 * 24 * 3600))
+# Fan, diode and power samples are only recorded when they change.
+EVENT_CAPACITY = int(os.environ.get('TELEMETRY_EVENT_CAPACITY', 65536))
+# Batched readings get one series per sensor ("temperature_c.<sensor id>"),
+# each with TEMPERATURE_CAPACITY samples; at most this many sensors are accepted.
+MAX_SENSORS = int(os.environ.get('TELEMETRY_MAX_SENSORS', 16))
+SENSOR_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+# A sensor whose newest reading is older than this no longer counts as current.
+SENSOR_STALE_S = float(os.environ.get('TELEMETRY_SENSOR_STALE_S', 60))
+# The longest history query accepted: what the temperature buffer holds at one sample per second.
+MAX_HISTORY_SPAN_S = float(TEMPERATURE_CAPACITY)
+
+# --- Shared Buffer Layout ---
+# offset 0: magic (u64), 8: capacity (u64), 16: next write position (u64),
+# 24: sample count (u64); from offset 64: timestamps (float64 x capacity),
+# followed by values (float32 x capacity).
+_HEADER = struct.Struct("<QQQQ")
+_MAGIC_VALUE = 0x5445535352544c31  # "TESSRTL1"
+_DATA_OFFSET = 64
+
+TELEMETRY_SAMPLES = registry.counter("telemetry_samples_total", "Telemetry samples ingested.", ["metric"])
+
+
+class TelemetryRingBuffer:
+    """
+    A ring buffer of (timestamp, value) samples backed by two numpy arrays
+    over a shared-memory file at path.
+
+    Timestamps are float64 seconds since the epoch and values are float32,
+    12 bytes per sample. Samples are kept in time order: a sample older than
+    the newest stored one (e.g. from a client that buffered it) is inserted
+    at its place, which rewrites the stored samples newer than it.
+    """
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        # Views of the mapped file, set up by _open.
+        self._timestamps = None
+        self._values = None
+        # Copies of the header, valid while _locked is held.
+        self._next = 0
+        self._count = 0
+        self._fd = None
+        self._mm = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._locked() as ready:
+            return self._count if ready else 0
+
+    @property
+    def nbytes(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def _open(self, create):
+        # Called with the thread lock held. Returns False if there is no buffer file yet.
+        import numpy as np
+
+        if self._pid != os.getpid() and self._fd is not None:
+            # A forked child opens its own descriptor, so its file locks are its own.
+            os.close(self._fd)
+            self._fd = self._mm = self._timestamps = self._values = None
+        if self._fd is not None:
+            return True
+        size = _DATA_OFFSET + self.capacity * 12
+        if create:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            fd = os.open(self.path, os.O_RDWR | (os.O_CREAT if create else 0), 0o600)
+        except FileNotFoundError:
+            return False
+        if os.fstat(fd).st_size < size:
+            if not create:
+                os.close(fd)
+                return False
+            os.ftruncate(fd, size)
+        self._fd, self._pid = fd, os.getpid()
+        self._mm = mmap.mmap(fd, size)
+        self._timestamps = np.frombuffer(self._mm, dtype=np.float64, count=self.capacity, offset=_DATA_OFFSET)
+        self._values = np.frombuffer(self._mm, dtype=np.float32, count=self.capacity,
+                                     offset=_DATA_OFFSET + self.capacity * 8)
+        return True
+
+    @contextmanager
+    def _locked(self, write=False):
+        """
+        Holds the buffer's locks and loads its header into _next and _count;
+        with write, creates the file if needed and stores the header on exit.
+        Yields False when there is nothing to read yet.
+        """
+        with self._lock:
+            if not self._open(create=write):
+                yield False
+                return
+            fcntl.flock(self._fd, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+            try:
+                magic, capacity, self._next, self._count = _HEADER.unpack_from(self._mm, 0)
+                if magic != _MAGIC_VALUE or capacity != self.capacity:
+                    # New file, or one laid out for another capacity: start empty.
+                    self._next = self._count = 0
+                    if write:
+                        _HEADER.pack_into(self._mm, 0, _MAGIC_VALUE, self.capacity, 0, 0)
+                yield True
+                if write:
+                    _HEADER.pack_into(self._mm, 0, _MAGIC_VALUE, self.capacity, self._next, self._count)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def create(self):
+        """Creates the buffer's file, empty, if it does not exist yet."""
+        with self._locked(write=True):
+            pass
+
+    def append(self, value, timestamp=None):
+        timestamp = time.time() if timestamp is None else float(timestamp)
+        with self._locked(write=True):
+            if self._count and timestamp < self._timestamps[self._next - 1]:
+                self._insert([timestamp], [value])
+                return
+            self._timestamps[self._next] = timestamp
+            self._values[self._next] = value
+            self._next = (self._next + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    def extend(self, timestamps, values):
+        """Adds many samples at once (timestamps and values are equal-length sequences, in any order)."""
+        import numpy as np
+
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float32)
+        order = np.argsort(timestamps, kind='stable')
+        timestamps, values = timestamps[order], values[order]
+        with self._locked(write=True):
+            if self._count and len(timestamps) and timestamps[0] < self._timestamps[self._next - 1]:
+                self._insert(timestamps, values)
+            else:
+                self._write(timestamps, values)
+
+    def _write(self, timestamps, values):
+        # Appends sorted samples that are not older than the newest stored one. Called with _locked(write=True).
+        import numpy as np
+
+        # Only the newest `capacity` samples can survive.
+        timestamps, values = timestamps[-self.capacity:], values[-self.capacity:]
+        positions = (self._next + np.arange(len(timestamps))) % self.capacity
+        self._timestamps[positions] = timestamps
+        self._values[positions] = values
+        self._next = (self._next + len(timestamps)) % self.capacity
+        self._count = min(self._count + len(timestamps), self.capacity)
+
+    def _insert(self, timestamps, values):
+        """
+        Merges sorted samples that start before the newest stored one: the
+        stored samples newer than the oldest new one are taken off the end,
+        merged with the new ones and written back. Called with _locked(write=True).
+        """
+        import numpy as np
+
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float32)
+        oldest = (self._next - self._count) % self.capacity
+        # Number of stored samples at or before the first new one; they stay in place.
+        # Stored timestamps are sorted in logical order, so search the two physical runs.
+        if oldest + self._count <= self.capacity:
+            keep = int(np.searchsorted(self._timestamps[oldest:oldest + self._count], timestamps[0], side='right'))
+        else:
+            first_run = self._timestamps[oldest:]
+            keep = int(np.searchsorted(first_run, timestamps[0], side='right'))
+            if keep == len(first_run):
+                keep += int(np.searchsorted(self._timestamps[:self._next], timestamps[0], side='right'))
+        tail = (oldest + np.arange(keep, self._count)) % self.capacity
+        merged_ts = np.concatenate((self._timestamps[tail], timestamps))
+        merged_values = np.concatenate((self._values[tail], values))
+        # Stable, so stored samples stay ahead of new samples with the same timestamp.
+        order = np.argsort(merged_ts, kind='stable')
+        self._next = (oldest + keep) % self.capacity
+        self._count = keep
+        self._write(merged_ts[order], merged_values[order])
+
+    def latest(self):
+        """Returns the newest (timestamp, value) pair, or None if empty."""
+        with self._locked() as ready:
+            if not ready or not self._count:
+                return None
+            return float(self._timestamps[self._next - 1]), float(self._values[self._next - 1])
+
+    def _range(self, start, end):
+        """Returns copies of the samples with start <= t < end, oldest first."""
+        import numpy as np
+
+        with self._locked() as ready:
+            if not ready or not self._count:
+                return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float32)
+            if self._count < self.capacity:
+                segments = [(self._timestamps[:self._count], self._values[:self._count])]
+            else:
+                # Oldest samples live after the write position, newest before it.
+                segments = [(self._timestamps[self._next:], self._values[self._next:]),
+                            (self._timestamps[:self._next], self._values[:self._next])]
+            ts_parts, value_parts = [], []
+            for ts, values in segments:
+                lo, hi = np.searchsorted(ts, [start, end], side='left')
+                ts_parts.append(ts[lo:hi])
+                value_parts.append(values[lo:hi])
+            return np.concatenate(ts_parts), np.concatenate(value_parts)
+
+    def downsample(self, start, end, step):
+        """
+        Splits [start, end) into windows of `step` seconds and returns the
+        min/max/mean/count of each non-empty window, computed in one vectorized pass.
+        """
+        import numpy as np
+
+        ts, values = self._range(start, end)
+        if not len(ts):
+            return []
+        window_ids = ((ts - start) // step).astype(np.int64)
+        # Samples are sorted, so each window is a contiguous run.
+        boundaries = np.flatnonzero(np.diff(window_ids)) + 1
+        starts = np.concatenate(([0], boundaries))
+        counts = np.diff(np.concatenate((starts, [len(ts)])))
+        mins = np.minimum.reduceat(values, starts)
+        maxs = np.maximum.reduceat(values, starts)
+        means = np.add.reduceat(values.astype(np.float64), starts) / counts
+        window_starts = start + window_ids[starts] * step
+        return [
+            {"t": float(t), "min": float(lo), "max": float(hi), "mean": round(float(mean), 3), "count": int(n)}
+            for t, lo, hi, mean, n in zip(window_starts, mins, maxs, means, counts)
+        ]
+
+
+class TelemetryStore:
+    """
+    Holds one ring buffer per metric, as files in directory. Per-sensor
+    temperature series are created when a sensor first reports (see
+    sensor_metric), by whichever process receives its readings.
+    """
+
+    FIXED_METRICS = {
+        "temperature_c": TEMPERATURE_CAPACITY,
+        "fan_speed_percent": EVENT_CAPACITY,
+        "diode_on": EVENT_CAPACITY,
+        "power_supply_on": EVENT_CAPACITY
+    }
+
+    def __init__(self, directory=TELEMETRY_DIR):
+        self.directory = directory
+        self._buffers = {name: TelemetryRingBuffer(os.path.join(directory, name), capacity)
+                         for name, capacity in self.FIXED_METRICS.items()}
+        self._buffers_lock = threading.Lock()
+        self._sensor_lock = threading.Lock()
+
+    @staticmethod
+    def sensor_metric(sensor_id):
+        """Returns the metric name of a sensor's temperature series."""
+        return f"temperature_c.{sensor_id}"
+
+    @property
+    def metrics(self):
+        """Returns {metric name: ring buffer}, including every sensor any process has created."""
+        for sensor_id in self.sensors():
+            self._buffer(self.sensor_metric(sensor_id))
+        with self._buffers_lock:
+            return dict(self._buffers)
+
+    def _buffer(self, metric):
+        with self._buffers_lock:
+            buf = self._buffers.get(metric)
+            if buf is None:
+                if not metric.startswith(self.sensor_metric("")):
+                    raise KeyError(metric)
+                buf = self._buffers[metric] = TelemetryRingBuffer(os.path.join(self.directory, metric),
+                                                                  TEMPERATURE_CAPACITY)
+            return buf
+
+    def add_sensors(self, sensor_ids):
+        """
+        Creates the series of any new sensors. Raises ValueError for an
+        invalid sensor id or when the sensors would exceed MAX_SENSORS.
+        """
+        for sensor_id in sensor_ids:
+            if not isinstance(sensor_id, str) or not SENSOR_ID_PATTERN.match(sensor_id):
+                raise ValueError("sensor ids must be 1-64 letters, digits, '_' or '-'")
+        os.makedirs(self.directory, exist_ok=True)
+        # Processes count and create sensor files one at a time.
+        with self._sensor_lock, open(os.path.join(self.directory, ".sensors.lock"), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            new = set(sensor_ids) - set(self.sensors())
+            if len(self.sensors()) + len(new) > MAX_SENSORS:
+                raise ValueError(f"at most {MAX_SENSORS} temperature sensors are supported")
+            for sensor_id in new:
+                self._buffer(self.sensor_metric(sensor_id)).create()
+
+    def sensors(self):
+        """Returns the ids of all sensors that have reported batched readings."""
+        prefix = self.sensor_metric("")
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[len(prefix):] for name in names if name.startswith(prefix))
+
+    def sensor_latest(self, max_age_s=SENSOR_STALE_S):
+        """
+        Returns {sensor id: {"t": timestamp, "temperature_c": value}} for every
+        sensor whose newest reading is at most max_age_s old (None: any age).
+        """
+        cutoff = None if max_age_s is None else time.time() - max_age_s
+        latest = {}
+        for sensor_id in self.sensors():
+            sample = self._buffer(self.sensor_metric(sensor_id)).latest()
+            if sample is not None and (cutoff is None or sample[0] >= cutoff):
+                latest[sensor_id] = {"t": sample[0], "temperature_c": sample[1]}
+        return latest
+
+    def record(self, metric, value, timestamp=None):
+        self._buffer(metric).append(value, timestamp)
+        TELEMETRY_SAMPLES.inc(metric=metric)
+
+    def extend(self, metric, timestamps, values):
+        self._buffer(metric).extend(timestamps, values)
+        TELEMETRY_SAMPLES.inc(len(values), metric=metric)
+
+    def latest(self, metric):
+        return self._buffer(metric).latest()
+
+    def history(self, metric, start, end, step):
+        return self._buffer(metric).downsample(start, end, step)
+
+    def stats(self):
+        return {
+            name: {"samples": len(buf), "capacity": buf.capacity, "bytes": buf.nbytes}
+            for name, buf in self.metrics.items()
+        }
+
+
+# The telemetry store of this process; its buffers are shared with every other app process.
+telemetry = TelemetryStore()
@@ -1,16 +1,23 @@
-
 # temperature_simulator.py
 # This script simulates the temperature sensor of the Orange Pi.
+#
+# By default it posts one reading at a time, like a single slow sensor.
+# With TEMPERATURE_BATCH_MODE=1 it instead simulates several probes sampled
+# at a fixed rate, buffers their readings and sends them in batches over a
+# pooled keep-alive session.
 
+import asyncio
 import time
 import random
 import requests
 import os
+from requests.adapters import HTTPAdapter
 
 # The endpoint of the main Flask application that will receive the temperature data
 HOST = os.environ.get("FLASK_HOST", "127.0.0.1")
 PORT = os.environ.get("FLASK_PORT", 3177)
 ALERT_URL = f"http://{HOST}:{PORT}/api/system/temperature"
+BATCH_URL = f"http://{HOST}:{PORT}/api/system/temperature/batch"
 
 # --- Temperature Simulation Parameters ---
 # A healthy baseline temperature
@@ -19,32 +26,208 @@ BASE_TEMP = 55.0
 TEMP_JITTER = 5.0
 # The chance (out of 100) that a critical overheat event will occur
 OVERHEAT_CHANCE = 3
+# Readings above this are sent immediately instead of waiting for the batch
+CRITICAL_TEMP = 80.0
+
+# --- Batch Mode Parameters ---
+BATCH_MODE = os.environ.get("TEMPERATURE_BATCH_MODE", "0") == "1"
+SENSOR_IDS = os.environ.get("TEMPERATURE_SENSORS", "cpu,npu,array_bay_1,array_bay_2").split(",")
+SAMPLE_HZ = float(os.environ.get("TEMPERATURE_SAMPLE_HZ", 10))
+# Send a batch once it holds this many readings, or after this many seconds
+BATCH_MAX_READINGS = int(os.environ.get("TEMPERATURE_BATCH_MAX_READINGS", 500))
+BATCH_MAX_DELAY_S = float(os.environ.get("TEMPERATURE_BATCH_MAX_DELAY_S", 1.0))
+# After a failed post, wait this long before the next attempt, doubling per failure
+BATCH_RETRY_MIN_S = float(os.environ.get("TEMPERATURE_BATCH_RETRY_MIN_S", 1.0))
+BATCH_RETRY_MAX_S = float(os.environ.get("TEMPERATURE_BATCH_RETRY_MAX_S", 30.0))
+
+def make_session():
+    """Creates an HTTP session that keeps its connections alive between posts."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# A single session shared by every post this process makes.
+session = make_session()
 
-def simulate_temperature():
+def sample_temperature():
+    """Returns one simulated temperature reading, occasionally a critical overheat."""
+    if random.randint(1, 100) <= OVERHEAT_CHANCE:
+        return 85.0 + random.uniform(0, 5.0)
+    return BASE_TEMP + random.uniform(0, TEMP_JITTER)
+
+def simulate_temperature(http_session=None):
     """
     Simulates CPU temperature, with a small chance of a critical overheat event
     that requires intervention (e.g., triggering the fan).
     """
-    current_temp = BASE_TEMP + random.uniform(0, TEMP_JITTER)
+    current_temp = sample_temperature()
 
     # Occasionally spike the temperature to test the system's reaction
-    if random.randint(1, 100) <= OVERHEAT_CHANCE:
-        current_temp = 85.0 + random.uniform(0, 5.0)
+    if current_temp > CRITICAL_TEMP:
         print(f"SIMULATOR: CRITICAL - Simulating overheat event: {current_temp:.2f}°C")
     else:
         print(f"SIMULATOR: INFO - Simulating normal temperature: {current_temp:.2f}°C")
 
     try:
         # Send the simulated temperature to the main application
-        response = requests.post(ALERT_URL, json={"temperature_c": current_temp}, timeout=2)
+        response = (http_session or session).post(ALERT_URL, json={"temperature_c": current_temp}, timeout=2)
         if response.status_code != 200:
             print(f"SIMULATOR: ERROR - Failed to send temperature data: {response.text}")
     except requests.exceptions.RequestException as e:
         print(f"SIMULATOR: ERROR - Could not connect to main application: {e}")
 
 
+class BatchingTemperatureClient:
+    """
+    Buffers readings per sensor and posts them to the batch endpoint.
+
+    A batch is sent when it reaches max_readings, when max_delay_s has passed
+    since the oldest buffered reading, or at once if a critical reading arrives.
+    If a post fails, the readings stay buffered, up to max_buffered readings
+    (beyond that the oldest non-critical readings are dropped first), and only
+    critical readings trigger another post until the retry back-off
+    (retry_min_s, doubling up to retry_max_s) has expired.
+    """
+
+    def __init__(self, url=BATCH_URL, max_readings=BATCH_MAX_READINGS, max_delay_s=BATCH_MAX_DELAY_S,
+                 max_buffered=100 * BATCH_MAX_READINGS, retry_min_s=BATCH_RETRY_MIN_S,
+                 retry_max_s=BATCH_RETRY_MAX_S, http_session=None):
+        self.url = url
+        self.max_readings = max_readings
+        self.max_delay_s = max_delay_s
+        self.max_buffered = max_buffered
+        self.retry_min_s = retry_min_s
+        self.retry_max_s = retry_max_s
+        self.session = http_session or session
+        self._buffer = {}
+        self._count = 0
+        self._oldest = None
+        # Back-off after failed posts: the current delay and when the next post may happen.
+        self._retry_delay = 0.0
+        self._next_attempt = 0.0
+
+    def add(self, sensor_id, temperature_c, timestamp=None):
+        timestamps, temps = self._buffer.setdefault(sensor_id, ([], []))
+        timestamps.append(time.time() if timestamp is None else timestamp)
+        temps.append(temperature_c)
+        self._count += 1
+        now = time.monotonic()
+        if self._oldest is None:
+            self._oldest = now
+        if temperature_c > CRITICAL_TEMP:
+            self.flush()
+        elif self._count >= self.max_readings or now - self._oldest >= self.max_delay_s:
+            if now >= self._next_attempt:
+                self.flush()
+            elif self._count > self.max_buffered:
+                self._drop()
+
+    def flush(self):
+        """Posts every buffered reading; returns True on success."""
+        if not self._count:
+            return True
+        payload = {"sensors": [
+            {"id": sensor_id, "timestamps": timestamps, "temperature_c": temps}
+            for sensor_id, (timestamps, temps) in self._buffer.items()
+        ]}
+        try:
+            response = self.session.post(self.url, json=payload, timeout=2)
+            ok = response.status_code == 200
+            if not ok:
+                print(f"SIMULATOR: ERROR - Failed to send temperature batch: {response.text}")
+        except requests.exceptions.RequestException as e:
+            print(f"SIMULATOR: ERROR - Could not connect to main application: {e}")
+            ok = False
+
+        if ok:
+            self._retry_delay = 0.0
+            self._next_attempt = 0.0
+            self._clear()
+        else:
+            self._retry_delay = min(self.retry_max_s, max(self.retry_min_s, 2 * self._retry_delay))
+            self._next_attempt = time.monotonic() + self._retry_delay
+            if self._count > self.max_buffered:
+                self._drop()
+        return ok
+
+    def _drop(self):
+        """
+        Makes room for another max_readings readings by dropping the oldest
+        non-critical readings, and only then the oldest critical ones.
+        """
+        keep = max(0, self.max_buffered - self.max_readings)
+        readings = sorted(
+            (temp > CRITICAL_TEMP, timestamp, sensor_id, i)
+            for sensor_id, (timestamps, temps) in self._buffer.items()
+            for i, (timestamp, temp) in enumerate(zip(timestamps, temps))
+        )
+        dropped = readings[:max(0, len(readings) - keep)]
+        critical = sum(1 for is_critical, _, _, _ in dropped if is_critical)
+        print(f"SIMULATOR: ERROR - Dropping {len(dropped)} buffered readings ({critical} critical).")
+        drop = {}
+        for _, _, sensor_id, i in dropped:
+            drop.setdefault(sensor_id, set()).add(i)
+        for sensor_id, indices in drop.items():
+            timestamps, temps = self._buffer[sensor_id]
+            kept = [(t, temp) for i, (t, temp) in enumerate(zip(timestamps, temps)) if i not in indices]
+            if kept:
+                self._buffer[sensor_id] = ([t for t, _ in kept], [temp for _, temp in kept])
+            else:
+                del self._buffer[sensor_id]
+        self._count -= len(dropped)
+        if not self._count:
+            self._oldest = None
+
+    def _clear(self):
+        self._buffer = {}
+        self._count = 0
+        self._oldest = None
+
+
+def add_samples(client):
+    """Samples every sensor once; the client posts a batch when one is due."""
+    now = time.time()
+    for sensor_id in SENSOR_IDS:
+        client.add(sensor_id, sample_temperature(), now)
+
+
+def run_batch_mode():
+    """Samples every sensor at SAMPLE_HZ and streams the readings in batches."""
+    client = BatchingTemperatureClient()
+    interval = 1.0 / SAMPLE_HZ
+    next_tick = time.monotonic()
+    while True:
+        add_samples(client)
+        next_tick += interval
+        time.sleep(max(0.0, next_tick - time.monotonic()))
+
+
+async def run_async(http_session=None):
+    """
+    Runs the simulator as an asyncio task (see simulator_supervisor.py).
+    Posts are blocking, so they run in a worker thread.
+    """
+    http_session = http_session or session
+    if BATCH_MODE:
+        client = BatchingTemperatureClient(http_session=http_session)
+        interval = 1.0 / SAMPLE_HZ
+        next_tick = time.monotonic()
+        while True:
+            await asyncio.to_thread(add_samples, client)
+            next_tick += interval
+            await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+    while True:
+        await asyncio.to_thread(simulate_temperature, http_session)
+        await asyncio.sleep(random.randint(5, 15))
+
+
 if __name__ == "__main__":
     print("--- Starting Temperature Simulator ---")
+    if BATCH_MODE:
+        print(f"SIMULATOR: Batch mode, {len(SENSOR_IDS)} sensors at {SAMPLE_HZ} Hz.")
+        run_batch_mode()
     while True:
         simulate_temperature()
         # Wait for a random interval to make the simulation more realistic
@@ -0,0 +1,80 @@
+# token_stream.py
+# This file carries generated tokens from a Celery worker to the HTTP client.
+# The worker appends each token to a per-task Redis stream as soon as it is
+# produced; the Flask app reads the stream with blocking reads, so a client
+# that attaches late still receives every token from the beginning.
+
+import json
+import time
+
+import redis
+
+STREAM_KEY_PREFIX = "npu-stream-"
+# How long a finished stream is kept around for clients that reattach.
+STREAM_TTL_S = 600
+# Cap on the stream length, so a runaway generation cannot fill Redis.
+STREAM_MAX_LEN = 10000
+
+
+def stream_key(task_id):
+    return STREAM_KEY_PREFIX + task_id
+
+
+class TokenPublisher:
+    """Writes tokens for one task to its Redis stream and tracks time-to-first-token."""
+
+    def __init__(self, redis_url, task_id):
+        self._client = redis.Redis.from_url(redis_url)
+        self._key = stream_key(task_id)
+        self._started = time.monotonic()
+        self.ttft_ms = None
+        self.token_count = 0
+
+    def publish(self, token):
+        if self.ttft_ms is None:
+            self.ttft_ms = round((time.monotonic() - self._started) * 1000, 1)
+        self.token_count += 1
+        self._client.xadd(self._key, {"token": token}, maxlen=STREAM_MAX_LEN, approximate=True)
+
+    def finish(self, error=None):
+        """Appends the final event with generation metrics; returns the metrics."""
+        metrics = {
+            "ttft_ms": self.ttft_ms,
+            "total_ms": round((time.monotonic() - self._started) * 1000, 1),
+            "tokens": self.token_count
+        }
+        fields = {"done": json.dumps(metrics)}
+        if error is not None:
+            fields["error"] = str(error)
+        self._client.xadd(self._key, fields, maxlen=STREAM_MAX_LEN, approximate=True)
+        self._client.expire(self._key, STREAM_TTL_S)
+        return metrics
+
+
+def read_tokens(redis_url, task_id, timeout_s, block_ms=15000):
+    """
+    Yields events for a task's stream as they arrive, from the beginning.
+
+    Each event is a dict with either a 'token' key, a 'done' key holding the
+    generation metrics (plus 'error' if the generation failed), or
+    {'keepalive': True} when nothing arrived within block_ms. Stops after the
+    'done' event, or with a final {'timeout': True} event once timeout_s has passed.
+    """
+    client = redis.Redis.from_url(redis_url)
+    key = stream_key(task_id)
+    last_id = "0-0"
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        entries = client.xread({key: last_id}, block=block_ms)
+        if not entries:
+            yield {"keepalive": True}
+            continue
+        for entry_id, fields in entries[0][1]:
+            last_id = entry_id
+            fields = {k.decode(): v.decode() for k, v in fields.items()}
+            if "done" in fields:
+                fields["done"] = json.loads(fields["done"])
+                yield fields
+                return
+            yield fields
+    yield {"timeout": True}
@@ -1,80 +1,104 @@
 # training_data_generator.py
 
+import argparse
+import hashlib
 import json
+import os
 import random
+from collections import deque
+from multiprocessing import Pool
+
+import numpy as np
+
+from prompts import AGENT_PROMPT_PREFIX
 
 # This script generates training data for fine-tuning an SLM to manage the storage array.
-# It defines a series of scenarios and the ideal sequence of API calls (the "plan") 
+# It defines a series of scenarios and the ideal sequence of API calls (the "plan")
 # that the SLM should make in response.
+#
+# Run without arguments it writes 200 examples to storage_management_training_data.jsonl.
+# With --output-dir it generates --target examples in parallel across a process pool,
+# deduplicated and streamed to JSONL shards, e.g.:
+#     python training_data_generator.py --target 5000000 --output-dir data/ --balanced
+
+# --- Scenario Labels ---
+# Each example is labeled with the branch of the plan logic it exercises.
+SCENARIOS = ["pi_overheating", "drive_lifespan", "drive_overheating", "raid_degraded", "nominal"]
+
+# Which simulated API states produce each scenario, given the plan priorities below.
+_SCENARIO_STATES = {
+    "pi_overheating": (["overheating"], ["healthy", "temp_warning", "lifespan_warning", "sync_error", "corruption"]),
+    "drive_lifespan": (["healthy", "npu_lockup"], ["lifespan_warning"]),
+    "drive_overheating": (["healthy", "npu_lockup"], ["temp_warning"]),
+    "raid_degraded": (["healthy", "npu_lockup"], ["sync_error"]),
+    "nominal": (["healthy", "npu_lockup"], ["healthy", "corruption"])
+}
 
 # --- Helper functions to simulate API calls ---
 # In a real scenario, these would make HTTP requests to the running Flask app.
 # For data generation, we can use the logic directly from main.py's mock endpoints.
+# Both take an optional random generator (for reproducible shards) and an
+# optional scenario name to force instead of picking one at random.
 
-def get_mock_system_health():
+def get_mock_system_health(rng=random, scenario=None):
     """Simulates a call to /api/system/health, returning one of several failure states."""
-    seagate_health = {"manufacturer": "Seagate", "total_gb": 500, "temperature_c": 35, "smart_attributes": {"Reallocated_Sector_Ct": 0}, "errors": []}
-    wd_drives_health = [{"manufacturer": "Western Digital", "total_gb": 1000, "temperature_c": 40, "smart_attributes": {"Reallocated_Sector_Ct": 0}, "errors": []} for _ in range(4)]
+    seagate_health = {"manufacturer": "Seagate", "total_gb": 500, "temperature_c": rng.randint(30, 45), "smart_attributes": {"Reallocated_Sector_Ct": 0}, "errors": []}
+    wd_drives_health = [{"manufacturer": "Western Digital", "total_gb": 1000, "temperature_c": rng.randint(32, 48), "smart_attributes": {"Reallocated_Sector_Ct": rng.choice([0, 0, 0, rng.randint(1, 8)])}, "errors": []} for _ in range(4)]
     raid_status = {"array": "/dev/md0", "level": 5, "status": "active", "sync_percent": 100, "errors": []}
 
-    scenario = random.choice(["healthy", "temp_warning", "lifespan_warning", "sync_error", "corruption"])
+    scenario = scenario or rng.choice(["healthy", "temp_warning", "lifespan_warning", "sync_error", "corruption"])
 
     if scenario == "temp_warning":
-        seagate_health["temperature_c"] = 68
+        seagate_health["temperature_c"] = rng.randint(62, 75)
         seagate_health["errors"].append("High Temperature Alert")
     elif scenario == "lifespan_warning":
-        wd_drives_health[2]["smart_attributes"]["Reallocated_Sector_Ct"] = 175
-        wd_drives_health[2]["errors"].append("S.M.A.R.T. Lifespan Warning")
+        failing = rng.randrange(len(wd_drives_health))
+        wd_drives_health[failing]["smart_attributes"]["Reallocated_Sector_Ct"] = rng.randint(100, 400)
+        wd_drives_health[failing]["errors"].append("S.M.A.R.T. Lifespan Warning")
     elif scenario == "sync_error":
+        failed_disk = rng.randint(1, 4)
         raid_status["status"] = "degraded"
-        raid_status["errors"] = ["Disk 2 failed. Array is in degraded mode."]
+        raid_status["sync_percent"] = rng.randint(0, 99)
+        raid_status["errors"] = [f"Disk {failed_disk} failed. Array is in degraded mode."]
     elif scenario == "corruption":
-        wd_drives_health[0]["errors"].append("Uncorrectable I/O Error: Filesystem may be corrupt.")
+        wd_drives_health[rng.randrange(len(wd_drives_health))]["errors"].append("Uncorrectable I/O Error: Filesystem may be corrupt.")
 
     return {"drives": [seagate_health] + wd_drives_health, "raid_arrays": [raid_status]}
 
-def get_mock_pi_status():
+def get_mock_pi_status(rng=random, scenario=None):
     """Simulates a call to /api/npu/status with Pi-specific failures."""
     status = {"mode": "mock", "drivers_found": False}
-    scenario = random.choice(["healthy", "overheating", "npu_lockup"])
+    scenario = scenario or rng.choice(["healthy", "overheating", "npu_lockup"])
     if scenario == "overheating":
-        status['cpu_temperature_c'] = 88
+        status['cpu_temperature_c'] = rng.randint(85, 95)
         status['errors'] = ["CPU temperature critical"]
     elif scenario == "npu_lockup":
         status['npu_status'] = "error"
         status['errors'] = ["NPU core unresponsive"]
     else:
-        status['cpu_temperature_c'] = 55
+        status['cpu_temperature_c'] = rng.randint(45, 65)
         status['errors'] = []
     return status
 
 # --- Training Data Generation Logic ---
 
-def generate_training_example():
-    """Creates a single training example (input prompt + ideal output)."""
-    
-    # 1. Simulate the state of the world by calling the mock APIs
-    pi_state = get_mock_pi_status()
-    drive_state = get_mock_system_health()
-
-    # 2. Construct the input prompt for the SLM
-    # This is what the SLM "sees". It's a summary of the system status.
-    prompt = f"USER: Assess system status and take necessary action.\nASSISTANT (thought): I need to check the status of the Orange Pi and the storage array. First, I will call the system health and NPU status APIs.\nASSISTANT (API call): GET /api/system/health -> {json.dumps(drive_state)}\nASSISTANT (API call): GET /api/npu/status -> {json.dumps(pi_state)}\nASSISTANT (thought): Now I will analyze the data and form a plan."
-    
-    # 3. Determine the correct plan of action based on the state (The "brains" of the generator)
+def build_plan(pi_state, drive_state):
+    """Determines the correct plan of action for a state; returns (scenario, plan)."""
     plan = []
-    
+
     # -- Rule-based logic to define the correct response for each scenario --
 
     # Priority 1: Orange Pi is overheating
     if "CPU temperature critical" in pi_state.get('errors', []):
+        scenario = "pi_overheating"
         plan.append({"thought": "The Orange Pi CPU is critically overheating. The highest priority is to shut down attached high-power peripherals to reduce load and prevent damage. I will turn off the drive array power supply.",
                      "action": {"tool": "/api/power/array", "method": "POST", "params": {"state": "off"}}})
         plan.append({"thought": "Now I must alert the user about the critical CPU temperature.",
                      "action": {"tool": "/api/notifications/send", "method": "POST", "params": {"level": "critical", "message": "Orange Pi CPU is overheating. Shutting down drive array to prevent damage."}}})
-    
+
     # Priority 2: A drive is about to fail (lifespan)
     elif any("S.M.A.R.T. Lifespan Warning" in d.get('errors', []) for d in drive_state['drives']):
+        scenario = "drive_lifespan"
         plan.append({"thought": "A drive is reporting a S.M.A.R.T. lifespan warning, indicating imminent failure. I should safely power down the array to allow for physical replacement.",
                      "action": {"tool": "/api/power/array", "method": "POST", "params": {"state": "off"}}})
         plan.append({"thought": "I need to inform the user about the specific failing drive.",
@@ -82,6 +106,7 @@ def generate_training_example():
 
     # Priority 3: A drive is overheating
     elif any("High Temperature Alert" in d.get('errors', []) for d in drive_state['drives']):
+        scenario = "drive_overheating"
         plan.append({"thought": "A drive is overheating. I will power off the array to let it cool down.",
                      "action": {"tool": "/api/power/array", "method": "POST", "params": {"state": "off"}}})
         plan.append({"thought": "I should notify the user of the temperature issue.",
@@ -89,27 +114,211 @@ def generate_training_example():
 
     # Priority 4: RAID array is degraded
     elif any("degraded" in r.get('status', "") for r in drive_state['raid_arrays']):
+        scenario = "raid_degraded"
         plan.append({"thought": "The RAID array is in a degraded state. File access is still possible but there is no redundancy. I will not power it down, but I must alert the user immediately.",
                      "action": {"tool": "/api/notifications/send", "method": "POST", "params": {"level": "critical", "message": "RAID array is DEGRADED. Data is at risk. Replace failed drive immediately."}}})
 
     # Default case: Everything is healthy
     else:
+        scenario = "nominal"
         plan.append({"thought": "System health is nominal. No action required.", "action": {}})
 
+    return scenario, plan
+
+def generate_labeled_example(rng=random, scenario=None):
+    """Creates one example and returns (scenario, example). scenario forces a plan branch."""
+
+    # 1. Simulate the state of the world by calling the mock APIs
+    if scenario is None:
+        pi_state = get_mock_pi_status(rng)
+        drive_state = get_mock_system_health(rng)
+    else:
+        pi_choices, drive_choices = _SCENARIO_STATES[scenario]
+        pi_state = get_mock_pi_status(rng, rng.choice(pi_choices))
+        drive_state = get_mock_system_health(rng, rng.choice(drive_choices))
+
+    # 2. Construct the input prompt for the SLM
+    # This is what the SLM "sees". It's a summary of the system status.
+    prompt = f"{AGENT_PROMPT_PREFIX}ASSISTANT (API call): GET /api/system/health -> {json.dumps(drive_state)}\nASSISTANT (API call): GET /api/npu/status -> {json.dumps(pi_state)}\nASSISTANT (thought): Now I will analyze the data and form a plan."
+
+    # 3. Determine the correct plan of action based on the state (The "brains" of the generator)
+    scenario, plan = build_plan(pi_state, drive_state)
+
     # 4. Format the final training example
-    return {
+    return scenario, {
         "prompt": prompt,
         "completion": json.dumps(plan)
     }
 
+def generate_training_example():
+    """Creates a single training example (input prompt + ideal output)."""
+    return generate_labeled_example()[1]
+
+# --- Parallel Sharded Generation ---
+
+def example_hash(example):
+    """64-bit content hash of a (prompt, completion) pair, used for deduplication."""
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(example["prompt"].encode())
+    digest.update(b"\0")
+    digest.update(example["completion"].encode())
+    return int.from_bytes(digest.digest(), "little")
+
+def _generate_chunk(args):
+    """Worker: generates one chunk of examples; returns (hash, scenario, json_line) tuples."""
+    base_seed, chunk_index, chunk_size, balanced = args
+    # Each chunk has its own seed, so a run is reproducible for a given --seed.
+    rng = random.Random(f"{base_seed}:{chunk_index}")
+    out = []
+    for i in range(chunk_size):
+        forced = SCENARIOS[(chunk_index * chunk_size + i) % len(SCENARIOS)] if balanced else None
+        scenario, example = generate_labeled_example(rng, forced)
+        example["scenario"] = scenario
+        out.append((example_hash(example), scenario, json.dumps(example)))
+    return out
+
+class HashIndex:
+    """
+    The set of 64-bit content hashes seen so far, kept as a sorted numpy array
+    (8 bytes per hash, where a Python set of ints takes about 70). New hashes
+    are buffered in a small set and merged in every merge_every additions.
+    """
+
+    def __init__(self, merge_every=65536):
+        self.merge_every = merge_every
+        self._sorted = np.empty(0, dtype=np.uint64)
+        self._recent = set()
+
+    def contains_many(self, hashes):
+        """Returns a boolean array telling, for each hash in the list, whether it has been added."""
+        values = np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+        positions = np.searchsorted(self._sorted, values)
+        found = np.zeros(len(values), dtype=bool)
+        inside = positions < len(self._sorted)
+        found[inside] = self._sorted[positions[inside]] == values[inside]
+        if self._recent:
+            found |= np.fromiter((h in self._recent for h in hashes), dtype=bool, count=len(hashes))
+        return found
+
+    def update(self, hashes):
+        """Adds hashes, which must not have been added before."""
+        self._recent.update(hashes)
+        if len(self._recent) >= self.merge_every:
+            new = np.fromiter(self._recent, dtype=np.uint64, count=len(self._recent))
+            new.sort()
+            self._sorted = np.insert(self._sorted, np.searchsorted(self._sorted, new), new)
+            self._recent.clear()
+
+class ShardWriter:
+    """Streams JSONL lines into numbered shard files of at most shard_size lines."""
+
+    def __init__(self, output_dir, shard_size):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.paths = []
+        self._file = None
+        self._lines = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+    def write(self, line):
+        if self._file is None or self._lines >= self.shard_size:
+            self.close()
+            path = os.path.join(self.output_dir, f"train-{len(self.paths):05d}.jsonl")
+            self.paths.append(path)
+            self._file = open(path, "w")
+            self._lines = 0
+        self._file.write(line + "\n")
+        self._lines += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def generate_sharded(target, output_dir, workers=None, seed=0, balanced=False,
+                     shard_size=100000, chunk_size=2000, max_chunks=None):
+    """
+    Generates `target` unique examples across a process pool and streams them to shards.
+
+    Chunks are handed out in order and consumed in order, with a bounded number
+    in flight, and the output is identical for the same seed and chunk size.
+    Memory is constant apart from the dedupe index (HashIndex), which grows by
+    8 bytes per unique example and briefly doubles while merging: about 40 MB
+    steady and 80 MB peak for 5 million examples. With balanced=True
+    every scenario gets an equal share of the target.
+    Returns a summary dict with counts per scenario and the shard paths.
+    """
+    workers = workers or os.cpu_count() or 1
+    quota = -(-target // len(SCENARIOS)) if balanced else None
+    # Stop if we keep producing only duplicates (the generator's variety is exhausted).
+    max_chunks = max_chunks or 10 * (-(-target // chunk_size)) + 10 * workers
+
+    seen = HashIndex()
+    counts = {name: 0 for name in SCENARIOS}
+    written = duplicates = 0
+    writer = ShardWriter(output_dir, shard_size)
+    next_chunk = 0
+    try:
+        with Pool(workers) as pool:
+            in_flight = deque()
+            while written < target:
+                while len(in_flight) < 2 * workers and next_chunk < max_chunks:
+                    in_flight.append(pool.apply_async(_generate_chunk, ((seed, next_chunk, chunk_size, balanced),)))
+                    next_chunk += 1
+                if not in_flight:
+                    print(f"WARNING: Stopped after {next_chunk} chunks; only {written} unique examples found.")
+                    break
+                chunk = in_flight.popleft().get()
+                known = seen.contains_many([content_hash for content_hash, _, _ in chunk])
+                added = set()
+                for (content_hash, scenario, line), duplicate in zip(chunk, known):
+                    if duplicate or content_hash in added:
+                        duplicates += 1
+                        continue
+                    if quota is not None and counts[scenario] >= quota:
+                        continue
+                    added.add(content_hash)
+                    counts[scenario] += 1
+                    writer.write(line)
+                    written += 1
+                    if written >= target:
+                        break
+                seen.update(added)
+    finally:
+        writer.close()
+
+    return {"written": written, "duplicates_skipped": duplicates, "scenarios": counts, "shards": writer.paths}
+
 # --- Main Execution ---
-if __name__ == "__main__":
-    dataset = [generate_training_example() for _ in range(200)] # Generate 200 examples
-    
+def main():
+    parser = argparse.ArgumentParser(description="Generate storage-management training data for the SLM.")
+    parser.add_argument("--output-dir", help="Write sharded JSONL here using a process pool (default: single 200-row file).")
+    parser.add_argument("--target", type=int, default=200, help="Number of unique examples to generate.")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: all cores).")
+    parser.add_argument("--seed", type=int, default=0, help="Base seed; each chunk derives its own seed from it.")
+    parser.add_argument("--balanced", action="store_true", help="Generate an equal number of examples per scenario.")
+    parser.add_argument("--shard-size", type=int, default=100000, help="Examples per output shard.")
+    parser.add_argument("--chunk-size", type=int, default=2000, help="Examples generated per worker task.")
+    args = parser.parse_args()
+
+    if args.output_dir:
+        summary = generate_sharded(args.target, args.output_dir, args.workers, args.seed,
+                                   args.balanced, args.shard_size, args.chunk_size)
+        print(f"Successfully generated {summary['written']} unique training examples "
+              f"({summary['duplicates_skipped']} duplicates skipped).")
+        print(f"Scenarios: {json.dumps(summary['scenarios'])}")
+        print(f"Dataset saved to {len(summary['shards'])} shard(s) in '{args.output_dir}'")
+        return
+
+    dataset = [generate_training_example() for _ in range(args.target)] # Generate 200 examples
+
     # Save to a file in a format suitable for fine-tuning (e.g., JSON Lines)
     with open("storage_management_training_data.jsonl", "w") as f:
         for entry in dataset:
             f.write(json.dumps(entry) + "\n")
-            
+
     print(f"Successfully generated {len(dataset)} training examples.")
     print("Dataset saved to 'storage_management_training_data.jsonl'")
+
+if __name__ == "__main__":
+    main()